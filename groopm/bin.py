@@ -373,36 +373,44 @@ class Bin:
             upper = limit
         return np.arange(lower, upper)
 
+    def makePixelRange(self, pos, span, limit):
+        """Make a search range of whole pixels within span of pos, [lower, upper)"""
+        lower = max(int(np.ceil(pos-span)), 0)
+        upper = min(int(np.floor(pos+span))+1, limit)
+        return (lower, upper)
+
     def recruit(self,
                 PM,
                 GT,
-                im2RowIndices,
+                pixelIndex,
                 inclusivity=1):
-        """Recruit more contigs into the bin, used during coring only"""
+        """Recruit more contigs into the bin, used during coring only
+
+        pixelIndex is the ClusterEngine's PixelIndex of unbinned points
+        """
         num_recruited = 0
 
         # make the distribution
         self.makeBinDist(PM.transformedCP, PM.averageCoverages, PM.kmerNormPC1, PM.kmerPCs, PM.contigGCs, PM.contigLengths)
         c_lens = PM.contigLengths[self.rowIndices]
 
-        for x in self.makeRanges(self.covMedians[0], inclusivity*self.covStdevs[0], PM.scaleFactor):
-            for y in self.makeRanges(self.covMedians[1], inclusivity*self.covStdevs[1], PM.scaleFactor):
-                for z in self.makeRanges(self.covMedians[2], inclusivity*self.covStdevs[2], PM.scaleFactor):
-                    # make sure it's a legit point
-                    try:
-                        for row_index in im2RowIndices[(x,y,z)]:
-                            if (row_index not in PM.binnedRowIndices) and (row_index not in self.rowIndices) and (row_index not in PM.restrictedRowIndices):
-                                # check the length
-                                length_wrong = GT.isMaxOutlier(PM.contigLengths[row_index],
-                                                               c_lens)
-                                if not length_wrong:
-                                    # fits length cutoff
-                                    (covZ,merZ) = self.scoreProfile(PM.kmerNormPC1[row_index], PM.transformedCP[row_index])
-                                    if covZ <= inclusivity and merZ <= inclusivity:
-                                        # we can recruit
-                                        self.rowIndices = np.append(self.rowIndices,row_index)
-                                        num_recruited += 1
-                    except KeyError: pass
+        (x_lower, x_upper) = self.makePixelRange(self.covMedians[0], inclusivity*self.covStdevs[0], PM.scaleFactor)
+        (y_lower, y_upper) = self.makePixelRange(self.covMedians[1], inclusivity*self.covStdevs[1], PM.scaleFactor)
+        (z_lower, z_upper) = self.makePixelRange(self.covMedians[2], inclusivity*self.covStdevs[2], PM.scaleFactor)
+        (candidates, points) = pixelIndex.query(x_lower, x_upper, y_lower, y_upper, z_lower, z_upper)
+        members = set(self.rowIndices)
+        for row_index in candidates:
+            if (row_index not in PM.binnedRowIndices) and (row_index not in members) and (row_index not in PM.restrictedRowIndices):
+                # check the length
+                length_wrong = GT.isMaxOutlier(PM.contigLengths[row_index],
+                                               c_lens)
+                if not length_wrong:
+                    # fits length cutoff
+                    (covZ,merZ) = self.scoreProfile(PM.kmerNormPC1[row_index], PM.transformedCP[row_index])
+                    if covZ <= inclusivity and merZ <= inclusivity:
+                        # we can recruit
+                        self.rowIndices = np.append(self.rowIndices,row_index)
+                        num_recruited += 1
 
     def shuffleMembers(self, adds, removes):
         """add some guys, take some guys away"""
@@ -98,10 +98,12 @@ class BinManager:
                  dbFileName="",
                  pm=None,
                  minSize=10,
-                 minVol=1000000):
+                 minVol=1000000,
+                 memmapDir=None,
+                 samples=None):
         # data storage
         if(dbFileName != ""):
-            self.PM = ProfileManager(dbFileName)
+            self.PM = ProfileManager(dbFileName, memmapDir=memmapDir, samples=samples)
         elif(pm is not None):
             self.PM = pm
 
@@ -112,6 +114,7 @@ class BinManager:
         # misc
         self.minSize=minSize           # Min number of contigs for a bin to be considered legit
         self.minVol=minVol             # Override on the min size, if we have this many BP
+        self.backgroundSaves = False   # queue bin saves on the DB writer thread
 
     def setColorMap(self, colorMapStr):
         self.PM.setColorMap(colorMapStr)
@@ -132,8 +135,13 @@ class BinManager:
                  loadLinks=False,
                  loadContigNames=True,
                  cutOff=0,
-                 transform=True):
-        """Load data and make bin objects"""
+                 transform=True,
+                 prefetch=False):
+        """Load data and make bin objects
+
+        Set prefetch to load contig names and links in the background
+        while the bins are built (see ProfileManager.loadData)
+        """
         # build the condition
 
         if getUnbinned:
@@ -162,7 +170,8 @@ class BinManager:
                          loadContigNames=loadContigNames,
                          loadContigLengths=loadContigLengths,
                          loadBins=True,
-                         loadLinks=loadLinks
+                         loadLinks=loadLinks,
+                         prefetch=prefetch
                         )
 
         # exit if no bins loaded
@@ -222,7 +231,7 @@ class BinManager:
             print(invalid_bids)
             exit(-1)
 
-    def saveBins(self, binAssignments={}, nuke=False):
+    def saveBins(self, binAssignments={}, nuke=False, background=None):
         """Save binning results
 
         binAssignments is a hash of LOCAL row indices Vs bin ids
@@ -230,14 +239,56 @@ class BinManager:
         PM.setBinAssignments needs GLOBAL row indices
 
         We always overwrite the bins table (It is smallish)
+
+        If background is set (defaults to self.backgroundSaves) the write
+        is queued and we return straight away. Call flushBins to wait
         """
-        # save the bin assignments
-        self.PM.setBinAssignments(
-                                  self.getGlobalBinAssignments(binAssignments), # convert to global indices
-                                  nuke=nuke
-                                  )
-        # overwrite the bins table
-        self.setBinStats()
+        if background is None:
+            background = self.backgroundSaves
+
+        # snapshot the state now, the bins may change before the write happens
+        assignments = self.getGlobalBinAssignments(binAssignments) # convert to global indices
+        bin_stats = self.getBinStats()
+
+        if background:
+            self.PM.dataManager.queueWrite(self.PM.dbFileName,
+                                           self.writeBins,
+                                           args=(assignments, nuke, bin_stats),
+                                           key='bins',
+                                           merge=self.mergeBinSaves)
+        else:
+            # don't let an older queued save land on top of this one
+            self.flushBins()
+            self.writeBins(assignments, nuke, bin_stats)
+
+    def writeBins(self, assignments, nuke, binStats):
+        """Write bin assignments (GLOBAL row indices) and bin stats to the DB"""
+        # write everything under one lock so readers never see
+        # new assignments with old bin stats (or vice versa)
+        with self.PM.dataManager.lockDB(self.PM.dbFileName, exclusive=True):
+            # save the bin assignments
+            self.PM.setBinAssignments(assignments, nuke=nuke)
+            # overwrite the bins table
+            self.PM.setBinStats(binStats)
+
+    def flushBins(self):
+        """Wait for any bin saves queued in the background"""
+        self.PM.dataManager.flushWrites()
+
+    def mergeBinSaves(self, oldArgs, newArgs):
+        """Coalesce two queued bin saves into one
+
+        The bin stats are always rewritten in full so the newest wins.
+        Assignments are updates, so apply the newer ones over the older
+        unless the newer save starts from scratch anyway
+        """
+        (old_assignments, old_nuke, old_stats) = oldArgs
+        (new_assignments, new_nuke, new_stats) = newArgs
+        if new_nuke:
+            return newArgs
+        assignments = dict(old_assignments)
+        assignments.update(new_assignments)
+        return (assignments, old_nuke, new_stats)
 
     def getGlobalBinAssignments(self, binAssignments={}):
         """Merge the bids, raw DB indexes and core information so we can save to disk
@@ -267,15 +318,19 @@ class BinManager:
 
         Note that this call effectively nukes the existing table
         """
+        self.PM.setBinStats(self.getBinStats())
+
+    def getBinStats(self):
+        """Make a list of tuples of bin stats suitable for the DB
 
-        # create and array of tuples:
-        # [(bid, size, likelyChimeric)]
+        [(bid, size, likelyChimeric)]
+        """
         bin_stats = []
         for bid in self.getBids():
             # no point in saving empty bins
             if np_size(self.bins[bid].rowIndices) > 0:
                 bin_stats.append((bid, np_size(self.bins[bid].rowIndices), self.PM.isLikelyChimeric[bid]))
-        self.PM.setBinStats(bin_stats)
+        return bin_stats
 
 
 #------------------------------------------------------------------------------
@@ -331,6 +386,7 @@ class BinManager:
     def getLinkingContigs(self, bid):
         """Get all contigs and their bin IDs which link to contigs in this bin"""
         bin2count = {}
+        self.PM.waitForPrefetch('links')
         for row_index in bin.rowIndices:
             try:
                 #print(row_index, len(self.PM.links[row_index]), self.PM.links[row_index], "===",)
@@ -355,6 +411,7 @@ class BinManager:
     def getConnectedBins(self, rowIndex):
         """Get a  list of bins connected to this contig"""
         ret_links = []
+        self.PM.waitForPrefetch('links')
         for link in self.PM.links[rowIndex]:
             cid = link[0]
             try:
@@ -392,6 +449,7 @@ class BinManager:
         """Determine the average number of links between contigs in a bin"""
         links = []
         min_links = 1000000000
+        self.PM.waitForPrefetch('links')
         for row_index in bin.rowIndices:
             try:
                 for link in self.PM.links[row_index]:
@@ -1143,6 +1201,7 @@ class BinManager:
             print("Error: Unrecognised format:", outFormat)
             return
 
+        self.PM.waitForPrefetch('contigNames')
         for bid in self.getBids():
             self.bins[bid].makeBinDist(self.PM.transformedCP, self.PM.averageCoverages, self.PM.kmerNormPC1,
                                         self.PM.kmerPCs, self.PM.contigGCs, self.PM.contigLengths)
@@ -48,49 +48,72 @@ __email__ = "mike@mikeimelfort.com"
 
 ###############################################################################
 
-from sys import stdout, exit
+from sys import stdout
+from multiprocessing.pool import ThreadPool
+from time import time
 
 from colorsys import hsv_to_rgb as htr
 import matplotlib.pyplot as plt
 
 from numpy import (abs as np_abs,
+                   add as np_add,
+                   all as np_all,
                    allclose as np_allclose,
                    append as np_append,
                    arange as np_arange,
                    argmax as np_argmax,
                    argsort as np_argsort,
+                   clip as np_clip,
                    around as np_around,
                    array as np_array,
+                   average as np_average,
                    bincount as np_bincount,
                    concatenate as np_concatenate,
+                   cumsum as np_cumsum,
                    copy as np_copy,
                    cos as np_cos,
                    delete as np_delete,
+                   diff as np_diff,
                    finfo as np_finfo,
+                   geterr as np_geterr,
+                   float32 as np_float32,
                    hypot as np_hypot,
+                   in1d as np_in1d,
                    inf as np_inf,
+                   hstack as np_hstack,
+                   lexsort as np_lexsort,
+                   linspace as np_linspace,
                    log10 as np_log10,
                    max as np_max,
+                   maximum as np_maximum,
                    mean as np_mean,
                    median as np_median,
                    min as np_min,
+                   minimum as np_minimum,
+                   nonzero as np_nonzero,
                    ones as np_ones,
                    pi as np_pi,
+                   repeat as np_repeat,
                    reshape as np_reshape,
+                   searchsorted as np_searchsorted,
                    seterr as np_seterr,
                    shape as np_shape,
                    sin as np_sin,
                    size as np_size,
-                   sort as np_sort,
                    std as np_std,
                    sum as np_sum,
                    sqrt as np_sqrt,
+                   unique as np_unique,
                    unravel_index as np_unravel_index,
                    where as np_where,
                    zeros as np_zeros)
 from numpy.linalg import norm as np_norm
+from numpy.random import (get_state as np_random_get_state,
+                          set_state as np_random_set_state)
 import scipy.ndimage as ndi
-from scipy.spatial.distance import pdist, squareform, cityblock, euclidean
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import euclidean
 from scipy.misc import imsave
 
 # GroopM imports
@@ -98,7 +121,7 @@ from profileManager import ProfileManager
 from binManager import BinManager
 from refine import GrubbsTester, RefineEngine
 from PCA import PCA, Center
-from groopmExceptions import BinNotFoundException
+from groopmExceptions import BinNotFoundException, InvalidPyramidLevelException
 
 np_seterr(all='raise')
 
@@ -117,10 +140,16 @@ class ClusterEngine:
                  force=False,
                  numImgMaps=1,
                  minSize=5,
-                 minVol=1000000):
+                 minVol=1000000,
+                 memmapDir=None,
+                 samples=None,
+                 peaksPerRound=1,
+                 threads=1,
+                 pyramidLevels=(1,),
+                 checkpointInterval=1800):
 
         # worker classes
-        self.PM = ProfileManager(dbFileName) # store our data
+        self.PM = ProfileManager(dbFileName, memmapDir=memmapDir, samples=samples) # store our data
         self.BM = BinManager(pm=self.PM, minSize=minSize, minVol=minVol)
 
         # heat maps
@@ -128,12 +157,49 @@ class ClusterEngine:
         self.imageMaps = np_zeros((self.numImgMaps,self.PM.scaleFactor,self.PM.scaleFactor))
         self.blurredMaps = np_zeros((self.numImgMaps,self.PM.scaleFactor,self.PM.scaleFactor))
 
+        # the blurred maps are kept up to date incrementally
+        self.blurSource = np_zeros((self.numImgMaps,self.PM.scaleFactor,self.PM.scaleFactor)) # image maps as they were last blurred
+        self.dirtyBounds = [None]*self.numImgMaps # [x_min, x_max, y_min, y_max] of points changed since then
+        self.blurStale = True                     # need to blur everything next time
+        self.blurUpdates = 0                      # local updates since the last full blur
+        self.fullBlurInterval = 100               # redo the full blur this often to stop errors building up
+
+        # hot spots are found on a coarse copy of the top view and followed
+        # down to full resolution, only blurring small windows at the finer
+        # levels. Each level is downsampled by this factor, coarsest first
+        # and always ending at 1 (no pyramid)
+        for factor in pyramidLevels:
+            if factor < 1:
+                raise InvalidPyramidLevelException("Pyramid levels must be at least 1, not %d" % factor)
+        self.pyramidLevels = sorted(set(pyramidLevels) | set([1]), reverse=True)
+        self.coarseImage = None         # top view summed over pyramidLevels[0] square cells
+        self.coarseSource = None        # coarse image as it was last blurred
+        self.coarseBlurred = None
+
         # we need a way to reference from the imageMaps back onto the transformed data
-        self.im2RowIndices = {}
+        # (a PixelIndex, built by populateImageMaps)
+        self.pixelIndex = None
 
         # When blurring the raw image maps I chose a radius to suit my data, you can vary this as you like
         self.blurRadius = 2
         self.span = 45                  # amount we can travel about when determining "hot spots"
+        self.maxContractionSize = 20000 # bigger blobs are partitioned from a sample
+        self.peaksPerRound = peaksPerRound # hot spots to work on at once when making cores
+        self.minPeakHeight = 0.05       # ...ignoring those cooler than this fraction of the hottest
+        self.threads = threads          # worker threads for partitioning the blobs
+        self.workerPool = None
+
+        # finding the densest point in a column, each contig adds this
+        # stencil about itself (centre slice in the middle)
+        stencil_edge = np_array([[1.6, 2.5, 1.6],
+                                 [2.5, 4.9, 2.5],
+                                 [1.6, 2.5, 1.6]])
+        stencil_centre = np_array([[2.5, 4.9, 2.5],
+                                   [4.9, 6.4, 4.9],
+                                   [2.5, 4.9, 2.5]])
+        self.stencil3D = np_array([stencil_edge, stencil_centre, stencil_edge], dtype=np_float32)
+        self.workingBlock = None        # (z, x, y) blocks reused by findDensestPoint
+        self.blurredBlock = None
 
         # Misc tools we'll need
         self.timer = timer
@@ -150,6 +216,12 @@ class ClusterEngine:
         self.subRoundNumber = 0         # measure sub rounds too!
         self.TSpan = 0.                 # dist from centre to the corner
 
+        # checkpoints
+        self.checkpointInterval = checkpointInterval # seconds between checkpoints (0 for none)
+        self.lastCheckpoint = 0.
+        self.nukeOnCheckpoint = True    # the first checkpoint of a fresh run clears the old bins
+        self.coreCut = 0
+
     def promptOnOverwrite(self, minimal=False):
         """Check that the user is ok with possibly overwriting the DB"""
         if(self.PM.isClustered()):
@@ -180,14 +252,31 @@ class ClusterEngine:
 #------------------------------------------------------------------------------
 # CORE CONSTRUCTION AND MANAGEMENT
 
-    def makeCores(self, coreCut, gf="", kmerThreshold=0.2, coverageThreshold=0.05):
-        """Cluster the contigs to make bin cores"""
-        # check that the user is OK with nuking stuff...
-        if(not self.promptOnOverwrite()):
-            return False
+    def makeCores(self, coreCut, gf="", kmerThreshold=0.2, coverageThreshold=0.05, resume=False):
+        """Cluster the contigs to make bin cores
+
+        If resume is set then carry on from the last checkpoint (if any)
+        """
+        checkpoint = None
+        if resume:
+            checkpoint = self.PM.dataManager.getCoreCheckpoint(self.PM.dbFileName)
+            if checkpoint is None:
+                print("    No checkpoint found, starting from scratch")
+
+        if checkpoint is None:
+            # check that the user is OK with nuking stuff...
+            if(not self.promptOnOverwrite()):
+                return False
+            self.PM.dataManager.clearCoreCheckpoint(self.PM.dbFileName)
+            self.nukeOnCheckpoint = True
+        else:
+            self.nukeOnCheckpoint = False
+        self.coreCut = coreCut
 
         # get some data
-        self.PM.loadData(self.timer, "length >= "+str(coreCut))
+        # names are only needed for debug plots and never block
+        # the heat maps, so let them load in the background
+        self.PM.loadData(self.timer, "length >= "+str(coreCut), prefetch=True, loadBins=(checkpoint is not None))
         print("    %s" % self.timer.getTimeStamp())
 
         # transform the data
@@ -202,6 +291,9 @@ class ClusterEngine:
 
         print("    %s" % self.timer.getTimeStamp())
 
+        if checkpoint is not None:
+            self.resumeFromCheckpoint(checkpoint)
+
         # cluster and bin!
         print("Create cores")
         self.initialiseCores(kmerThreshold, coverageThreshold)
@@ -218,8 +310,53 @@ class ClusterEngine:
         # Now save all the stuff to disk!
         print("Saving bins")
         self.BM.saveBins(nuke=True)
+        self.PM.dataManager.clearCoreCheckpoint(self.PM.dbFileName)
         print("    %s" % self.timer.getTimeStamp())
 
+    def checkpoint(self):
+        """Save the cores made so far so an interrupted run can be resumed
+
+        The bins are saved as usual, the restricted rows and everything else
+        we need go in the checkpoint. Both are written in the background
+        """
+        self.BM.saveBins(nuke=self.nukeOnCheckpoint, background=True)
+        self.nukeOnCheckpoint = False
+
+        restricted = np_array(sorted(self.PM.restrictedRowIndices.keys()), dtype=int)
+        state = {'coreCut' : self.coreCut,
+                 'roundNumber' : self.roundNumber,
+                 'rngState' : np_random_get_state()}
+        self.PM.dataManager.queueWrite(self.PM.dbFileName,
+                                       self.PM.dataManager.setCoreCheckpoint,
+                                       args=(self.PM.indices[restricted], state),
+                                       key='core_checkpoint')
+        self.lastCheckpoint = time()
+
+    def resumeFromCheckpoint(self, checkpoint):
+        """Rebuild the cores and restricted rows saved by checkpoint
+
+        Must be called after the data is loaded (with bins) and transformed
+        but before the image maps are made, they will leave these rows out
+        """
+        (restricted, state) = checkpoint
+        if state['coreCut'] != self.coreCut:
+            print("    WARNING: checkpoint was made with a core cutoff of %d" % state['coreCut'])
+
+        self.BM.makeBins(self.BM.getBinMembers())
+
+        # restricted rows are saved as GLOBAL indices, some may not
+        # have been loaded this time
+        row_indices = np_searchsorted(self.PM.indices, restricted)
+        found = row_indices < len(self.PM.indices)
+        found[found] = self.PM.indices[row_indices[found]] == restricted[found]
+        for row_index in row_indices[found]:
+            if row_index not in self.PM.binnedRowIndices:
+                self.PM.restrictedRowIndices[row_index] = True
+
+        self.roundNumber = state['roundNumber']
+        np_random_set_state(state['rngState'])
+        print("    Resuming from checkpoint with %d cores and %d restricted contigs" % (len(self.BM.bins), len(self.PM.restrictedRowIndices)))
+
     def initialiseCores(self, kmerThreshold, coverageThreshold):
         """Process contigs and form CORE bins"""
         num_below_cutoff = 0            # how many consecutive attempts have produced small bins
@@ -228,6 +365,7 @@ class ClusterEngine:
         # First we need to find the centers of each blob.
         # We can make a heat map and look for hot spots
         self.populateImageMaps()
+        self.lastCheckpoint = time()
         sub_counter = 0
         print("     .... .... .... .... .... .... .... .... .... ....")
         print("%4d" % sub_counter,)
@@ -243,13 +381,20 @@ class ClusterEngine:
 
             # now search for the "hottest" spots on the blurred map
             # and check for possible bin centroids
-            putative_clusters = self.findNewClusterCenters(kmerThreshold, coverageThreshold)
+            all_putative_clusters = self.findNewClusterCenters(kmerThreshold, coverageThreshold)
 
-            if(putative_clusters is None):
+            if all([putative_clusters is None for putative_clusters in all_putative_clusters]):
                 break
-            else:
+
+            # work through the spots hottest first. The blobs can't overlap
+            # but recruiting for a hotter spot may have taken some contigs
+            for putative_clusters in all_putative_clusters:
+                if putative_clusters is None:
+                    continue
+
                 bids_made = []
-                partitions = putative_clusters[0]
+                partitions = [np_array([row_index for row_index in row_indices if row_index not in self.PM.binnedRowIndices], dtype=int)
+                              for row_indices in putative_clusters[0]]
                 [max_x, max_y] = putative_clusters[1]
                 self.roundNumber += 1
                 self.subRoundNumber = 1
@@ -297,7 +442,7 @@ class ClusterEngine:
                         # recruit more contigs
                         bin.recruit(self.PM,
                                     self.GT,
-                                    self.im2RowIndices
+                                    self.pixelIndex
                                     )
                         self.updatePostBin(bin)
 
@@ -316,50 +461,104 @@ class ClusterEngine:
 
                     except BinNotFoundException: pass
 
-        print("\n     .... .... .... .... .... .... .... .... .... ....")
+            if self.checkpointInterval > 0 and time() - self.lastCheckpoint >= self.checkpointInterval:
+                self.checkpoint()
 
-    def findNewClusterCenters(self, kmerThreshold, coverageThreshold):
-        """Find a putative cluster"""
-        inRange = lambda x,l,u : x >= l and x < u
+        if self.workerPool is not None:
+            self.workerPool.close()
+            self.workerPool.join()
+            self.workerPool = None
 
-        # we work from the top view as this has the base clustering
-        max_index = np_argmax(self.blurredMaps[0])
-        max_value = self.blurredMaps[0].ravel()[max_index]
+        print("\n     .... .... .... .... .... .... .... .... .... ....")
 
-        max_x = int(max_index/self.PM.scaleFactor)
-        max_y = max_index - self.PM.scaleFactor*max_x
+    def findNewClusterCenters(self, kmerThreshold, coverageThreshold):
+        """Find putative clusters
 
-        ret_values = [max_x, max_y]
+        Returns a list with one entry for each hot spot, hottest first.
+        Entries are [partitions, [x, y]] or None if nothing was found there
+        """
+        peaks = self.findPeaks()
 
         if(self.debugPlots >= 2):
-            self.plotHeat("HM_%d.%d.png" % (self.roundNumber+1, self.subRoundNumber), x=max_x, y=max_y)
-
-        start_span = int(1.5 * self.span)
-        span_len = 2*start_span+1
+            self.plotHeat("HM_%d.%d.png" % (self.roundNumber+1, self.subRoundNumber), x=peaks[0][0], y=peaks[0][1])
+
+        # the blobs about each peak can't overlap so only the contraction
+        # is worth farming out. The debug plots are not thread safe
+        blobs = [self.findBlob(max_x, max_y) for (max_x, max_y) in peaks]
+        if self.threads == 1 or len(blobs) == 1 or self.debugPlots:
+            return [self.partitionBlob(blob, kmerThreshold, coverageThreshold) for blob in blobs]
+
+        if self.workerPool is None:
+            self.workerPool = ThreadPool(self.threads)
+        err = np_geterr()   # error handling is per thread
+        def work(blob):
+            np_seterr(**err)
+            return self.partitionBlob(blob, kmerThreshold, coverageThreshold)
+        return self.workerPool.map(work, blobs)
+
+    def findPeaks(self):
+        """Find up to peaksPerRound hot spots on the top view
+
+        The hottest spot always comes first. Any others must be local maxima
+        at least minPeakHeight of the hottest and far enough from every
+        hotter peak that the columns findBlob searches don't overlap.
+        Candidates come from the coarsest level of the pyramid
+        """
+        # we work from the top view as this has the base clustering,
+        # starting at the coarsest level of the pyramid
+        factor = self.pyramidLevels[0]
+        if factor == 1:
+            heat = self.blurredMaps[0]
+        else:
+            heat = self.coarseBlurred
+        heat_len = np_shape(heat)[1]
+        max_index = np_argmax(heat)
+        peaks = [self.refinePeak(int(max_index/heat_len), max_index - heat_len*int(max_index/heat_len))]
+
+        if self.peaksPerRound > 1:
+            separation = 2*int(1.5 * self.span)
+            flat_heat = np_reshape(heat, -1)
+            local_max = (ndi.maximum_filter(heat, size=int(separation/factor)+1, mode='constant') == heat)
+            local_max &= heat >= self.minPeakHeight * flat_heat[max_index]
+            candidates = np_nonzero(np_reshape(local_max, -1))[0]
+            # hottest first, ties go to the lowest index
+            candidates = candidates[np_lexsort((candidates, -flat_heat[candidates]))]
+            for index in candidates:
+                if len(peaks) >= self.peaksPerRound:
+                    break
+                peak = self.refinePeak(int(index/heat_len), index - heat_len*int(index/heat_len))
+                if all(max(abs(peak[0] - p[0]), abs(peak[1] - p[1])) > separation for p in peaks):
+                    peaks.append(peak)
+
+        return peaks
+
+    def findBlob(self, max_x, max_y):
+        """Find the unbinned contigs about the densest point of the column above a hot spot
+
+        Returns [row indices, [x, y] of the hot spot, densest point]
+        """
+        inRange = lambda x,l,u : x >= l and x < u
 
-        # make a 3d grid to hold the values
-        working_block = np_zeros((span_len, span_len, self.PM.scaleFactor))
+        ret_values = [max_x, max_y]
 
         # go through the entire column
+        start_span = int(1.5 * self.span)
         (x_lower, x_upper) = self.makeCoordRanges(max_x, start_span)
         (y_lower, y_upper) = self.makeCoordRanges(max_y, start_span)
-        super_putative_row_indices = []
-        for p in self.im2RowIndices:
-            if inRange(p[0],x_lower,x_upper) and inRange(p[1],y_lower,y_upper):
-                for row_index in self.im2RowIndices[p]:
-                    # check that the point is real and that it has not yet been binned
-                    if row_index not in self.PM.binnedRowIndices and row_index not in self.PM.restrictedRowIndices:
-                        # this is an unassigned point.
-                        multiplier = np_log10(self.PM.contigLengths[row_index])
-                        self.incrementAboutPoint3D(working_block, p[0]-x_lower, p[1]-y_lower, p[2],multiplier=multiplier)
-                        super_putative_row_indices.append(row_index)
+        (column_rows, column_points) = self.pixelIndex.query(x_lower, x_upper, y_lower, y_upper)
+
+        # check that the points have not yet been binned
+        free = np_array([row_index not in self.PM.binnedRowIndices and row_index not in self.PM.restrictedRowIndices for row_index in column_rows], dtype=bool)
+        super_putative_row_indices = column_rows[free]
+        if len(super_putative_row_indices) == 0:
+            # it's all over!
+            return None
 
         # blur and find the highest value
-        bwb = ndi.gaussian_filter(working_block, 8)#self.blurRadius)
-        densest_index = np_unravel_index(np_argmax(bwb), (np_shape(bwb)))
-        max_x = densest_index[0] + x_lower
-        max_y = densest_index[1] + y_lower
-        max_z = densest_index[2]
+        (max_x, max_y, max_z) = self.findDensestPoint(column_points[free] - [x_lower, y_lower, 0],
+                                                      np_log10(self.PM.contigLengths[super_putative_row_indices]))
+        max_x += x_lower
+        max_y += y_lower
 
         # now get the basic color of this dense point
         putative_center_row_indices = []
@@ -381,6 +580,16 @@ class ClusterEngine:
                 putative_center_row_indices.append(row_index)
 
         putative_center_row_indices = np_array(putative_center_row_indices)
+        return [putative_center_row_indices, ret_values, [max_x, max_y]]
+
+    def partitionBlob(self, blob, kmerThreshold, coverageThreshold):
+        """Split a blob found by findBlob into putative clusters
+
+        Returns [partitions, [x, y] of the hot spot] or None
+        """
+        if blob is None:
+            return None
+        (putative_center_row_indices, ret_values, [max_x, max_y]) = blob
 
         # make sure we have something to go on here
         if(np_size(putative_center_row_indices) == 0):
@@ -407,6 +616,26 @@ class ClusterEngine:
 
                 return [putative_clusters, ret_values]
 
+    def inverseDistanceWeights(self, rows, cols, dists, noise, numPoints):
+        """Sparse matrix of normalised inverse distance weights
+
+        Row i holds the weights point i gives each of its neighbours, rows
+        for noise points are left empty
+        """
+        keep = ~noise[rows]
+        rows = rows[keep]
+        cols = cols[keep]
+        dists = dists[keep]
+        # zero distances can only happen if the radius is zero, give
+        # these neighbours no weight rather than blowing up
+        inv_dist = np_zeros(len(dists))
+        nz = dists > 0
+        inv_dist[nz] = 1.0 / dists[nz]
+        sum_inv_dist = np_bincount(rows, weights=inv_dist, minlength=numPoints)[rows]
+        nz = sum_inv_dist > 0
+        inv_dist[nz] /= sum_inv_dist[nz]
+        return csr_matrix((inv_dist, (rows, cols)), shape=(numPoints, numPoints))
+
     def twoWayContraction(self, rowIndices, positionInPlane, kmerThreshold, coverageThreshold):
         """Partition a collection of contigs into 'core' groups"""
         # sanity check that there is enough data here to try a determine 'core' groups
@@ -416,13 +645,20 @@ class ClusterEngine:
             # the calling function should restrict these indices
             return [np_array(rowIndices)]
 
+        if len(rowIndices) > self.maxContractionSize:
+            return self.partitionFromSample(rowIndices,
+                                            positionInPlane,
+                                            kmerThreshold,
+                                            coverageThreshold,
+                                            self.maxContractionSize)
+
         # make a copy of the data we'll be munging
         k_dat = np_copy(self.PM.kmerPCs[rowIndices])
         c_dat = np_copy(self.PM.transformedCP[rowIndices])
         l_dat = np_copy(self.PM.contigLengths[rowIndices])
 
         if self.debugPlots >= 2:
-            n_dat = np_copy(self.PM.contigNames[rowIndices])
+            n_dat = np_copy(self.PM.waitForPrefetch('contigNames')[rowIndices])
 
         row_indices = np_copy(rowIndices)
 
@@ -491,107 +727,62 @@ class ClusterEngine:
             c_whiten_dat = (c_dat-c_mean) / c_std
 
             try:
-                # calculate distance matrices
-                c_dist_matrix = squareform(pdist(c_whiten_dat, 'cityblock'))
-                c_radius = np_median(np_sort(c_dist_matrix)[:,eps_neighbours])
-                k_dist_matrix = squareform(pdist(k_dat, 'cityblock'))
-                k_radius = np_median(np_sort(k_dist_matrix)[:,eps_neighbours])
+                # kd-trees give us the neighbourhoods without ever
+                # building the full distance matrices
+                c_engine = NeighbourEngine(c_whiten_dat)
+                c_radius = c_engine.kthNeighbourRadius(eps_neighbours)
+                k_engine = NeighbourEngine(k_dat)
+                k_radius = k_engine.kthNeighbourRadius(eps_neighbours)
             except MemoryError:
-                print("\n")
-                print('*******************************************************************************')
-                print('*********************************    ERROR    *********************************')
-                print('*******************************************************************************')
-                print('GroopM is attempting to do some maths on a putative bin which contains:')
-                print()
-                print('\t\t%d contigs'  % (len(rowIndices)))
-                print()
-                print('This has caused your machine to run out of memory.')
-                print('The most likely cause is that your samples are very different from each other.')
-                print('You can confirm this by running:')
-                print()
-                print('\t\tgroopm explore -m allcontigs %s' % self.PM.dbFileName)
-                print()
-                print('If you notice only vertical "spears" of contigs at the corners of the plot then')
-                print('this means that your samples are very different and you are not getting a good')
-                print('mapping from all samples to all contigs. You may get more mileage by assembling')
-                print('and binning your samples separately.')
-                print()
-                print('If you notice "clouds" of contigs then congratulations! You have found a bug.')
-                print('Please let me know at "%s or via github.com/ecogenomics/GroopM' % __email__)
-                print()
-                print('GroopM is aborting... sorry')
-                print()
-                print('*******************************************************************************')
-                print("\n")
-                exit(-1)
+                # too big to work on in one go, fall back to a smaller sample
+                print("\n    Not enough memory to contract %d contigs, working from a sample" % len(rowIndices))
+                return self.partitionFromSample(rowIndices,
+                                                positionInPlane,
+                                                kmerThreshold,
+                                                coverageThreshold,
+                                                int(len(rowIndices)/2))
+
+            num_points = len(row_indices)
+            min_neighbours = np_max([1, 0.1*eps_neighbours])
 
             # find nearest neighbours to each point in whitened coverage space,
             # and use this to converage a point's kmer profile
-            new_k_dat = np_zeros(k_dat.shape)
-            k_putative_noise = set()
-            k_deltas = []
-            for index, row in enumerate(c_dist_matrix):
-                neigbhours = np_where(row <= c_radius)[0]
-                if len(neigbhours) > np_max([1, 0.1*eps_neighbours]):
-                    neigbhours = neigbhours[1:] # ignore self match
-                else:
-                    # extremely few neighbours so mark this as noise
-                    k_putative_noise.add(index)
-                    new_k_dat[index] = k_dat[index]
-                    continue
-
-                # use distance between kmer profiles as weights for moving similar
-                # points towards each other; a minimum distance based on the kmer
-                # radius is used to avoid zeros and ensure all neighbours provide
-                # some weight
-                neighbour_dist = k_dist_matrix[index][neigbhours] + 0.1 * k_radius
+            (rows, cols) = c_engine.neighbourPairs(c_radius)
+            k_noise = np_bincount(rows, minlength=num_points) + 1 <= min_neighbours
 
-                # move point towards neighbours using inverse distance weighting
-                try:
-                    inv_dist = 1.0 / neighbour_dist
-                except FloatingPointError:
-                    inv_dist = 0.
-                sum_inv_dist = np_sum(inv_dist)
-                try:
-                    neighbour_weights = inv_dist / sum_inv_dist
-                except FloatingPointError:
-                    neighbour_weights = 0.
-                new_k_dat[index] = (1-k_move_perc) * k_dat[index] + k_move_perc * np_sum( (k_dat[neigbhours].T * neighbour_weights).T, axis = 0 )
+            # use distance between kmer profiles as weights for moving similar
+            # points towards each other; a minimum distance based on the kmer
+            # radius is used to avoid zeros and ensure all neighbours provide
+            # some weight
+            neighbour_dist = k_engine.pairDistances(rows, cols) + 0.1 * k_radius
+            weights = self.inverseDistanceWeights(rows, cols, neighbour_dist, k_noise, num_points)
 
-                k_deltas.append(cityblock(k_dat[index], new_k_dat[index]))
+            # move points towards neighbours using inverse distance weighting
+            new_k_dat = (1-k_move_perc) * k_dat + k_move_perc * weights.dot(k_dat)
+            new_k_dat[k_noise] = k_dat[k_noise]
+            k_deltas = np_sum(np_abs(k_dat - new_k_dat), axis=1)[~k_noise]
+            k_putative_noise = set(np_nonzero(k_noise)[0])
 
-            k_dat = new_k_dat
+            k_dat = new_k_dat.astype(k_dat.dtype)
 
             # find nearest neighbours to each point in kmer space,
             # and use this to converage a point's coverage profile
-            new_c_dat = np_zeros(c_dat.shape)
-            c_putative_noise = set()
-            c_deltas = []
-            for index, row in enumerate(k_dist_matrix):
-                neigbhours = np_where(row <= k_radius)[0]
-                if len(neigbhours) > np_max([1, 0.1*eps_neighbours]):
-                    neigbhours = neigbhours[1:] # ignore self match
-                else:
-                    # extremely few neighbours so mark this as nois
-                    c_putative_noise.add(index)
-                    new_c_dat[index] = c_dat[index]
-                    continue
+            (rows, cols) = k_engine.neighbourPairs(k_radius)
+            c_noise = np_bincount(rows, minlength=num_points) + 1 <= min_neighbours
 
-                # use distance between whitened coverage profiles as weights for moving similar
-                # points towards each other; a minimum distance based of the coverage
-                # radius is used to avoid zeros and ensure all neighbours provide some weight
-                neighbour_dist = c_dist_matrix[index][neigbhours] + 0.1 * c_radius
+            # use distance between whitened coverage profiles as weights for moving similar
+            # points towards each other; a minimum distance based of the coverage
+            # radius is used to avoid zeros and ensure all neighbours provide some weight
+            neighbour_dist = c_engine.pairDistances(rows, cols) + 0.1 * c_radius
+            weights = self.inverseDistanceWeights(rows, cols, neighbour_dist, c_noise, num_points)
 
-                # move point towards neighbours using inverse distance weighting
-                inv_dist = 1.0 / neighbour_dist
-                sum_inv_dist = np_sum(inv_dist)
-                neighbour_weights = inv_dist / sum_inv_dist
-                new_c_dat[index] = (1-c_move_perc) * c_dat[index] + c_move_perc * np_sum( (c_dat[neigbhours].T * neighbour_weights).T, axis = 0 )
-                new_c_whiten_dat = (1-c_move_perc) * c_whiten_dat[index] + c_move_perc * np_sum( (c_whiten_dat[neigbhours].T * neighbour_weights).T, axis = 0 )
+            new_c_dat = (1-c_move_perc) * c_dat + c_move_perc * weights.dot(c_dat)
+            new_c_dat[c_noise] = c_dat[c_noise]
+            new_c_whiten_dat = (1-c_move_perc) * c_whiten_dat + c_move_perc * weights.dot(c_whiten_dat)
+            c_deltas = np_sum(np_abs(c_whiten_dat - new_c_whiten_dat), axis=1)[~c_noise]
+            c_putative_noise = set(np_nonzero(c_noise)[0])
 
-                c_deltas.append(cityblock(c_whiten_dat[index], new_c_whiten_dat))
-
-            c_dat = new_c_dat
+            c_dat = new_c_dat.astype(c_dat.dtype)
 
             # remove points that have no or few neighbours in both spaces,
             # unless they are long enough to be of interest
@@ -883,34 +1074,89 @@ class ClusterEngine:
 
         return np_array(ret_parts)
 
+    def partitionFromSample(self, rowIndices, positionInPlane, kmerThreshold, coverageThreshold, sampleSize):
+        """Partition a blob which is too big to contract in one go
+
+        An evenly spaced sample of the blob is partitioned as usual. Every
+        other contig then goes wherever its nearest sampled neighbour (in
+        whitened coverage and kmer space) went, including being left out
+        """
+        row_indices = np_array(rowIndices)
+        sample = np_array(self.RE.getEvenlySpacedPtsZ(row_indices, sampleSize))
+        sample_parts = self.twoWayContraction(sample,
+                                              positionInPlane,
+                                              kmerThreshold,
+                                              coverageThreshold)
+        if sample_parts is None:
+            return None
+
+        # which partition each sampled contig ended up in, -1 for none
+        part_ids = np_ones(len(sample), dtype=int) * -1
+        sample_order = np_argsort(sample)
+        for (part_id, part) in enumerate(sample_parts):
+            part_ids[sample_order[np_searchsorted(sample[sample_order], part)]] = part_id
+
+        # whiten using the sample so neither space swamps the other
+        s_dat = np_hstack([self.PM.transformedCP[sample], self.PM.kmerPCs[sample]])
+        s_mean = np_mean(s_dat, axis=0)
+        s_std = np_std(s_dat, axis=0)
+        s_std += np_where(s_std == 0, 1, 0)
+        tree = cKDTree((s_dat - s_mean) / s_std)
+
+        rest = row_indices[~np_in1d(row_indices, sample)]
+        r_dat = np_hstack([self.PM.transformedCP[rest], self.PM.kmerPCs[rest]])
+        (_, nearest) = tree.query((r_dat - s_mean) / s_std, p=1)
+        rest_ids = part_ids[nearest]
+
+        ret_parts = []
+        for (part_id, part) in enumerate(sample_parts):
+            ret_parts.append(np_concatenate([part, rest[rest_ids == part_id]]))
+
+        return np_array(ret_parts)
+
 #------------------------------------------------------------------------------
 # DATA MAP MANAGEMENT
 
     def populateImageMaps(self):
-        """Load the transformed data into the main image maps"""
-        # reset these guys... JIC
-        self.imageMaps = np_zeros((self.numImgMaps,self.PM.scaleFactor,self.PM.scaleFactor))
-        self.im2RowIndices = {}
+        """Load the transformed data into the main image maps
 
-        # add to the grid wherever we find a contig
-        row_index = -1
-        for point in np_around(self.PM.transformedCP):
-            row_index += 1
-            # can only bin things once!
-            if row_index not in self.PM.binnedRowIndices and row_index not in self.PM.restrictedRowIndices:
-                # add to the row_index dict so we can relate the
-                # map back to individual points later
-                p = tuple(point)
-                try:
-                    self.im2RowIndices[p].append(row_index)
-                except KeyError:
-                    self.im2RowIndices[p] = [row_index]
-
-                # now increment in the grid
-                # for each point we encounter we incrmement
-                # it's position + the positions to each side
-                # and touching each corner
-                self.incrementViaRowIndex(row_index, p)
+        Same result as calling incrementViaRowIndex for every free contig,
+        but done as a length weighted histogram of pixel ids which is then
+        convolved with the incrementAboutPoint stencil
+        """
+        # reset these guys... JIC
+        sf = self.PM.scaleFactor
+        self.imageMaps = np_zeros((self.numImgMaps,sf,sf))
+        self.pixelIndex = PixelIndex(np_zeros((0,3), dtype=int), np_array([], dtype=int), sf)
+        self.blurStale = True
+
+        # can only bin things once!
+        free = np_ones(len(self.PM.transformedCP), dtype=bool)
+        free[list(self.PM.binnedRowIndices.keys())] = False
+        free[list(self.PM.restrictedRowIndices.keys())] = False
+        row_indices = np_nonzero(free)[0]
+        if len(row_indices) == 0:
+            return
+
+        points = np_around(self.PM.transformedCP[row_indices]).astype(int)
+        multipliers = np_log10(self.PM.contigLengths[row_indices])
+
+        # for each point we encounter we incrmement
+        # it's position + the positions to each side
+        # and touching each corner
+        stencil = np_array([[0.2, 0.6, 0.2],
+                            [0.6, 1.0, 0.6],
+                            [0.2, 0.6, 0.2]])
+        views = [(points[:,0], points[:,1]),                    # top
+                 (sf - points[:,2] - 1, points[:,1]),           # front
+                 (sf - points[:,2] - 1, sf - points[:,0] - 1)]  # side
+        for view_index in range(self.numImgMaps):
+            (px, py) = views[view_index]
+            counts = np_bincount(px*sf + py, weights=multipliers, minlength=sf*sf)
+            self.imageMaps[view_index] = ndi.convolve(np_reshape(counts, (sf,sf)), stencil, mode='constant', cval=0.)
+
+        # relate the map back to individual points later
+        self.pixelIndex = PixelIndex(points, row_indices, sf)
 
     def incrementViaRowIndex(self, rowIndex, point=None):
         """Wrapper to increment about point"""
@@ -943,6 +1189,7 @@ class ClusterEngine:
 
         multiplier is proportional to the contigs length
         """
+        self.markDirty(view_index, px, py)
         valP *= multiplier
         valS *= multiplier
         valC *= multiplier
@@ -971,6 +1218,7 @@ class ClusterEngine:
 
         multiplier is proportional to the contigs length
         """
+        self.markDirty(view_index, px, py)
         valP *= multiplier
         valS *= multiplier
         valC *= multiplier
@@ -1000,60 +1248,239 @@ class ClusterEngine:
         if map[px][py] < np_finfo(float).eps:
             map[px][py] = 0
 
-    def incrementAboutPoint3D(self, workingBlock, px, py, pz, vals=(6.4,4.9,2.5,1.6), multiplier=1):
-        """Increment a point found in a 3D column
+    def findDensestPoint(self, points, multipliers):
+        """Find the densest point in a column of the transformed space
 
-        used when finding the centroid of a hot area
-        update the 26 points which surround the centre point
-        z spans the height of the entire column, x and y have been offset to
-        match the column subspace
+        points are offset to match the column subspace. Each one adds the
+        length weighted 3x3x3 stencil about itself to the working block,
+        which is then blurred. Only the z slab holding points (plus the
+        blur margin) is touched and the blocks are reused between calls
 
-        multiplier is proportional to the contigs length
+        With a pyramid the whole column is only blurred at the coarsest
+        level, see refineDensestPoint
+        """
+        if self.pyramidLevels[0] > 1:
+            return self.refineDensestPoint(points, multipliers)
+
+        sf = self.PM.scaleFactor
+        if self.workingBlock is None:
+            span_len = 2*int(1.5 * self.span)+1
+            self.workingBlock = np_zeros((sf, span_len, span_len), dtype=np_float32)
+            self.blurredBlock = np_zeros((sf, span_len, span_len), dtype=np_float32)
+
+        # outside the margin the blur can't see the points, so the slab
+        # edges behave like the block edges
+        sigma = 8
+        margin = int(4.0 * sigma + 0.5) + 2
+        z_lower = max(0, np_min(points[:,2]) - 1 - margin)
+        z_upper = min(sf, np_max(points[:,2]) + 2 + margin)
+
+        # blocks are laid out z first so the slab is contiguous
+        block = self.workingBlock[z_lower:z_upper]
+        block[:] = 0.
+        flat_ids = ((points[:,2]-z_lower) * block.shape[1] + points[:,0]) * block.shape[2] + points[:,1]
+        (ids, inverse) = np_unique(flat_ids, return_inverse=True)
+        np_reshape(block, -1)[ids] += np_bincount(inverse, weights=multipliers)
+
+        blurred = self.blurredBlock[z_lower:z_upper]
+        ndi.convolve(block, self.stencil3D, output=blurred, mode='constant', cval=0.)
+        for axis in range(3):
+            ndi.gaussian_filter1d(blurred, sigma, axis=axis, output=blurred)
+
+        (z, x, y) = np_unravel_index(np_argmax(blurred), blurred.shape)
+        return (x, y, z + z_lower)
+
+    def refineDensestPoint(self, points, multipliers):
+        """Find the densest point in a column working down the pyramid
+
+        The column is blurred as a whole at the coarsest level. At each
+        finer level only the cells under the densest cell and its
+        neighbours are blurred and searched
         """
-        valsM = [x*multiplier for x in vals]
-        # top slice
-        if pz < self.PM.scaleFactor-1:
-            self.subIncrement3D(workingBlock, px, py, pz+1, valsM, 1)
+        span_len = 2*int(1.5 * self.span)+1
+        full_shape = np_array([span_len, span_len, self.PM.scaleFactor])
+
+        factor = self.pyramidLevels[0]
+        shape = (full_shape + factor - 1) // factor
+        cells = points // factor
+        lower = np_array([0, 0, np_min(cells[:,2])])
+        upper = np_array([shape[0], shape[1], np_max(cells[:,2])+1])
+        for next_factor in self.pyramidLevels[1:] + [None]:
+            density = self.blurDensity(points, multipliers, factor, lower, upper)
+            (z, x, y) = np_unravel_index(np_argmax(density), density.shape)
+            cell = lower + [x, y, z]
+            if next_factor is None:
+                break
+            lower = np_maximum((cell-1)*factor // next_factor, 0)
+            upper = np_minimum(((cell+2)*factor - 1) // next_factor + 1, (full_shape + next_factor - 1) // next_factor)
+            factor = next_factor
+        return (cell[0], cell[1], cell[2])
 
-        # center slice
-        self.subIncrement3D(workingBlock, px, py, pz, valsM, 0)
+    def blurDensity(self, points, multipliers, factor, lower, upper):
+        """Blurred density of column points over the (x, y, z) cells [lower, upper) at a pyramid level
 
-        # bottom slice
-        if pz > 0:
-            self.subIncrement3D(workingBlock, px, py, pz-1, valsM, 1)
+        Returns a (z, x, y) block. Only the points within the blur margin of
+        the window are used. The stencil is only applied at full resolution
+        """
+        sigma = 8./factor
+        margin = int(4.0 * sigma + 0.5) + 2
+        box_lower = np_maximum(lower - margin, 0)
+        box_upper = upper + margin
+        cells = points // factor
+        inside = np_all((cells >= box_lower) & (cells < box_upper), axis=1)
+        cells = cells[inside] - box_lower
+        shape = box_upper - box_lower
+
+        block = np_zeros((shape[2], shape[0], shape[1]), dtype=np_float32)
+        flat_ids = (cells[:,2] * shape[0] + cells[:,0]) * shape[1] + cells[:,1]
+        (ids, inverse) = np_unique(flat_ids, return_inverse=True)
+        np_reshape(block, -1)[ids] += np_bincount(inverse, weights=multipliers[inside])
+        if factor == 1:
+            block = ndi.convolve(block, self.stencil3D, mode='constant', cval=0.)
+        for axis in range(3):
+            ndi.gaussian_filter1d(block, sigma, axis=axis, output=block)
+
+        (x_lower, y_lower, z_lower) = lower - box_lower
+        (x_upper, y_upper, z_upper) = upper - box_lower
+        return block[z_lower:z_upper, x_lower:x_upper, y_lower:y_upper]
+
+    def markDirty(self, viewIndex, px, py):
+        """Note that the image map has changed about this point"""
+        px = int(px)
+        py = int(py)
+        bounds = self.dirtyBounds[viewIndex]
+        if bounds is None:
+            self.dirtyBounds[viewIndex] = [px, px, py, py]
+        else:
+            if px < bounds[0]: bounds[0] = px
+            if px > bounds[1]: bounds[1] = px
+            if py < bounds[2]: bounds[2] = py
+            if py > bounds[3]: bounds[3] = py
 
-    def subIncrement3D(self, workingBlock, px, py, pz, vals, offset):
-        """AUX: Called from incrementAboutPoint3D does but one slice
+    def blurMaps(self):
+        """Blur the 2D image maps
 
-        multiplier is proportional to the contigs length
-        """
-        # get the size of the working block
-        shape = np_shape(workingBlock)
-        if px > 0:
-            if py > 0:
-                workingBlock[px-1,py-1,pz] += vals[offset + 2]      # Top left corner
-            workingBlock[px-1,py,pz] += vals[offset + 1]            # Top
-            if py < shape[1]-1:
-                workingBlock[px-1,py+1,pz] += vals[offset + 2]      # Top right corner
+        The blur is linear, so once the maps have been blurred in full we
+        only need to blur the change since last time. This is done in a
+        window around the points which changed
 
-        if py > 0:
-            workingBlock[px,py-1,pz] += vals[offset + 1]            # Left side
-        workingBlock[px,py,pz] += vals[offset]                      # Point
-        if py < shape[1]-1:
-            workingBlock[px,py+1,pz] += vals[offset + 1]            # Right side
+        With a pyramid only the coarse top view is kept blurred, the full
+        resolution maps are only needed for plots
+        """
+        full = self.blurStale or self.blurUpdates >= self.fullBlurInterval
+        if self.pyramidLevels[0] == 1 or self.debugPlots:
+            if full:
+                self.blurredMaps = np_zeros((self.numImgMaps,self.PM.scaleFactor,self.PM.scaleFactor))
+                for i in range(self.numImgMaps): # top, front and side
+                    self.blurredMaps[i,:,:] = ndi.gaussian_filter(self.imageMaps[i,:,:], 8)#self.blurRadius)
+                self.blurSource = np_copy(self.imageMaps)
+            else:
+                for i in range(self.numImgMaps):
+                    if self.dirtyBounds[i] is not None:
+                        self.blurWindow(self.imageMaps[i], self.blurSource[i], self.blurredMaps[i], self.dirtyBounds[i], 8)
+        if self.pyramidLevels[0] > 1:
+            self.blurCoarseMap(full)
+
+        self.dirtyBounds = [None]*self.numImgMaps
+        if full:
+            self.blurStale = False
+            self.blurUpdates = 0
+        else:
+            self.blurUpdates += 1
 
-        if px < shape[0]-1:
-            if py > 0:
-                workingBlock[px+1,py-1,pz] += vals[offset + 2]      # Bottom left corner
-            workingBlock[px+1,py,pz] += vals[offset + 1]            # Bottom
-            if py < shape[1]-1:
-                workingBlock[px+1,py+1,pz] += vals[offset + 2]      # Bottom right corner
+    def blurWindow(self, image, source, blurred, bounds, sigma):
+        """Add the blurred change to image since source to blurred, about bounds
 
-    def blurMaps(self):
-        """Blur the 2D image maps"""
-        self.blurredMaps = np_zeros((self.numImgMaps,self.PM.scaleFactor,self.PM.scaleFactor))
-        for i in range(self.numImgMaps): # top, front and side
-            self.blurredMaps[i,:,:] = ndi.gaussian_filter(self.imageMaps[i,:,:], 8)#self.blurRadius)
+        bounds are [x_min, x_max, y_min, y_max] of the changed pixels.
+        gaussian_filter looks int(4*sigma+0.5) pixels out, plus one for the
+        neighbours touched by incrementAboutPoint. Beyond this the change
+        is zero so reflecting at the window edge is exact
+        """
+        margin = int(4*sigma+0.5) + 1
+        x_lower = max(bounds[0]-margin, 0)
+        x_upper = min(bounds[1]+margin+1, image.shape[0])
+        y_lower = max(bounds[2]-margin, 0)
+        y_upper = min(bounds[3]+margin+1, image.shape[1])
+
+        delta = image[x_lower:x_upper,y_lower:y_upper] - source[x_lower:x_upper,y_lower:y_upper]
+        window = blurred[x_lower:x_upper,y_lower:y_upper]
+        window += ndi.gaussian_filter(delta, sigma)
+        window[window < np_finfo(float).eps] = 0.   # rounding errors
+        source[x_lower:x_upper,y_lower:y_upper] = image[x_lower:x_upper,y_lower:y_upper]
+
+    def blurCoarseMap(self, full):
+        """Bring the blurred coarse top view up to date"""
+        factor = self.pyramidLevels[0]
+        if full or self.coarseImage is None:
+            self.coarseImage = self.poolMap(factor)
+            self.coarseSource = np_copy(self.coarseImage)
+            self.coarseBlurred = ndi.gaussian_filter(self.coarseImage, 8./factor)
+            return
+
+        bounds = self.dirtyBounds[0]
+        if bounds is None:
+            return
+        # the cells holding the changed pixels
+        last_cell = self.coarseImage.shape[0] - 1
+        cell_bounds = [int(max(bounds[0]-1, 0)/factor),
+                       min(int((bounds[1]+1)/factor), last_cell),
+                       int(max(bounds[2]-1, 0)/factor),
+                       min(int((bounds[3]+1)/factor), last_cell)]
+        self.coarseImage[cell_bounds[0]:cell_bounds[1]+1,cell_bounds[2]:cell_bounds[3]+1] = \
+            self.poolMap(factor, cell_bounds[0], cell_bounds[1]+1, cell_bounds[2], cell_bounds[3]+1)
+        self.blurWindow(self.coarseImage, self.coarseSource, self.coarseBlurred, cell_bounds, 8./factor)
+
+    def poolMap(self, factor, xLower=0, xUpper=None, yLower=0, yUpper=None):
+        """Sum the top view image map over factor x factor cells
+
+        Optionally only the cells in [xLower, xUpper) x [yLower, yUpper).
+        Cells hanging off the edge of the map are padded with zeros
+        """
+        num_cells = int((self.PM.scaleFactor + factor - 1)/factor)
+        if xUpper is None:
+            xUpper = num_cells
+        if yUpper is None:
+            yUpper = num_cells
+        block = np_zeros(((xUpper-xLower)*factor, (yUpper-yLower)*factor))
+        src = self.imageMaps[0, xLower*factor:xUpper*factor, yLower*factor:yUpper*factor]
+        block[:src.shape[0],:src.shape[1]] = src
+        block = np_reshape(block, (xUpper-xLower, factor, yUpper-yLower, factor))
+        return np_sum(np_sum(block, axis=3), axis=1)
+
+    def heatWindow(self, factor, xLower, xUpper, yLower, yUpper):
+        """The blurred top view at a pyramid level over a window of cells
+
+        Only the window plus the blur margin is pooled and blurred. At
+        factor 1 this is the same as the full resolution blurred map
+        """
+        sigma = 8./factor
+        margin = int(4*sigma+0.5)
+        num_cells = int((self.PM.scaleFactor + factor - 1)/factor)
+        x_lower = max(xLower-margin, 0)
+        x_upper = min(xUpper+margin, num_cells)
+        y_lower = max(yLower-margin, 0)
+        y_upper = min(yUpper+margin, num_cells)
+        heat = ndi.gaussian_filter(self.poolMap(factor, x_lower, x_upper, y_lower, y_upper), sigma)
+        return heat[xLower-x_lower:xUpper-x_lower,yLower-y_lower:yUpper-y_lower]
+
+    def refinePeak(self, cx, cy):
+        """Follow a hot cell on the coarsest level of the pyramid down to a hot pixel
+
+        At each finer level only the cells under the hot cell and its
+        neighbours are blurred and searched. The blur differs a little
+        between levels so the peak may move into a neighbouring cell
+        """
+        factor = self.pyramidLevels[0]
+        for next_factor in self.pyramidLevels[1:]:
+            num_cells = int((self.PM.scaleFactor + next_factor - 1)/next_factor)
+            x_lower = max(int((cx-1)*factor/next_factor), 0)
+            x_upper = min(int(((cx+2)*factor - 1)/next_factor) + 1, num_cells)
+            y_lower = max(int((cy-1)*factor/next_factor), 0)
+            y_upper = min(int(((cy+2)*factor - 1)/next_factor) + 1, num_cells)
+            window = self.heatWindow(next_factor, x_lower, x_upper, y_lower, y_upper)
+            (wx, wy) = np_unravel_index(np_argmax(window), window.shape)
+            (cx, cy, factor) = (x_lower + wx, y_lower + wy, next_factor)
+        return [int(cx), int(cy)]
 
     def makeCoordRanges(self, pos, span):
         """Make search ranges which won't go out of bounds"""
@@ -1145,32 +1572,27 @@ class ClusterEngine:
 
         (x_lower, x_upper) = self.makeCoordRanges(px, self.span)
         (y_lower, y_upper) = self.makeCoordRanges(py, self.span)
-        for z in range(z_lower, z_upper):
-            realz = self.PM.scaleFactor - z - 1
-            for x in range(x_lower, x_upper):
-                for y in range(y_lower, y_upper):
-                    if((x,y,realz) in self.im2RowIndices):
-                        for row_index in self.im2RowIndices[(x,y,realz)]:
-                            if row_index not in self.PM.binnedRowIndices and row_index not in self.PM.restrictedRowIndices:
-                                num_points += 1
-                                disp_vals = np_append(disp_vals, self.PM.transformedCP[row_index])
-                                disp_cols = np_append(disp_cols, self.PM.colorMapGC(self.PM.contigGCs[row_index]))
+        # z runs backwards in the pixel index
+        (region_rows, region_points) = self.pixelIndex.query(x_lower, x_upper, y_lower, y_upper,
+                                                             self.PM.scaleFactor - z_upper, self.PM.scaleFactor - z_lower)
+        for row_index in region_rows:
+            if row_index not in self.PM.binnedRowIndices and row_index not in self.PM.restrictedRowIndices:
+                num_points += 1
+                disp_vals = np_append(disp_vals, self.PM.transformedCP[row_index])
+                disp_cols = np_append(disp_cols, self.PM.colorMapGC(self.PM.contigGCs[row_index]))
 
         # make a black mark at the max values
         small_span = self.span/2
         (x_lower, x_upper) = self.makeCoordRanges(px, small_span)
         (y_lower, y_upper) = self.makeCoordRanges(py, small_span)
         (z_lower, z_upper) = self.makeCoordRanges(pz, small_span)
-        for z in range(z_lower, z_upper):
-            realz = self.PM.scaleFactor - z - 1
-            for x in range(x_lower, x_upper):
-                for y in range(y_lower, y_upper):
-                    if((x,y,realz) in self.im2RowIndices):
-                        for row_index in self.im2RowIndices[(x,y,realz)]:
-                            if row_index not in self.PM.binnedRowIndices and row_index not in self.PM.restrictedRowIndices:
-                                num_points += 1
-                                disp_vals = np_append(disp_vals, self.PM.transformedCP[row_index])
-                                disp_cols = np_append(disp_cols, htr(0,0,0))
+        (region_rows, region_points) = self.pixelIndex.query(x_lower, x_upper, y_lower, y_upper,
+                                                             self.PM.scaleFactor - z_upper, self.PM.scaleFactor - z_lower)
+        for row_index in region_rows:
+            if row_index not in self.PM.binnedRowIndices and row_index not in self.PM.restrictedRowIndices:
+                num_points += 1
+                disp_vals = np_append(disp_vals, self.PM.transformedCP[row_index])
+                disp_cols = np_append(disp_cols, htr(0,0,0))
         # reshape
         disp_vals = np_reshape(disp_vals, (num_points, 3))
         disp_cols = np_reshape(disp_cols, (num_points, 3))
@@ -1247,9 +1669,94 @@ class ClusterEngine:
 ###############################################################################
 ###############################################################################
 
+class NeighbourEngine:
+    """City block neighbourhood queries over a set of points
+
+    Backed by a kd-tree so we never hold the full n x n distance matrix,
+    memory is O(n.k) for the radius and O(neighbours) for each query
+    """
+    def __init__(self, points):
+        self.points = points
+        self.tree = cKDTree(points)
+
+    def kthNeighbourRadius(self, k):
+        """Median distance from each point to its k-th nearest neighbour
+
+        Each point counts as its own 0th neighbour
+        """
+        (dists, _) = self.tree.query(self.points, k=k+1, p=1)
+        return np_median(dists[:,k])
+
+    def neighbourPairs(self, radius):
+        """Every (point, neighbour) pair within radius, as two index arrays
+
+        Self matches are left out
+        """
+        hits = self.tree.query_ball_point(self.points, radius, p=1)
+        counts = np_array([len(h) for h in hits], dtype=int)
+        cols = np_concatenate(hits).astype(int)
+        rows = np_repeat(np_arange(len(hits)), counts)
+        keep = rows != cols
+        return (rows[keep], cols[keep])
+
+    def pairDistances(self, rows, cols):
+        """City block distances between points rows[i] and cols[i]"""
+        return np_sum(np_abs(self.points[cols] - self.points[rows]), axis=1)
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+class PixelIndex:
+    """Find the rows which fall in a window of the transformed space
+
+    Rows are sorted by (x, y) pixel id, then z, then row index. offsets is
+    a CSR style array over the whole x, y grid: the rows in pixel id are
+    rows[offsets[id]:offsets[id+1]]. For any x, a run of y values is one
+    contiguous slice so a query only ever touches the window it asks for
+    """
+    def __init__(self, points, rowIndices, scaleFactor):
+        """points are the (integer) pixels of rowIndices"""
+        self.scaleFactor = scaleFactor
+        pixel_ids = points[:,0]*scaleFactor + points[:,1]
+        order = np_lexsort((rowIndices, points[:,2], pixel_ids))
+        self.rows = rowIndices[order]
+        self.points = points[order]
+        self.offsets = np_zeros(scaleFactor*scaleFactor+1, dtype=int)
+        self.offsets[1:] = np_cumsum(np_bincount(pixel_ids, minlength=scaleFactor*scaleFactor))
+
+    def query(self, xLower, xUpper, yLower, yUpper, zLower=None, zUpper=None):
+        """Rows (and their pixels) with xLower <= x < xUpper etc.
+
+        Leave out the z limits to get the whole column
+        """
+        sf = self.scaleFactor
+        xLower = max(int(xLower), 0)
+        xUpper = min(int(xUpper), sf)
+        yLower = max(int(yLower), 0)
+        yUpper = min(int(yUpper), sf)
+        if xLower >= xUpper or yLower >= yUpper:
+            return (np_array([], dtype=int), np_zeros((0,3), dtype=int))
+
+        row_starts = np_arange(xLower, xUpper)*sf
+        starts = self.offsets[row_starts + yLower]
+        ends = self.offsets[row_starts + yUpper]
+        hits = np_concatenate([np_arange(start, end) for (start, end) in zip(starts, ends)])
+        if zLower is not None:
+            z = self.points[hits,2]
+            hits = hits[(z >= zLower) & (z < zUpper)]
+        return (self.rows[hits], self.points[hits])
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
 class HoughPartitioner:
     def __init__(self):
         self.hc = 0
+        self.maxPoints = 5000   # the accumulator is maxPoints^2, bigger inputs are sampled
 
     def houghPartition(self,
                        dAta,            # data to cluster with
@@ -1266,147 +1773,108 @@ class HoughPartitioner:
         if d_len_raw < 3:
             return np_array([[0,1]])
 
+        # work from a sample if the accumulator would be too big
+        if d_len_raw > self.maxPoints:
+            return self.partitionFromSample(dAta,
+                                            lData,
+                                            self.maxPoints,
+                                            imgTag=imgTag,
+                                            gData=gData,
+                                            gCut=gCut)
+
         #----------------------------------------------------------------------
         # prep the data
         #
+        dAta = np_array(dAta)
         sorted_indices_raw = np_argsort(dAta)
+        sorted_data = dAta[sorted_indices_raw]
         nUm_points = len(dAta)
 
         # fudge the data to make longer contigs have more say in the
         # diff line we'll be making. This way we may be able to avoid lumping
         # super long contigs in with the short riff raff by accident.
-        scales_per = {}
-        spread_data = []
-        spread2real = {}
-        j = 0
-
         # all points get at least one point, but long ones get more
-        # let's say 1 point per 5000bp
-        for i in range(len(dAta)):
-            real_index = sorted_indices_raw[i]
-            rep = int((lData[real_index] - 1.)/5000.) + 1
-            scales_per[real_index] = rep
-            if rep == 1:
-                spread_data.append(dAta[real_index])
-                spread2real[j] = real_index
-                j += 1
-            else:
-                # rep >= 2
-                if i == 0:
-                    left_stop = dAta[real_index]
-                else:
-                    left_stop = (dAta[real_index] + dAta[sorted_indices_raw[i-1]])/2.
-
-                if i == nUm_points-1:
-                    right_stop = dAta[real_index]
-                else:
-                    right_stop = (dAta[real_index] + dAta[sorted_indices_raw[i+1]])/2.
-
-                spread_jump = (right_stop - left_stop) / (rep + 1.)
-
-
-                for ii in range(rep):
-                    spread_data.append(left_stop + ((ii + 1) * spread_jump))
-                    spread2real[j] = real_index
-                    j += 1
+        # let's say 1 point per 5000bp, spread evenly between the midpoints
+        # to their neighbours
+        reps = ((np_array(lData)[sorted_indices_raw] - 1.)/5000.).astype(int) + 1
+        mid_points = (sorted_data[1:] + sorted_data[:-1])/2.
+        left_stops = np_concatenate([sorted_data[:1], mid_points])
+        right_stops = np_concatenate([mid_points, sorted_data[-1:]])
+        spread_jumps = (right_stops - left_stops) / (reps + 1.)
+        run_starts = np_cumsum(reps) - reps
+        run_offsets = np_arange(np_sum(reps)) - np_repeat(run_starts, reps) + 1
+        data = np_where(np_repeat(reps, reps) == 1,
+                        np_repeat(sorted_data, reps),
+                        np_repeat(left_stops, reps) + run_offsets * np_repeat(spread_jumps, reps))
 
         # Force the data to fill the space
-        data = np_array(spread_data)
         data -= np_min(data)    # shift to 0 but DO NOT scale to 1
         d_len = len(data)
-        scale = np_max(dAta) - np_min(dAta)
 
         # we want to know how much each value differs from it's neighbours
-        back_diffs = [float(data[i] - data[i-1]) for i in range(1,d_len)]
-        diffs = [back_diffs[0]]
-        for i in range(len(back_diffs)-1):
-            diffs.append((back_diffs[i] + back_diffs[i+1])/2)
-        diffs.append(back_diffs[-1])
-        diffs = np_array(diffs)**2  # square it! Makes things more betterrer
-
-        # replace the data array by the sum of it's diffs
-        for i in range(1, d_len):
-            diffs[i] += diffs[i-1]
-
-        # scale to fit between 0 and len(diffs)
-        # HT works better on a square
-        diffs -= np_min(diffs)
-        try:
-            diffs /= np_max(diffs)
-        except FloatingPointError:
-            pass
+        # and replace the data array by the sum of it's diffs
+        diffs = self.cumulativeDiffs(data)
         ###MMM FIX
         #diffs *= len(diffs)
         diffs *= (len(diffs)-1)
 
-        # make it 2D
-        t_data = np_array(zip(diffs, np_arange(d_len)))
+        # the spread points are only needed to shape the diff line. Each
+        # contig is voted once from the middle of its run, weighted by the
+        # number of points it was spread over, and everything is scaled
+        # back so the image is sized by the number of contigs
+        scale = float(nUm_points - 1) / (d_len - 1)
+        t_data = np_array([np_add.reduceat(diffs, run_starts) / reps,
+                           run_starts + (reps - 1) / 2.]).T * scale
         ###MMM FIX
         #im_shape = (int(np_max(t_data, axis=0)[0]+1), d_len)
-        im_shape = (d_len, d_len)
+        im_shape = (nUm_points, nUm_points)
 
         #----------------------------------------------------------------------
         # Apply hough transformation and find the most prominent line
         #
         # rets should be an array of arrays of real indices
         # IE. indices into the array dAta
-        rets = self.recursiveSelect(t_data,
-                                    im_shape,
-                                    spread2real,
-                                    0,
-                                    d_len,
-                                    {},
-                                    imgTag=imgTag)
+        try:
+            rets = self.recursiveSelect(t_data,
+                                        reps,
+                                        im_shape,
+                                        sorted_indices_raw,
+                                        0,
+                                        nUm_points,
+                                        {},
+                                        imgTag=imgTag)
+        except MemoryError:
+            if d_len_raw <= 3:
+                raise
+            print("\n    Not enough memory to partition %d points, working from a sample" % d_len_raw)
+            return self.partitionFromSample(dAta,
+                                            lData,
+                                            int(d_len_raw/2),
+                                            imgTag=imgTag,
+                                            gData=gData,
+                                            gCut=gCut)
 
         #----------------------------------------------------------------------
         # Squish things up
         #
-        # build a flat data set similar to the gradiated data set
-        real2spread = {}
-        j = 0
-        flat_data = []
         if len(rets) > 1:
-            for i in range(len(dAta)):
-                real_index = sorted_indices_raw[i]
-                rep = scales_per[real_index]
-                for k in range(rep):
-                    flat_data.append(dAta[real_index])
-                    try:
-                        real2spread[real_index].append(j)
-                    except KeyError:
-                        real2spread[real_index] = [j]
-                    j += 1
-            data -= np_min(flat_data)
-            back_diffs = [float(data[i] - data[i-1]) for i in range(1,d_len)]
-            diffs = [back_diffs[0]]
-            for i in range(len(back_diffs)-1):
-                diffs.append((back_diffs[i] + back_diffs[i+1])/2)
-            diffs.append(back_diffs[-1])
-            diffs = np_array(diffs)**2
-            for i in range(1, d_len):
-                diffs[i] += diffs[i-1]
-            diffs -= np_min(diffs)
-            try:
-                diffs /= np_max(diffs)
-            except FloatingPointError:
-                pass
+            # build a flat data set similar to the gradiated data set
+            data -= np_min(dAta)
+            diffs = self.cumulativeDiffs(data)
             diffs *= len(diffs)
 
             # diffs is now the same size as the gradiated data sent through
             # to hough in level 0. We wish to find the gradients of the lines
             # returned by recursive partitioning
+            spread2real = np_repeat(sorted_indices_raw, reps)
             gradients = []
             for ret in rets:
-                sis = []
-                for ii in ret:
-                    for si in real2spread[ii]:
-                        sis.append(diffs[si])
+                sis = diffs[np_in1d(spread2real, ret)]
                 l_sis = len(sis)
                 if l_sis == 1:
                     gradients.append(-1)
                 else:
-                    sis = sorted(sis)
-                    gradients.append((sis[-1] - sis[0])/l_sis)
+                    gradients.append((np_max(sis) - np_min(sis))/l_sis)
 
             gradients = np_array(gradients)
 
@@ -1487,19 +1955,77 @@ class HoughPartitioner:
 
         return (np_array(squished_rets), np_array(squished_keeps))
 
+    def cumulativeDiffs(self, data):
+        """Running sum of the squared (smoothed) gaps between sorted values
+
+        Scaled to fit between 0 and 1
+        """
+        back_diffs = data[1:] - data[:-1]
+        diffs = np_concatenate([back_diffs[:1],
+                                (back_diffs[:-1] + back_diffs[1:])/2,
+                                back_diffs[-1:]])**2  # square it! Makes things more betterrer
+        diffs = np_cumsum(diffs)
+
+        # HT works better on a square
+        diffs -= np_min(diffs)
+        try:
+            diffs /= np_max(diffs)
+        except FloatingPointError:
+            pass
+        return diffs
+
+    def partitionFromSample(self, dAta, lData, sampleSize, imgTag=None, gData=None, gCut=0):
+        """Partition an evenly spaced sample of the data
+
+        Every other point joins the partition of the nearest sampled value
+        """
+        dAta = np_array(dAta)
+        sorted_indices = np_argsort(dAta)
+        sample_size = np_max([3, np_min([sampleSize, len(dAta)-1])])
+        sample = sorted_indices[np_unique(np_around(np_linspace(0, len(dAta)-1, sample_size)).astype(int))]
+        if gData is not None:
+            gData = np_array(gData)[sample]
+        (s_rets, s_keeps) = self.houghPartition(dAta[sample],
+                                                np_array(lData)[sample],
+                                                imgTag=imgTag,
+                                                gData=gData,
+                                                gCut=gCut)
+
+        # s_rets index into the sample
+        s_part_ids = np_zeros(len(sample), dtype=int)
+        for (part_id, part) in enumerate(s_rets):
+            s_part_ids[part] = part_id
+
+        # the sample is in sorted order so nearest is one side or the other
+        s_vals = dAta[sample]
+        right = np_clip(np_searchsorted(s_vals, dAta), 1, len(s_vals)-1)
+        left = right - 1
+        nearest = np_where(dAta - s_vals[left] <= s_vals[right] - dAta, left, right)
+        part_ids = s_part_ids[nearest]
+        part_ids[sample] = s_part_ids
+
+        rets = [np_nonzero(part_ids == part_id)[0] for part_id in range(len(s_rets))]
+        return (np_array(rets), s_keeps)
+
     def recursiveSelect(self,
                         tData,
+                        weights,
                         imShape,
-                        spread2real,
+                        point2real,
                         startRange,
                         endRange,
                         assigned,
                         level=0,
                         side="C",
                         imgTag=None):
-        """Recursively select clusters from the data"""
-        d_len = len(tData)
-        (m, ret_point, accumulator) = self.houghTransform(tData.astype(float)[startRange:endRange,:], imShape)
+        """Recursively select clusters from the data
+
+        Points in tData are voted weights times each, point2real maps them
+        back onto the real indices
+        """
+        (m, ret_point, accumulator) = self.houghTransform(tData.astype(float)[startRange:endRange,:],
+                                                          imShape,
+                                                          weights=weights[startRange:endRange])
 
         if m == np_inf:
             # this is a vertical line through ret_point
@@ -1524,17 +2050,15 @@ class HoughPartitioner:
                 end_p = [imShape[0], imShape[0]/m + x_int]
 
         # draw a nice thick line over the top of the data
-        # found_line is a set of points
+        # found_line is the sorted flat ids of its pixels
         found_line = self.points2Line(np_array([start_p,end_p]), imShape[1], imShape[0], 5)
 
         # make an image if we're that way inclined
         if imgTag is not None:
             # make a pretty picture
             fff = np_ones(imShape) * 255
-            for p in found_line.keys():
-                fff[p[0],p[1]] = 220
-            for p in tData:
-                fff[p[0],p[1]] = 0
+            fff.flat[found_line] = 220
+            fff[tData[:,0].astype(int), tData[:,1].astype(int)] = 0
 
             # scale so colors look sharper
             accumulator -= np_min(accumulator)
@@ -1546,29 +2070,20 @@ class HoughPartitioner:
         # see which points lie on the line
         # we need to protect against the data line crossing
         # in and out of the "found line"
-        in_block = False
-        block_starts = []
-        block_lens = []
-        for ii in np_arange(startRange, endRange):
-            p = tData.astype('int')[ii]
-            if tuple(p) in found_line:
-                if not in_block:
-                    in_block = True
-                    block_starts.append(ii)
-            else:
-                if in_block:
-                    in_block = False
-                    block_lens.append(ii - block_starts[-1])
+        points = tData[startRange:endRange].astype('int')
+        in_image = (points[:,0] >= 0) & (points[:,0] < imShape[0]) & (points[:,1] >= 0) & (points[:,1] < imShape[1])
+        on_line = np_in1d(points[:,0]*imShape[1] + points[:,1], found_line) & in_image
 
-        if in_block:
-            # finishing block
-            block_lens.append(endRange - block_starts[-1])
+        # find the runs of points on the line
+        edges = np_diff(np_concatenate([[0], on_line.astype(int), [0]]))
+        block_starts = np_nonzero(edges == 1)[0] + startRange
+        block_lens = np_nonzero(edges == -1)[0] + startRange - block_starts
 
         # check to see the line hit something
         if len(block_lens) == 0:
             tmp = {}
             for ii in np_arange(startRange, endRange):
-                real_index = spread2real[ii]
+                real_index = point2real[ii]
                 if real_index not in assigned:
                     tmp[real_index] = None
                     assigned[real_index] = None
@@ -1578,8 +2093,9 @@ class HoughPartitioner:
             # nuffin
             return np_array([])
 
-        # get the start and end indices in the longest block found
-        longest_block = np_argmax(block_lens)
+        # get the start and end indices in the (by weight) longest block found
+        cum_weights = np_concatenate([[0], np_cumsum(weights)])
+        longest_block = np_argmax(cum_weights[block_starts + block_lens] - cum_weights[block_starts])
         spread_start = block_starts[longest_block]
         spread_end =  block_lens[longest_block] + spread_start  # 1 after the end of the block
 
@@ -1588,7 +2104,7 @@ class HoughPartitioner:
         # "real" indices.
         tmp = {}
         for ii in np_arange(spread_start, spread_end):
-            real_index = spread2real[ii]
+            real_index = point2real[ii]
             if real_index not in assigned:
                 tmp[real_index] = None
                 assigned[real_index] = None
@@ -1598,12 +2114,12 @@ class HoughPartitioner:
 
         # recursive call for leftmost indices
         if (spread_start - startRange) > 0:
-            if (spread_start - startRange) < 3:
+            if (cum_weights[spread_start] - cum_weights[startRange]) < 3:
                 # end of the line for left expansion, give up "real" indices
                 # select all the guys with their centres to the left of the start
                 tmp = {}
                 for ii in np_arange(startRange, spread_start):
-                    real_index = spread2real[ii]
+                    real_index = point2real[ii]
                     if real_index not in assigned:
                         tmp[real_index] = None
                         assigned[real_index] = None
@@ -1614,8 +2130,9 @@ class HoughPartitioner:
             else:
                 # otherwise we keep working with ranges
                 left_p = self.recursiveSelect(tData,
+                                              weights,
                                               imShape,
-                                              spread2real,
+                                              point2real,
                                               startRange,
                                               spread_start,
                                               assigned,
@@ -1632,12 +2149,12 @@ class HoughPartitioner:
 
         # recursive call for rightmost indices
         if (endRange - spread_end) > 0:
-            if (endRange - spread_end) < 3:
+            if (cum_weights[endRange] - cum_weights[spread_end]) < 3:
                 # end of the line for left expansion, give up "real" indices
                 # select all the guys with their centres right of the end
                 tmp = {}
                 for ii in np_arange(spread_end, endRange):
-                    real_index = spread2real[ii]
+                    real_index = point2real[ii]
                     if real_index not in assigned:
                         tmp[real_index] = None
                         assigned[real_index] = None
@@ -1646,8 +2163,9 @@ class HoughPartitioner:
                     rets.append(np_array(tmp.keys()))
             else:
                 right_p = self.recursiveSelect(tData,
+                                               weights,
                                                imShape,
-                                               spread2real,
+                                               point2real,
                                                spread_end,
                                                endRange,
                                                assigned,
@@ -1660,9 +2178,12 @@ class HoughPartitioner:
         return np_array(rets)
 
     def points2Line(self, points, xIndexLim, yIndexLim, thickness):
-        """Draw a thick line between a series of points"""
+        """Draw a thick line between a series of points
 
-        line_points = []
+        Returns the sorted flat ids (y * xIndexLim + x) of the pixels
+        """
+        line_ys = []
+        line_xs = []
         num_points = len(points)
         for i in range(1, num_points):
             # draw a line between this point and the last point
@@ -1671,30 +2192,31 @@ class HoughPartitioner:
             largest_gap = np_max([x_gap, y_gap])
 
             if points[i-1,0] >= points[i,0]:
-                Ys = [int(j) for j in np_around((np_arange(largest_gap)*y_gap/largest_gap) + points[i,0])]
+                Ys = np_around((np_arange(largest_gap)*y_gap/largest_gap) + points[i,0]).astype(int)
             elif points[i,0] > points[i-1,0]:
-                Ys = [int(j) for j in np_around((np_arange(largest_gap)*y_gap/largest_gap) + points[i-1,0])][::-1]
+                Ys = np_around((np_arange(largest_gap)*y_gap/largest_gap) + points[i-1,0]).astype(int)[::-1]
             if points[i-1,1] >= points[i,1]:
-                Xs = [int(j) for j in np_around((np_arange(largest_gap)*x_gap/largest_gap) + points[i,1])]
+                Xs = np_around((np_arange(largest_gap)*x_gap/largest_gap) + points[i,1]).astype(int)
             elif points[i,1] > points[i-1,1]:
-                Xs = [int(j) for j in np_around((np_arange(largest_gap)*x_gap/largest_gap) + points[i-1,1])][::-1]
-
-            for p in zip(Ys, Xs):
-                line_points.append(p)
-
-            # now make the line thicker
-            thick_points = {}
-            for point in line_points:
-                for y in range(np_max([point[0]-thickness, 0]),np_min([point[0]+thickness+1,yIndexLim])):
-                    for x in range(np_max([point[1]-thickness, 0]),np_min([point[1]+thickness+1,xIndexLim])):
-                        thick_points[(y,x)] = 1
-
-        return thick_points
-
-    def houghTransform(self, data, imShape):
+                Xs = np_around((np_arange(largest_gap)*x_gap/largest_gap) + points[i-1,1]).astype(int)[::-1]
+
+            line_ys.append(Ys)
+            line_xs.append(Xs)
+
+        # now make the line thicker, every pixel in the square about
+        # each point on the line which is also in the image
+        offsets = np_arange(-thickness, thickness+1)
+        square_ys = np_reshape(offsets[:,None] * np_ones(len(offsets), dtype=int), -1)
+        square_xs = np_reshape(np_ones(len(offsets), dtype=int)[:,None] * offsets, -1)
+        ys = np_reshape(np_concatenate(line_ys)[:,None] + square_ys, -1)
+        xs = np_reshape(np_concatenate(line_xs)[:,None] + square_xs, -1)
+        in_image = (ys >= 0) & (ys < yIndexLim) & (xs >= 0) & (xs < xIndexLim)
+        return np_unique(ys[in_image]*xIndexLim + xs[in_image])
+
+    def houghTransform(self, data, imShape, weights=None):
         """Calculate Hough transform
 
-        Data is a 2D numpy array"""
+        Data is a 2D numpy array, each point is voted weights times"""
 
         (rows, cols) = imShape
         d_len = len(data)
@@ -1722,54 +2244,23 @@ class HoughPartitioner:
                 iry = half_rows + int(r/dr)
                 accumulator[iry, theta_index] -= 1
         """
-        cos_sin_array = np_array(zip([np_sin(dth * theta_index) for theta_index in range(cols)],
-                                     [np_cos(dth * theta_index) for theta_index in range(cols)]))
-        Rs = np_array(np_sum(np_reshape([p * cos_sin_array for p in data], (d_len*cols,2)),
-                             axis=1)/dr).astype('int') + half_rows
-        Cs = np_reshape([range(cols)]*d_len, d_len*cols)
-
-        try:
-            flat_indices = Rs * cols + Cs
-        except ValueError:
-            print("\n")
-            print('*******************************************************************************')
-            print('*********************************    ERROR    *********************************')
-            print('*******************************************************************************')
-            print('GroopM is attempting to do some maths on a putative bin which contains')
-            print('too many contigs.')
-            print()
-            print('This has resulted in a buffer overflow in the numpy library... oops.')
-            print('The most likely cause is that your samples are very different from each other.')
-            print('You can confirm this by running:')
-            print()
-            print('\t\tgroopm explore -c 0 -m allcontigs <dbfilename>')
-            print()
-            print('If you notice only vertical "spears" of contigs at the corners of the plot then')
-            print('this means that your samples are very different and you are not getting a good')
-            print('mapping from all samples to all contigs. You may get more mileage by assembling')
-            print('and binning your samples separately.')
-            print()
-            print('If you notice "clouds" of contigs then congratulations! You have found a bug.')
-            print('Please let me know at "%s or via github.com/ecogenomics/GroopM' % __email__)
-            print()
-            print('GroopM is aborting... sorry')
-            print()
-            print('*******************************************************************************')
-            print("\n")
-            exit(-1)
-
-        # update the accumulator with integer decrements
-        # work around numpy bincount bug
-        flat_indices = flat_indices.astype('int')
-        last_index=0
-        while last_index < len(flat_indices):
-            decrements = np_bincount(flat_indices[last_index:last_index+pow(2,31)-1])
-            last_index+=pow(2,31)-1
-
-            index = 0
-            for d in decrements:
-                accumulator[index] -= d
-                index += 1
+        # work through the data a chunk of rows at a time so we never
+        # hold more than ~4M (rho, theta) pairs
+        sins = np_sin(dth * np_arange(cols))
+        coss = np_cos(dth * np_arange(cols))
+        Cs = np_arange(cols)
+        chunk_len = np_max([1, int(pow(2,22)/cols)])
+        for start in range(0, d_len, chunk_len):
+            chunk = data[start:start+chunk_len]
+            Rs = ((chunk[:,0:1] * sins + chunk[:,1:2] * coss)/dr).astype('int') + half_rows
+            flat_indices = np_reshape(Rs * cols + Cs, -1)
+            # update the accumulator with (weighted) decrements
+            if weights is None:
+                accumulator -= np_bincount(flat_indices, minlength=rows*cols)
+            else:
+                accumulator -= np_bincount(flat_indices,
+                                           weights=np_repeat(weights[start:start+chunk_len], cols),
+                                           minlength=rows*cols)
 
         minindex = accumulator.argmin()
 
@@ -1781,17 +2272,13 @@ class HoughPartitioner:
 
         # now de hough!
         # first get a point our found line passes through
-        Ps = []
-        for p in range(len(data)):
-            point = data[p]
-            th = dth * min_col
-            r = point[1]*np_cos(th) + point[0]*np_sin(th)
-            iry = half_rows + int(r/dr)
-            # this point does
-            if iry == min_row:
-                Ps.append(data[p])
+        th = dth * min_col
+        Rs = ((data[:,1]*np_cos(th) + data[:,0]*np_sin(th))/dr).astype('int') + half_rows
         # take the average of all of em'
-        ret_point = np_mean(Ps, axis=0)
+        if weights is None:
+            ret_point = np_mean(data[Rs == min_row], axis=0)
+        else:
+            ret_point = np_average(data[Rs == min_row], axis=0, weights=weights[Rs == min_row])
 
         # get the gradient
         if theta != 0:
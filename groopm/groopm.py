@@ -114,7 +114,9 @@ class GroopMOptionsParser():
                                       options.cutoff,
                                       timer,
                                       force=options.force,
-                                      threads=options.threads)
+                                      threads=options.threads,
+                                      precision=options.precision,
+                                      sortByLength=options.sort_length)
             if not success:
                 print options.dbname,"not updated"
 
@@ -129,13 +131,20 @@ class GroopMOptionsParser():
                                        finalPlot=options.plot,
                                        plot=options.multiplot,
                                        minSize=options.size,
-                                       minVol=options.bp)
+                                       minVol=options.bp,
+                                       memmapDir=options.scratch,
+                                       samples=options.samples,
+                                       peaksPerRound=options.peaks,
+                                       threads=options.threads,
+                                       pyramidLevels=options.pyramid,
+                                       checkpointInterval=options.checkpoint*60)
             if options.graphfile is None:
                 gf = ""
             else:
                 gf=options.graphfile
             CE.makeCores(coreCut=options.cutoff,
-                         gf=gf)
+                         gf=gf,
+                         resume=options.resume)
 
         elif(options.subparser_name == 'refine'):
             # refine bin cores
@@ -152,7 +161,9 @@ class GroopMOptionsParser():
                                      dbFileName=options.dbname,
                                      transform=transform,
                                      bids=bids,
-                                     loadContigNames=True)
+                                     loadContigNames=True,
+                                     memmapDir=options.scratch,
+                                     samples=options.samples)
 
             if options.plot:
                 pfx="REFINED"
@@ -174,7 +185,9 @@ class GroopMOptionsParser():
                                      dbFileName=options.dbname,
                                      getUnbinned=True,
                                      loadContigNames=False,
-                                     cutOff=options.cutoff)
+                                     cutOff=options.cutoff,
+                                     memmapDir=options.scratch,
+                                     samples=options.samples)
 
             RE.recruitWrapper(timer,
                               inclusivity=options.inclusivity,
@@ -245,11 +258,28 @@ class GroopMOptionsParser():
             BM.loadBins(timer, makeBins=True, silent=True)#, bids=options.bids)
             BM.deleteBins(options.bids, force=options.force, saveBins=True, freeBinnedRowIndices=True)
 
+        elif(options.subparser_name == 'compact'):
+            print "*******************************************************************************"
+            print " [[GroopM %s]] Running in DB compaction mode..." % self.GMVersion
+            print "*******************************************************************************"
+            GMdata = mstore.GMDataManager()
+            GMdata.compactDB(options.dbname,
+                             complevel=options.complevel,
+                             complib=options.complib,
+                             sortByLength=options.sort_length)
+
+        elif(options.subparser_name == 'compare'):
+            print "*******************************************************************************"
+            print " [[GroopM %s]] Running in bin comparison mode..." % self.GMVersion
+            print "*******************************************************************************"
+            BC = groopmUtils.BinComparer(options.dbname, options.otherdb)
+            BC.compare(tolerance=options.tolerance)
+
         elif(options.subparser_name == 'plot'):
             print "*******************************************************************************"
             print " [[GroopM %s]] Running in bin plotting mode..." % self.GMVersion
             print "*******************************************************************************"
-            BM = binManager.BinManager(dbFileName=options.dbname)
+            BM = binManager.BinManager(dbFileName=options.dbname, samples=options.samples)
 
             if options.bids is None:
                 bids = []
@@ -373,12 +403,33 @@ class GroopMOptionsParser():
             else:
                 separator = options.separator
 
+            # contigs to keep, one name per line
+            contig_names = None
+            if options.cids is not None:
+                try:
+                    with open(options.cids, 'r') as fh:
+                        contig_names = [line.rstrip().split()[0] for line in fh if line.strip() != '']
+                except:
+                    print "ERROR: could not read contig names from '%s'" % options.cids
+                    return
+
+            columns = None
+            if options.columns is not None:
+                columns = options.columns.split(',')
+
             DM = GMDataManager()
             DM.dumpData(options.dbname,
                         fields,
                         options.outfile,
                         separator,
-                        not options.no_headers)
+                        not options.no_headers,
+                        bids=options.bids,
+                        minLength=options.min_length,
+                        maxLength=options.max_length,
+                        minGC=options.min_gc,
+                        maxGC=options.max_gc,
+                        contigNames=contig_names,
+                        columns=columns)
 
         return 0
 
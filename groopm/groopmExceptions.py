@@ -63,10 +63,17 @@ class SOMFlavourException(GMSOMException): pass
 class SOMTypeException(GMSOMException): pass
 class RegionsDontExistException(GMSOMException): pass
 
+#------------------------------------------------------------------------------
+# DATA MANAGER
+class GMDataException(BaseException): pass
+class UnknownPrecisionException(GMDataException): pass
+class UnknownSampleException(GMDataException): pass
+
 #------------------------------------------------------------------------------
 # ARG PARSER
 class GMARGException(BaseException): pass
 class ExtractModeNotAppropriateException(GMARGException): pass
+class InvalidPyramidLevelException(GMARGException): pass
 
 ###############################################################################
 ###############################################################################
@@ -95,6 +95,8 @@ class GMExtractor:
         # make the dir if need be
         makeSurePathExists(self.outDir)
 
+        self.nameIndex = None       # DB contig name index, loaded on first use
+
     def extractContigs(self,
                        timer,
                        fasta=[],
@@ -129,7 +131,7 @@ class GMExtractor:
                     print "Error when guessing contig file mimetype"
                     raise
                 with GM_open(file_name, "r") as f:
-                    contigs = CP.getWantedSeqs(f, self.PM.contigNames, storage=contigs)
+                    contigs = self.getLoadedSeqs(CP, f, storage=contigs)
         except:
             print "Could not parse contig file:",fasta[0],sys.exc_info()[0]
             raise
@@ -153,6 +155,30 @@ class GMExtractor:
                 print "Could not open file for writing:",file_name,sys.exc_info()[0]
                 raise
 
+    def getLoadedSeqs(self, contigParser, fp, storage={}, blockSize=10000):
+        """Read a fasta file and keep the sequences of the loaded contigs
+
+        Headers are looked up in blocks using the name index in the DB
+        """
+        block = []
+        for cid,seq in contigParser.readFasta(fp):
+            block.append((cid, seq))
+            if len(block) == blockSize:
+                self.storeLoadedSeqs(block, storage)
+                block = []
+        self.storeLoadedSeqs(block, storage)
+        return storage
+
+    def storeLoadedSeqs(self, block, storage):
+        """Store the (cid, seq) pairs in block whose contigs are loaded"""
+        if len(block) == 0:
+            return
+        if self.nameIndex is None:
+            self.nameIndex = self.PM.dataManager.getContigNameIndex(self.dbFileName)
+        row_indices = self.PM.getRowIndicesForNames([cid for (cid, seq) in block], nameIndex=self.nameIndex)
+        for i in np.nonzero(row_indices != -1)[0]:
+            storage[block[i][0]] = block[i][1]
+
     def extractReads(self,
                      timer,
                      bams=[],
@@ -1123,25 +1149,27 @@ class LabelParser:
 
         If a contig is omitted from this list then it gets coloured nullCol
         """
-        # first we need to make a map of contig name to rowIndex
-        name_2_row_index = {}
-        for row_index in range(len(PM.indices)):
-            name_2_row_index[PM.contigNames[row_index]] = row_index
-
         # first we parse the file
+        cids = []
+        cols = []
         try:
             with open(labelFileName, "r") as l_fh:
                 for line in l_fh:
                     fields = line.rstrip().split("\t")
-                    cid = fields[0]
-                    try:
-                        self.contig2Cols[name_2_row_index[cid]] = self.rgb(fields[1])
-                    except KeyError:
-                        print "ERROR: contig name %s not recognised" % cid
+                    cids.append(fields[0])
+                    cols.append(self.rgb(fields[1]))
         except:
             print "ERROR: parsing labels file: %s" % labelFileName
             raise
 
+        # then resolve all the names in one go using the DB name index
+        row_indices = PM.getRowIndicesForNames(cids)
+        for i in range(len(cids)):
+            if row_indices[i] == -1:
+                print "ERROR: contig name %s not recognised" % cids[i]
+            else:
+                self.contig2Cols[row_indices[i]] = cols[i]
+
         # now we parse the rest of the contig names and colour the null colour
         for row_index in range(len(PM.indices)):
             if row_index not in self.contig2Cols:
@@ -1215,3 +1243,76 @@ class LabelParser:
 ###############################################################################
 ###############################################################################
 
+class BinComparer:
+    """Compare the bin assignments held in two GroopM DBs
+
+    Used to check that a run made in float32 mode agrees with the
+    float64 run of the same data to within some tolerance
+    """
+    def __init__(self, dbFileName1, dbFileName2):
+        self.dbFileName1 = dbFileName1
+        self.dbFileName2 = dbFileName2
+
+    def loadAssignments(self, dbFileName):
+        """return a dict of contig name -> bin id"""
+        dm = mstore.GMDataManager()
+        names = dm.getContigNames(dbFileName)
+        bids = dm.getBins(dbFileName)
+        return dict(zip(names, bids))
+
+    def compare(self, tolerance=0.99, silent=False):
+        """Work out the fraction of contigs placed consistently in both DBs
+
+        Bins are paired one to one, greedily by the number of contigs they
+        share, so a bin split or merged in one DB only agrees with one of
+        the pieces. A contig agrees if it lands in paired bins (or is
+        unbinned in both). Returns (agreement, passed)
+        """
+        assignments1 = self.loadAssignments(self.dbFileName1)
+        assignments2 = self.loadAssignments(self.dbFileName2)
+
+        # count the overlaps between bins in each DB
+        overlaps = {}
+        num_shared = 0
+        for cid in assignments1:
+            try:
+                key = (assignments1[cid], assignments2[cid])
+            except KeyError:
+                continue
+            num_shared += 1
+            overlaps[key] = overlaps.get(key, 0) + 1
+
+        if num_shared == 0:
+            print "ERROR: no contigs are shared between %s and %s" % (self.dbFileName1, self.dbFileName2)
+            return (0., False)
+
+        # pair the bins, biggest overlaps first, each bin used at most once
+        # unbinned only matches unbinned
+        matches = [overlaps.get((0,0), 0)]
+        used1 = set([0])
+        used2 = set([0])
+        for ((bid1, bid2), count) in sorted(overlaps.items(), key=lambda item: (-item[1], item[0])):
+            if bid1 in used1 or bid2 in used2:
+                continue
+            used1.add(bid1)
+            used2.add(bid2)
+            matches.append(count)
+
+        num_agree = np.sum(matches)
+        agreement = float(num_agree) / float(num_shared)
+        passed = agreement >= tolerance
+
+        if not silent:
+            print "    Compared %d contigs" % num_shared
+            print "    Bin assignment agreement: %0.4f (tolerance: %0.4f)" % (agreement, tolerance)
+            if passed:
+                print "    PASS"
+            else:
+                print "    FAIL"
+
+        return (agreement, passed)
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
@@ -45,13 +45,20 @@ __license__ = "GPL3"
 __maintainer__ = "Michael Imelfort"
 __email__ = "mike@mikeimelfort.com"
 
-__current_GMDB_version__ = 5
+__current_GMDB_version__ = 7
 
 ###############################################################################
 
 from sys import exc_info
-from os.path import splitext as op_splitext, basename as op_basename
+from os import rename as os_rename, remove as os_remove
+from os.path import splitext as op_splitext, basename as op_basename, getsize as op_getsize
 from string import maketrans as s_maketrans
+from hashlib import md5
+from contextlib import contextmanager
+from threading import RLock, Condition, Thread, current_thread
+from atexit import register as atexit_register
+import fcntl
+import re
 
 import tables
 import numpy as np
@@ -59,6 +66,7 @@ from scipy.spatial.distance import cdist, squareform
 
 # GroopM imports
 from PCA import PCA, Center
+import groopmExceptions as ge
 
 # BamM imports
 try:
@@ -89,6 +97,115 @@ np.seterr(all='raise')
 import warnings
 warnings.filterwarnings('ignore', category=tables.NaturalNameWarning)
 
+# number of rows upgrades work on at once
+UPGRADE_BLOCK_SIZE = 100000
+
+# getRowIndicesForNames reads names in one slice of the name blob unless
+# they are more than this many bytes apart
+NAME_SLICE_GAP = 1048576
+
+# number of rows dumpData writes at once
+DUMP_BLOCK_SIZE = 50000
+
+# common coreCut values, the number of rows at or above each is recorded
+# for DBs stored in length order
+LENGTH_BOUNDARIES = [0, 500, 1000, 1500, 2000, 2500, 3000, 5000, 10000, 20000, 50000]
+
+# Each DB has one writer / many readers. Between processes this is a flock on
+# a <dbFileName>.lock file, threads in this process follow the same rules.
+# DB_THREAD_LOCK only guards DB_LOCK_STATE, it is never held while a DB is in
+# use or while we wait for a flock
+#
+# HDF5 (and PyTables) is not thread safe though, so only one thread in this
+# process may have any DB open at a time. openDB holds DB_HDF5_LOCK for as
+# long as the file is open. It is always taken after the DB lock, never before
+DB_HDF5_LOCK = RLock()
+DB_THREAD_LOCK = RLock()
+DB_LOCK_CHANGED = Condition(DB_THREAD_LOCK)
+DB_LOCK_STATE = {}          # dbFileName -> [lock file handle, writing thread or None, {thread : depth}, acquiring flock?]
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+class DBWriteQueue:
+    """Apply DB writes in order on a single background thread
+
+    Each job is a call fn(*args). Jobs submitted with the same key for the
+    same DB replace (or are merged into) the previous job if that one has
+    not started yet and nothing else was queued behind it, so a burst of
+    saves of the same state only hits the disk once. Everything still
+    queued is written before the interpreter exits
+    """
+    def __init__(self):
+        self.cond = Condition()
+        self.jobs = []              # [dbFileName, key, fn, args]
+        self.busy = False           # is the worker applying a job right now
+        self.worker = None
+        self.error = None           # exc_info of the first job to fail
+        atexit_register(self.flush)
+
+    def submit(self, dbFileName, fn, args=(), key=None, merge=None):
+        """Queue fn(*args)
+
+        merge(oldArgs, newArgs) returns the args of a coalesced job. If
+        it is None then the newer job simply replaces the older one
+        """
+        with self.cond:
+            self.raiseError()
+            if key is not None and len(self.jobs) > 0:
+                last = self.jobs[-1]
+                if last[0] == dbFileName and last[1] == key:
+                    if merge is not None:
+                        args = merge(last[3], args)
+                    self.jobs.pop()
+            self.jobs.append([dbFileName, key, fn, args])
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = Thread(target=self.work, name="groopm-db-writer")
+                self.worker.daemon = True
+                self.worker.start()
+            self.cond.notify_all()
+
+    def work(self):
+        """Worker thread, apply jobs until the queue is empty"""
+        while True:
+            with self.cond:
+                if len(self.jobs) == 0:
+                    self.worker = None
+                    self.cond.notify_all()
+                    return
+                (db_file_name, key, fn, args) = self.jobs.pop(0)
+                self.busy = True
+            try:
+                fn(*args)
+            except:
+                with self.cond:
+                    if self.error is None:
+                        self.error = exc_info()
+                print "Error writing to DB:", db_file_name, exc_info()[0]
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+
+    def flush(self):
+        """Block until every queued write is on disk"""
+        if self.worker is not None and current_thread() is self.worker:
+            return
+        with self.cond:
+            while len(self.jobs) > 0 or self.busy:
+                self.cond.wait(1.)
+            self.raiseError()
+
+    def raiseError(self):
+        """Pass the failure of a background write on to the caller"""
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error[0], error[1], error[2]
+
+# every DB in this process shares the one writer so writes are never reordered
+DB_WRITE_QUEUE = DBWriteQueue()
+
 ###############################################################################
 ###############################################################################
 ###############################################################################
@@ -175,10 +292,18 @@ class GMDataManager:
 
     ** Contigs **
     table = 'contigs'
-    'cid'    : tables.StringCol(512, pos=0)
-    'bid'    : tables.Int32Col(pos=1)
-    'length' : tables.Int32Col(pos=2)
-    'gc'     : tables.FloatCol(pos=3)
+    'bid'    : tables.Int32Col(pos=0)
+    'length' : tables.Int32Col(pos=1)
+    'gc'     : tables.FloatCol(pos=2)
+
+    ** Contig names **
+    earray = 'contigNameBlob'                     # all contig names run together (UInt8)
+    array = 'contigNameOffsets'                   # name i is blob[offsets[i]:offsets[i+1]] (Int64)
+
+    ** Contig name index **
+    table = 'contigNameHash'                      # sorted by hash for fast name -> row lookups
+    'hash'   : tables.UInt64Col(pos=0)            # first 8 bytes of md5(name)
+    'row'    : tables.Int64Col(pos=1)             # row in meta/contigs
 
     ** Bins **
     table = 'bins'
@@ -195,15 +320,129 @@ class GMDataManager:
     """
     def __init__(self): pass
 
+#------------------------------------------------------------------------------
+# DB LOCKING
+
+    @contextmanager
+    def lockDB(self, dbFileName, exclusive=False):
+        """Hold a shared (read) or exclusive (write) lock on the DB
+
+        Locks are re-entrant within a thread so a writer can wrap several
+        calls which each open the DB in one lock, making them atomic as far
+        as any readers are concerned. Likewise a reader can wrap several
+        reads to get a consistent view of the DB. Other threads in this
+        process share or wait for the lock just as other processes do (they
+        still take turns with the file itself, see openDB). New
+        readers don't queue behind a waiting writer, a reader may be waiting
+        on another reader (a prefetch) to finish
+
+        A thread holding a shared lock can not take an exclusive one, take
+        the exclusive lock up front if you need to read then write
+        """
+        this_thread = current_thread()
+        acquire = False
+        with DB_LOCK_CHANGED:
+            state = DB_LOCK_STATE.get(dbFileName)
+            if state is not None and this_thread in state[2]:
+                assert (not exclusive) or state[1] is this_thread, \
+                    "Can not upgrade a shared lock on %s to an exclusive one" % dbFileName
+            else:
+                # wait for other threads in this process to be done with it
+                # or to finish getting the flock
+                while state is not None and (state[3] or state[1] is not None or exclusive):
+                    DB_LOCK_CHANGED.wait()
+                    state = DB_LOCK_STATE.get(dbFileName)
+                if state is None:
+                    # claim it now, the flock is taken below
+                    state = [None, None, {}, True]
+                    DB_LOCK_STATE[dbFileName] = state
+                    acquire = True
+                if exclusive:
+                    state[1] = this_thread
+            state[2][this_thread] = state[2].get(this_thread, 0) + 1
+
+        if acquire:
+            # another process may hold the flock for a while, don't stop
+            # threads working on other DBs while we wait for it
+            lock_fh = None
+            try:
+                try:
+                    lock_fh = open(dbFileName+'.lock', 'a')
+                except IOError:
+                    # read-only location, nobody can write here anyway
+                    pass
+                if lock_fh is not None:
+                    fcntl.flock(lock_fh, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            except:
+                if lock_fh is not None:
+                    lock_fh.close()
+                with DB_LOCK_CHANGED:
+                    del DB_LOCK_STATE[dbFileName]
+                    DB_LOCK_CHANGED.notify_all()
+                raise
+            with DB_LOCK_CHANGED:
+                state[0] = lock_fh
+                state[3] = False
+                DB_LOCK_CHANGED.notify_all()
+
+        try:
+            yield
+        finally:
+            with DB_LOCK_CHANGED:
+                state[2][this_thread] -= 1
+                if state[2][this_thread] == 0:
+                    del state[2][this_thread]
+                    if len(state[2]) == 0:
+                        if state[0] is not None:
+                            fcntl.flock(state[0], fcntl.LOCK_UN)
+                            state[0].close()
+                        del DB_LOCK_STATE[dbFileName]
+                        DB_LOCK_CHANGED.notify_all()
+
+    @contextmanager
+    def openDB(self, dbFileName, mode='r', **kwargs):
+        """Open the DB while holding the appropriate lock
+
+        Use in place of tables.openFile. Readers share the DB, anything
+        which writes gets it to itself. Within this process only one thread
+        has a file open at a time, see DB_HDF5_LOCK
+        """
+        with self.lockDB(dbFileName, exclusive=(mode != 'r')):
+            with DB_HDF5_LOCK:
+                with tables.openFile(dbFileName, mode=mode, **kwargs) as h5file:
+                    yield h5file
+
+    def queueWrite(self, dbFileName, fn, args=(), key=None, merge=None):
+        """Write to the DB in the background
+
+        fn(*args) is called on the writer thread. See DBWriteQueue for
+        how key and merge coalesce repeated writes
+        """
+        DB_WRITE_QUEUE.submit(dbFileName, fn, args=args, key=key, merge=merge)
+
+    def flushWrites(self):
+        """Wait for all background writes to finish"""
+        DB_WRITE_QUEUE.flush()
+
 #------------------------------------------------------------------------------
 # DB CREATION / INITIALISATION  - PROFILES
 
-    def createDB(self, bamFiles, contigs, dbFileName, cutoff, timer, kmerSize=4, force=False, threads=1):
-        """Main wrapper for parsing all input files"""
+    def createDB(self, bamFiles, contigs, dbFileName, cutoff, timer, kmerSize=4, force=False, threads=1, precision='float64', sortByLength=False):
+        """Main wrapper for parsing all input files
+
+        precision sets the storage type of the profile tables. Use 'float32'
+        to halve the size of the DB and the memory used by later stages
+
+        If sortByLength is set the rows are stored longest contig first
+        """
         # load all the passed vars
         dbFileName = dbFileName
         contigsFile = contigs
         stoitColNames = []
+        try:
+            profile_type = {'float64' : np.float64, 'float32' : np.float32}[precision]
+        except KeyError:
+            raise ge.UnknownPrecisionException("Unknown profile precision: %s" % precision)
 
         kse = KmerSigEngine(kmerSize)
         conParser = ContigParser()
@@ -226,7 +465,7 @@ class GMDataManager:
 
         # create the db
         try:
-            with tables.openFile(dbFileName, mode = "w", title = "GroopM") as h5file:
+            with self.openDB(dbFileName, mode = "w", title = "GroopM") as h5file:
                 # Create groups under "/" (root) for storing profile information and metadata
                 profile_group = h5file.createGroup("/", 'profile', 'Assembly profiles')
                 meta_group = h5file.createGroup("/", 'meta', 'Associated metadata')
@@ -305,7 +544,7 @@ class GMDataManager:
                 # store the raw calculated kmer sigs in one table
                 db_desc = []
                 for mer in kse.kmerCols:
-                     db_desc.append((mer, float))
+                     db_desc.append((mer, profile_type))
                 try:
                     h5file.createTable(profile_group,
                                        'kms',
@@ -322,7 +561,7 @@ class GMDataManager:
 
                 db_desc = []
                 for i in xrange(0, len(pc_ksigs[0])):
-                  db_desc.append(('pc' + str(i+1), float))
+                  db_desc.append(('pc' + str(i+1), profile_type))
 
                 try:
                     h5file.createTable(profile_group,
@@ -369,7 +608,7 @@ class GMDataManager:
                 # raw coverages
                 db_desc = []
                 for scn in CT.stoitColNames:
-                    db_desc.append((scn, float))
+                    db_desc.append((scn, profile_type))
 
                 try:
                     h5file.createTable(profile_group,
@@ -382,9 +621,9 @@ class GMDataManager:
                     raise
 
                 # transformed coverages
-                db_desc = [('x', float),
-                           ('y', float),
-                           ('z', float)]
+                db_desc = [('x', profile_type),
+                           ('y', profile_type),
+                           ('z', profile_type)]
                 try:
                     h5file.createTable(profile_group,
                                        'transCoverage',
@@ -410,7 +649,7 @@ class GMDataManager:
                     raise
 
                 # normalised coverages
-                db_desc = [('normCov', float)]
+                db_desc = [('normCov', profile_type)]
                 try:
                     h5file.createTable(profile_group,
                                        'normCoverage',
@@ -498,6 +737,10 @@ class GMDataManager:
             print "Error creating database:", dbFileName, exc_info()[0]
             raise
 
+        if sortByLength:
+            print "Sorting rows by contig length"
+            self.compactDB(dbFileName, sortByLength=True)
+
         print "****************************************************************"
         print "Data loaded successfully!"
         print " ->",num_cons,"contigs"
@@ -548,13 +791,19 @@ class GMDataManager:
         upgrade_tasks[(2,3)] = self.upgradeDB_2_to_3
         upgrade_tasks[(3,4)] = self.upgradeDB_3_to_4
         upgrade_tasks[(4,5)] = self.upgradeDB_4_to_5
+        upgrade_tasks[(5,6)] = self.upgradeDB_5_to_6
+        upgrade_tasks[(6,7)] = self.upgradeDB_6_to_7
 
         # we need to apply upgrades in order!
         # keep applying the upgrades as long as we need to
-        while this_DB_version < __current_GMDB_version__:
-            task = (this_DB_version, this_DB_version+1)
-            upgrade_tasks[task](dbFileName)
-            this_DB_version += 1
+        # lock the DB for the whole lot and check again in case
+        # another process got in first
+        with self.lockDB(dbFileName, exclusive=True):
+            this_DB_version = self.getGMDBFormat(dbFileName)
+            while this_DB_version < __current_GMDB_version__:
+                task = (this_DB_version, this_DB_version+1)
+                upgrade_tasks[task](dbFileName)
+                this_DB_version += 1
 
     def upgradeDB_0_to_1(self, dbFileName):
         """Upgrade a GM db from version 0 to version 1"""
@@ -568,30 +817,25 @@ class GMDataManager:
         print "    Calculating and storing the kmerSig PCAs"
 
         # compute the PCA of the ksigs
-        ksigs = self.getKmerSigs(dbFileName)
-        CP = ContigParser()
-        pc_ksigs, sumvariance = CP.PCAKSigs(ksigs)
-        num_cons = len(pc_ksigs)
-
+        model = self.getKmerSigPCAModel(dbFileName)
         db_desc = [('pc1', float),
                    ('pc2', float)]
+        self.streamTable(dbFileName,
+                         '/profile',
+                         'tmp_kpca',
+                         db_desc,
+                         self.getNumRows(dbFileName, '/profile/kms'),
+                         lambda start, end: projectBlock(model, self.readTableBlock(dbFileName, '/profile/kms', start, end))[:,:2],
+                         'Kmer signature PCAs')
         try:
-            with tables.openFile(dbFileName, mode='a', rootUEP="/profile") as profile_group:
-                try:
-                    profile_group.createTable('/',
-                                              'kpca',
-                                              np.array(pc_ksigs, dtype=db_desc),
-                                              title='Kmer signature PCAs',
-                                              expectedrows=num_cons
-                                              )
-                except:
-                    print "Error creating KMERVALS table:", exc_info()[0]
-                    raise
+            with self.openDB(dbFileName, mode='a', rootUEP="/") as h5file:
+                h5file.renameNode('/profile', 'kpca', 'tmp_kpca', overwrite=True)
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
 
         # update the formatVersion field and we're done
+        self.clearUpgradeState(dbFileName)
         self.setGMDBFormat(dbFileName, 1)
         print "*******************************************************************************"
 
@@ -606,42 +850,37 @@ class GMDataManager:
         # and GC information for each contig
         print "    Calculating and storing the kmer signature PCAs"
 
-        # grab any data needed from database before opening if for modification
-        bin_ids = self.getBins(dbFileName)
-        orig_con_names = self.getContigNames(dbFileName)
-        ksigs = self.getKmerSigs(dbFileName)
-
         # compute the PCA of the ksigs
-        conParser = ContigParser()
-        pc_ksigs, sumvariance = conParser.PCAKSigs(ksigs)
-        num_cons = len(pc_ksigs)
-
+        model = self.getKmerSigPCAModel(dbFileName)
         db_desc = []
-        for i in xrange(0, len(pc_ksigs[0])):
+        for i in xrange(0, len(model['components'])):
           db_desc.append(('pc' + str(i+1), float))
 
-        try:
-            with tables.openFile(dbFileName, mode='a', rootUEP="/") as h5file:
-                pg = h5file.getNode('/', name='profile')
-                try:
-                    try:
-                        h5file.removeNode(pg, 'tmp_kpca')
-                    except:
-                        pass
-
-                    h5file.createTable(pg,
-                                       'tmp_kpca',
-                                       np.array(pc_ksigs, dtype=db_desc),
-                                       title='Kmer signature PCAs',
-                                       expectedrows=num_cons
-                                      )
-
-                    h5file.renameNode(pg, 'kpca', 'tmp_kpca', overwrite=True)
+        # the new PCA table is built in blocks and is not swapped in until it is
+        # complete, so this step can be re-run if it is interrupted
+        if not self.getUpgradeState(dbFileName, 'kpcaDone'):
+            self.streamTable(dbFileName,
+                             '/profile',
+                             'tmp_kpca',
+                             db_desc,
+                             self.getNumRows(dbFileName, '/profile/kms'),
+                             lambda start, end: projectBlock(model, self.readTableBlock(dbFileName, '/profile/kms', start, end)),
+                             'Kmer signature PCAs')
+            try:
+                with self.openDB(dbFileName, mode='a', rootUEP="/") as h5file:
+                    h5file.renameNode('/profile', 'kpca', 'tmp_kpca', overwrite=True)
+            except:
+                print "Error opening DB:",dbFileName, exc_info()[0]
+                raise
+            self.setUpgradeState(dbFileName, 'kpcaDone', True)
 
-                except:
-                    print "Error creating kpca table:", exc_info()[0]
-                    raise
+        # grab any data needed from database before opening if for modification
+        bin_ids = self.getBins(dbFileName)
+        orig_con_names = self.getLegacyContigNames(dbFileName)
+        conParser = ContigParser()
 
+        try:
+            with self.openDB(dbFileName, mode='a', rootUEP="/") as h5file:
                 # Add GC
                 contigFile = raw_input('\nPlease specify fasta file containing the bam reference sequences: ')
                 with open(contigFile, "r") as f:
@@ -661,12 +900,12 @@ class GMDataManager:
                         raise
 
                 # remove any contigs not in the current DB (these were removed due to having zero coverage)
-                good_indices = [i for i in range(len(orig_con_names)) if orig_con_names[i] in con_names]
+                orig_con_names = set(orig_con_names)
+                good_indices = [i for i in range(len(con_names)) if con_names[i] in orig_con_names]
 
                 con_names = con_names[good_indices]
                 con_lengths = con_lengths[good_indices]
                 con_gcs = con_gcs[good_indices]
-                bin_ids = bin_ids[good_indices]
 
                 mg = h5file.getNode('/', name='meta')
                 self.setBinAssignments((h5file, mg),
@@ -679,6 +918,7 @@ class GMDataManager:
             raise
 
         # update the formatVersion field and we're done
+        self.clearUpgradeState(dbFileName)
         self.setGMDBFormat(dbFileName, 2)
         print "*******************************************************************************"
 
@@ -693,9 +933,7 @@ class GMDataManager:
         print "    Calculating and storing variance of kmer signature PCAs"
 
         # compute the PCA of the ksigs
-        conParser = ContigParser()
-        ksigs = self.getKmerSigs(dbFileName)
-        pc_ksigs, sumvariance = conParser.PCAKSigs(ksigs)
+        sumvariance = self.getKmerSigPCAModel(dbFileName)['sumvariance']
 
         # calcualte variance of each PC
         pc_var = [sumvariance[0]]
@@ -708,7 +946,7 @@ class GMDataManager:
           db_desc.append(('pc' + str(i+1) + '_var', float))
 
         try:
-            with tables.openFile(dbFileName, mode='a', rootUEP="/") as h5file:
+            with self.openDB(dbFileName, mode='a', rootUEP="/") as h5file:
                 meta = h5file.getNode('/', name='meta')
                 try:
                     try:
@@ -733,6 +971,7 @@ class GMDataManager:
             raise
 
         # update the formatVersion field and we're done
+        self.clearUpgradeState(dbFileName)
         self.setGMDBFormat(dbFileName, 3)
         print "*******************************************************************************"
 
@@ -749,7 +988,7 @@ class GMDataManager:
 
         # read existing data in 'bins' table
         try:
-            with tables.openFile(dbFileName, mode='r') as h5file:
+            with self.openDB(dbFileName, mode='r') as h5file:
                 ret_dict = {}
                 all_rows = h5file.root.meta.bins.read()
                 for row in all_rows:
@@ -770,7 +1009,7 @@ class GMDataManager:
         bd = np.array(data, dtype=db_desc)
 
         try:
-            with tables.openFile(dbFileName, mode='a', rootUEP="/") as h5file:
+            with self.openDB(dbFileName, mode='a', rootUEP="/") as h5file:
                 mg = h5file.getNode('/', name='meta')
 
                 try:
@@ -808,93 +1047,157 @@ class GMDataManager:
         print "    Saving transformed coverage profiles"
         print "    You will not need to re-run parse or core due to this change"
 
-        # we need to get the raw coverage profiles and the kmerPCA1 data
-        indices = self.getConditionalIndices(dbFileName, silent=False, checkUpgrade=False)
-        kPCA_1 = self.getKmerPCAs(dbFileName, indices=indices)[:,0]
-        raw_coverages = self.getCoverageProfiles(dbFileName, indices=indices)
-        norm_coverages = np.array([np.linalg.norm(raw_coverages[i]) for i in range(len(indices))])
-
-        CT = CoverageTransformer(len(indices),
-                                 self.getNumStoits(dbFileName),
+        # we only ever hold one block of coverage profiles in memory. The per contig
+        # scalars (norms and kmer PC1) are small enough to keep
+        num_cons = self.getNumRows(dbFileName, '/profile/coverage')
+        state = self.getUpgradeState(dbFileName, 'transform')
+        if state is None:
+            norm_coverages = np.zeros(num_cons)
+            kmer_PC1 = np.zeros(num_cons)
+            for start in xrange(0, num_cons, UPGRADE_BLOCK_SIZE):
+                cov_block = self.readTableBlock(dbFileName, '/profile/coverage', start, start+UPGRADE_BLOCK_SIZE)
+                norm_coverages[start:start+len(cov_block)] = np.sqrt(np.sum(cov_block**2, axis=1))
+                kmer_PC1[start:start+len(cov_block)] = self.readTableBlock(dbFileName, '/profile/kpca', start, start+UPGRADE_BLOCK_SIZE)[:,0]
+
+            CT = CoverageTransformer(num_cons,
+                                     self.getNumStoits(dbFileName),
+                                     norm_coverages,
+                                     kmer_PC1,
+                                     None,
+                                     np.array(self.getStoitColNames(dbFileName).split(",")))
+
+            # the BAM ordering only needs a small subset of the coverage profiles
+            sub_cons = CT.getShuffleSubset()
+            if CT.numStoits > 3:
+                ordering = CT.findBAMOrdering(self.getCoverageProfiles(dbFileName, indices=sub_cons),
+                                              norm_coverages[sub_cons])
+            else:
+                ordering = range(CT.numStoits)
+            CT.shuffleBAMs(ordering=ordering)
+            state = {'normCoverages' : norm_coverages,
+                     'stoitOrder' : CT.stoitOrder,
+                     'stoitColNames' : CT.stoitColNames}
+            self.setUpgradeState(dbFileName, 'transform', state)
+
+        norm_coverages = state['normCoverages']
+        stoit_order = state['stoitOrder']
+        CT = CoverageTransformer(num_cons,
+                                 len(stoit_order),
                                  norm_coverages,
-                                 kPCA_1,
-                                 raw_coverages,
-                                 np.array(self.getStoitColNames(dbFileName).split(",")))
-
-        CT.transformCP()
-        CT.transformedCP = [tuple(i) for i in CT.transformedCP]
-        CT.covProfiles = [tuple(i) for i in CT.covProfiles]
-        CT.corners = [tuple(i) for i in CT.corners]
-
-        # now CT stores the transformed coverages and other important information
-        # we will write this to the database
-        with tables.openFile(dbFileName, mode='a', rootUEP="/") as h5file:
-            meta_group = h5file.getNode('/', name='meta')
-            profile_group = h5file.getNode('/', name='profile')
-
-            # raw coverages - we may have reordered rows, so we should fix this now!
+                                 None,
+                                 None,
+                                 state['stoitColNames'])
+
+        # once the new tables are swapped in the old ones are gone, so if we
+        # got that far last time none of this can be run again. The swap and
+        # the flag saying it happened are written together
+        if self.getUpgradeState(dbFileName, 'swapped') is None:
+            # raw coverages - we may have reordered columns, so we should fix this now!
             db_desc = []
             for scn in CT.stoitColNames:
                 db_desc.append((scn, float))
+            self.streamTable(dbFileName,
+                             '/profile',
+                             'tmp_coverages',
+                             db_desc,
+                             num_cons,
+                             lambda start, end: self.readTableBlock(dbFileName, '/profile/coverage', start, end)[:,stoit_order],
+                             'Bam based coverage')
 
-            try:
-                h5file.removeNode(mg, 'tmp_coverages')
-            except:
-                pass
-
-            try:
-                h5file.createTable(profile_group,
-                                   'tmp_coverages',
-                                   np.array(CT.covProfiles, dtype=db_desc),
-                                   title="Bam based coverage",
-                                   expectedrows=CT.numContigs)
-            except:
-                print "Error creating coverage table:", exc_info()[0]
-                raise
-
-            h5file.renameNode(profile_group, 'coverage', 'tmp_coverages', overwrite=True)
-
-            # transformed coverages
-            db_desc = [('x', float),
-                       ('y', float),
-                       ('z', float)]
-            try:
-                h5file.createTable(profile_group,
-                                   'transCoverage',
-                                   np.array(CT.transformedCP , dtype=db_desc),
-                                   title="Transformed coverage",
-                                   expectedrows=CT.numContigs)
-            except:
-                print "Error creating transformed coverage table:", exc_info()[0]
-                raise
-
-            # transformed coverage corners
+            # transformed coverages, first pass works out the raw positions
+            # and the extent of the space
             db_desc = [('x', float),
                        ('y', float),
                        ('z', float)]
-            try:
-                h5file.createTable(meta_group,
-                                   'transCoverageCorners',
-                                   np.array(CT.corners , dtype=db_desc),
-                                   title="Transformed coverage corners",
-                                   expectedrows=CT.numStoits)
-            except:
-                print "Error creating transformed coverage corner table:", exc_info()[0]
-                raise
+            self.streamTable(dbFileName,
+                             '/profile',
+                             'tmp_transCoverage',
+                             db_desc,
+                             num_cons,
+                             lambda start, end: CT.transformBlock(self.readTableBlock(dbFileName, '/profile/tmp_coverages', start, end),
+                                                                  norm_coverages[start:end]),
+                             'Transformed coverage')
+
+            # second pass scales the space in place
+            extent = self.getUpgradeState(dbFileName, 'extent')
+            if extent is None:
+                t_min = None
+                t_max = None
+                for start in xrange(0, num_cons, UPGRADE_BLOCK_SIZE):
+                    t_block = self.readTableBlock(dbFileName, '/profile/tmp_transCoverage', start, start+UPGRADE_BLOCK_SIZE)
+                    if t_min is None:
+                        t_min = np.amin(t_block, axis=0)
+                        t_max = np.amax(t_block, axis=0)
+                    else:
+                        t_min = np.minimum(t_min, np.amin(t_block, axis=0))
+                        t_max = np.maximum(t_max, np.amax(t_block, axis=0))
+                extent = (t_min, (t_max - t_min) / (CT.scaleFactor-1))
+                # both at once, a resumed run needs one as much as the other
+                self.setUpgradeStates(dbFileName, {'extent' : extent, 'rowsScaled' : 0})
+            (t_min, t_scale) = extent
+
+            for start in xrange(self.getUpgradeState(dbFileName, 'rowsScaled'), num_cons, UPGRADE_BLOCK_SIZE):
+                try:
+                    with self.openDB(dbFileName, mode='a', rootUEP="/") as h5file:
+                        t_table = h5file.getNode('/profile/tmp_transCoverage')
+                        t_block = records2Array(t_table.read(start, start+UPGRADE_BLOCK_SIZE))
+                        t_block = (t_block - t_min) / t_scale
+                        t_table.modifyRows(start=start, rows=array2Records(t_block, db_desc))
+                        h5file.root._v_attrs.upgrade_rowsScaled = start + len(t_block)
+                except:
+                    print "Error opening DB:",dbFileName, exc_info()[0]
+                    raise
 
+            CT.makeCorners(t_min, t_scale)
+            CT.corners = [tuple(i) for i in CT.corners]
 
-            # normalised coverages
-            db_desc = [('normCov', float)]
+            # now we will write the rest to the database
             try:
-                h5file.createTable(profile_group,
-                                   'normCoverage',
-                                   np.array(CT.normCoverages , dtype=db_desc),
-                                   title="Normalised coverage",
-                                   expectedrows=CT.numContigs)
+                with self.openDB(dbFileName, mode='a', rootUEP="/") as h5file:
+                    meta_group = h5file.getNode('/', name='meta')
+                    profile_group = h5file.getNode('/', name='profile')
+
+                    h5file.renameNode(profile_group, 'coverage', 'tmp_coverages', overwrite=True)
+                    h5file.renameNode(profile_group, 'transCoverage', 'tmp_transCoverage', overwrite=True)
+                    h5file.root._v_attrs.upgrade_swapped = True
+
+                    # transformed coverage corners
+                    db_desc = [('x', float),
+                               ('y', float),
+                               ('z', float)]
+                    try:
+                        h5file.removeNode(meta_group, 'transCoverageCorners')
+                    except:
+                        pass
+                    try:
+                        h5file.createTable(meta_group,
+                                           'transCoverageCorners',
+                                           np.array(CT.corners , dtype=db_desc),
+                                           title="Transformed coverage corners",
+                                           expectedrows=CT.numStoits)
+                    except:
+                        print "Error creating transformed coverage corner table:", exc_info()[0]
+                        raise
             except:
-                print "Error creating normalised coverage table:", exc_info()[0]
+                print "Error opening DB:",dbFileName, exc_info()[0]
                 raise
 
+        # normalised coverages
+        db_desc = [('normCov', float)]
+        self.streamTable(dbFileName,
+                         '/profile',
+                         'tmp_normCoverage',
+                         db_desc,
+                         num_cons,
+                         lambda start, end: np.reshape(norm_coverages[start:end], (end-start, 1)),
+                         'Normalised coverage')
+        try:
+            with self.openDB(dbFileName, mode='a', rootUEP="/") as h5file:
+                h5file.renameNode('/profile', 'normCoverage', 'tmp_normCoverage', overwrite=True)
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
         # stoit col names may have been shuffled
         meta_data = (",".join([str(i) for i in CT.stoitColNames]),
                     CT.numStoits,
@@ -905,15 +1208,307 @@ class GMDataManager:
                     self.getNumBins(dbFileName),
                     self.isClustered(dbFileName),
                     self.isComplete(dbFileName),
-                    self.getGMDBFormat(dbFileName))
+                    5)
 
-        with tables.openFile(dbFileName, mode='a', rootUEP="/") as h5file:
+        # update the formatVersion field and we're done. Forget the upgrade
+        # state at the same time, without it we would start over on the
+        # already reordered tables
+        with self.openDB(dbFileName, mode='a', rootUEP="/") as h5file:
             self.setMeta(h5file, meta_data, overwrite=True)
+            self.removeUpgradeState(h5file)
+        print "*******************************************************************************"
+
+    def upgradeDB_5_to_6(self, dbFileName):
+        """Upgrade a GM db from version 5 to version 6"""
+        print "*******************************************************************************\n"
+        print "              *** Upgrading GM DB from version 5 to version 6 ***"
+        print ""
+        print "                            please be patient..."
+        print ""
+        # the change in this version is that contig names are moved out of the
+        # contigs table and stored as a blob of characters plus offsets
+        print "    Moving contig names out of the contigs table"
+        print "    You will not need to re-run parse or core due to this change"
+
+        try:
+            with self.openDB(dbFileName, mode='a', rootUEP="/") as h5file:
+                meta_group = h5file.getNode('/', name='meta')
+                # an earlier upgrade step may have already written the new layout
+                if 'cid' in h5file.root.meta.contigs.colnames:
+                    old_contigs = h5file.root.meta.contigs.read()
+                    self.setBinAssignments((h5file, meta_group),
+                                           image=zip(old_contigs['cid'],
+                                                     old_contigs['bid'],
+                                                     old_contigs['length'],
+                                                     old_contigs['gc'])
+                                           )
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
 
         # update the formatVersion field and we're done
-        self.setGMDBFormat(dbFileName, 5)
+        self.setGMDBFormat(dbFileName, 6)
         print "*******************************************************************************"
 
+    def upgradeDB_6_to_7(self, dbFileName):
+        """Upgrade a GM db from version 6 to version 7"""
+        print "*******************************************************************************\n"
+        print "              *** Upgrading GM DB from version 6 to version 7 ***"
+        print ""
+        print "                            please be patient..."
+        print ""
+        # the change in this version is that we'll be saving a hash index of contig names
+        print "    Building contig name index"
+        print "    You will not need to re-run parse or core due to this change"
+
+        contig_names = self.getContigNames(dbFileName)
+        try:
+            with self.openDB(dbFileName, mode='a', rootUEP="/") as h5file:
+                meta_group = h5file.getNode('/', name='meta')
+                self.setContigNameIndex(h5file, meta_group, contig_names)
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+        # update the formatVersion field and we're done
+        self.setGMDBFormat(dbFileName, 7)
+        print "*******************************************************************************"
+
+#------------------------------------------------------------------------------
+# DB UPGRADE - STREAMING HELPERS
+#
+# Upgrades work through tables UPGRADE_BLOCK_SIZE rows at a time so that memory
+# use does not depend on the size of the DB. Anything which must survive an
+# interrupted upgrade (models, partial tables, row counters) is written to the
+# DB as we go, and re-running the upgrade picks up where it left off
+
+    def getUpgradeState(self, dbFileName, key):
+        """Return a value saved by an earlier (possibly interrupted) upgrade step or None"""
+        try:
+            with self.openDB(dbFileName, mode='r') as h5file:
+                attr_name = 'upgrade_' + key
+                if attr_name in h5file.root._v_attrs._v_attrnames:
+                    return getattr(h5file.root._v_attrs, attr_name)
+                return None
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+    def setUpgradeState(self, dbFileName, key, value):
+        """Save a value so an interrupted upgrade step can resume"""
+        self.setUpgradeStates(dbFileName, {key : value})
+
+    def setUpgradeStates(self, dbFileName, states):
+        """Save several values at once, either all of them land or none do"""
+        try:
+            with self.openDB(dbFileName, mode='a') as h5file:
+                for key in states:
+                    setattr(h5file.root._v_attrs, 'upgrade_' + key, states[key])
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+    def clearUpgradeState(self, dbFileName):
+        """Forget everything saved by the upgrade step which just finished"""
+        try:
+            with self.openDB(dbFileName, mode='a') as h5file:
+                self.removeUpgradeState(h5file)
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+    def removeUpgradeState(self, h5file):
+        """Remove all saved upgrade state from an open DB"""
+        for attr_name in list(h5file.root._v_attrs._v_attrnames):
+            if attr_name.startswith('upgrade_'):
+                delattr(h5file.root._v_attrs, attr_name)
+
+    def getNumRows(self, dbFileName, nodePath):
+        """return the number of rows in the table at nodePath"""
+        try:
+            with self.openDB(dbFileName, mode='r') as h5file:
+                return h5file.getNode(nodePath).nrows
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+    def readTableBlock(self, dbFileName, nodePath, start, stop):
+        """Read rows [start, stop) of the table at nodePath as a plain 2D array"""
+        try:
+            with self.openDB(dbFileName, mode='r') as h5file:
+                return records2Array(h5file.getNode(nodePath).read(start, stop))
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+    def streamTable(self, dbFileName, groupPath, tableName, dbDesc, numRows, blockFn, title):
+        """Build a table block by block
+
+        blockFn(start, end) returns a 2D array holding rows [start, end).
+        Each block is committed along with a count of the rows written so far,
+        if the table already exists from an interrupted run we carry on from
+        there. The caller renames the finished table into place
+        """
+        try:
+            with self.openDB(dbFileName, mode='a') as h5file:
+                group = h5file.getNode(groupPath)
+                try:
+                    table = h5file.getNode(group, tableName)
+                    rows_done = table.attrs.rowsDone
+                    if table.nrows > rows_done:
+                        # a block was half written when we stopped
+                        table.removeRows(rows_done, table.nrows)
+                except (tables.NoSuchNodeError, AttributeError):
+                    try:
+                        h5file.removeNode(group, tableName)
+                    except:
+                        pass
+                    table = h5file.createTable(group,
+                                               tableName,
+                                               np.array([], dtype=dbDesc),
+                                               title=title,
+                                               expectedrows=numRows)
+                    rows_done = 0
+                    table.attrs.rowsDone = rows_done
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+        for start in xrange(rows_done, numRows, UPGRADE_BLOCK_SIZE):
+            end = min(start + UPGRADE_BLOCK_SIZE, numRows)
+            block = array2Records(blockFn(start, end), dbDesc)
+            try:
+                with self.openDB(dbFileName, mode='a') as h5file:
+                    table = h5file.getNode(groupPath + '/' + tableName)
+                    table.append(block)
+                    table.attrs.rowsDone = end
+            except:
+                print "Error opening DB:",dbFileName, exc_info()[0]
+                raise
+
+    def getKmerSigPCAModel(self, dbFileName):
+        """PCA of the kmer signatures, worked out one block at a time
+
+        The model is saved with the upgrade state so that every block
+        of an interrupted upgrade is projected onto the same components
+        """
+        model = self.getUpgradeState(dbFileName, 'kmerPCA')
+        if model is None:
+            model = blockwisePCA(lambda start, end: self.readTableBlock(dbFileName, '/profile/kms', start, end),
+                                 self.getNumRows(dbFileName, '/profile/kms'))
+            self.setUpgradeState(dbFileName, 'kmerPCA', model)
+        return model
+
+    def getLegacyContigNames(self, dbFileName):
+        """Load contig names from a pre version 6 DB"""
+        try:
+            with self.openDB(dbFileName, mode='r') as h5file:
+                return h5file.root.meta.contigs.col('cid')
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+#------------------------------------------------------------------------------
+# DB MAINTENANCE
+
+    def compactDB(self, dbFileName, complevel=0, complib='zlib', sortByLength=False):
+        """Rewrite the DB into a fresh file to reclaim the space left by old tables
+
+        HDF5 never gives back the space used by removed nodes, so every
+        tmp table / rename leaves a hole. Copying all live nodes into a new
+        file and renaming it over the old one gets rid of them
+
+        If sortByLength is set the rows of the new file are also put in
+        descending length order (see sortRowsByLength)
+        """
+        self.checkAndUpgradeDB(dbFileName, silent=True)
+        tmp_file_name = dbFileName + '.compact'
+        filters = tables.Filters(complevel=complevel, complib=complib)
+        old_size = op_getsize(dbFileName)
+
+        # hold the write lock from start to finish so nobody can change
+        # the DB under us or open it while it is being swapped
+        with self.lockDB(dbFileName, exclusive=True):
+            try:
+                with self.openDB(dbFileName, mode='r') as h5file:
+                    h5file.copyFile(tmp_file_name, overwrite=True, filters=filters)
+                    if sortByLength:
+                        # nobody else knows about this file so no need to lock it
+                        with tables.openFile(tmp_file_name, mode='a') as new_h5file:
+                            self.sortRowsByLength(h5file, new_h5file)
+            except:
+                print "Error compacting DB:",dbFileName, exc_info()[0]
+                try:
+                    os_remove(tmp_file_name)
+                except OSError:
+                    pass
+                raise
+
+            # rename is atomic, readers see either the old or the new file
+            os_rename(tmp_file_name, dbFileName)
+
+        new_size = op_getsize(dbFileName)
+        print "    Compacted %s: %d -> %d bytes" % (dbFileName, old_size, new_size)
+        return (old_size, new_size)
+
+    def sortRowsByLength(self, srcH5file, dstH5file, blockSize=100000):
+        """Put every per-contig node of dstH5file into descending length order
+
+        dstH5file must be a straight copy of srcH5file. Rows are read from the
+        source in the new order and written over the copy in place, so the
+        file does not grow. Links and core checkpoint rows are renumbered to
+        match. Afterwards any 'length >= X' condition selects a contiguous
+        block of leading rows
+        """
+        lengths = srcH5file.root.meta.contigs.col('length')
+        num_cons = len(lengths)
+        order = np.argsort(-lengths, kind='mergesort')
+        new_rows = np.zeros(num_cons, dtype=np.int64)
+        new_rows[order] = np.arange(num_cons)
+
+        # tables with one row per contig
+        table_paths = ['/meta/contigs'] + ['/profile/'+name for name in srcH5file.root.profile._v_children]
+        for path in table_paths:
+            src_table = srcH5file.getNode(path)
+            dst_table = dstH5file.getNode(path)
+            for start in xrange(0, num_cons, blockSize):
+                dst_table.modifyRows(start=start,
+                                     rows=src_table.readCoordinates(order[start:start+blockSize]))
+
+        # contig names and their index, the blob stays the same size
+        contig_names = decodeNames(srcH5file.root.meta.contigNameBlob.read(),
+                                   srcH5file.root.meta.contigNameOffsets.read(),
+                                   order)
+        (blob, offsets) = encodeNames(contig_names)
+        if len(blob) > 0:
+            dstH5file.root.meta.contigNameBlob[:] = blob
+        dstH5file.root.meta.contigNameOffsets[:] = offsets
+        name_index = srcH5file.root.meta.contigNameHash.read()
+        name_index['row'] = new_rows[name_index['row']]
+        if num_cons > 0:
+            dstH5file.root.meta.contigNameHash.modifyRows(start=0, rows=name_index)
+
+        # links refer to rows so they need renumbering
+        links = dstH5file.root.links.links
+        if links.nrows > 0:
+            for col_name in ['contig1', 'contig2']:
+                column = links.col(col_name)
+                links.modifyColumn(column=np.where(column >= 0, new_rows[np.maximum(column, 0)], column),
+                                   colname=col_name)
+
+        # as do the rows restricted by a core checkpoint
+        if 'core_restricted' in dstH5file.root._v_attrs._v_attrnames:
+            restricted = np.array(dstH5file.root._v_attrs.core_restricted, dtype=np.int64)
+            dstH5file.root._v_attrs.core_restricted = np.sort(new_rows[restricted]).astype(int)
+
+        # finally record where the common cutoffs fall
+        contigs = dstH5file.root.meta.contigs
+        sorted_lengths = -lengths[order]
+        contigs.attrs.lengthSorted = True
+        contigs.attrs.lengthBoundaries = np.array(LENGTH_BOUNDARIES, dtype=np.int64)
+        contigs.attrs.lengthBoundaryRows = np.searchsorted(sorted_lengths,
+                                                           -contigs.attrs.lengthBoundaries,
+                                                           side='right')
 
 #------------------------------------------------------------------------------
 # GET LINKS
@@ -922,7 +1517,7 @@ class GMDataManager:
         """Restore the links hash for a given set of indices"""
         full_record = []
         try:
-            with tables.openFile(dbFileName, mode='r') as h5file:
+            with self.openDB(dbFileName, mode='r') as h5file:
                 full_record = [list(x) for x in h5file.root.links.links.readWhere("contig1 >= 0")]
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
@@ -953,37 +1548,98 @@ class GMDataManager:
             self.checkAndUpgradeDB(dbFileName, silent=silent)
 
         if('' == condition):
-            condition = "cid != ''" # no condition breaks everything!
+            condition = "length >= 0" # no condition breaks everything!
         try:
-            with tables.openFile(dbFileName, mode='r') as h5file:
-                return np.array([x.nrow for x in h5file.root.meta.contigs.where(condition)])
+            with self.openDB(dbFileName, mode='r') as h5file:
+                contigs = h5file.root.meta.contigs
+                length_cut = getLengthCutoff(condition)
+                if length_cut is not None and 'lengthSorted' in contigs.attrs._v_attrnames:
+                    # rows are in length order so this is just a prefix
+                    return np.arange(self.countRowsAtLength(contigs, length_cut))
+                return np.array([x.nrow for x in contigs.where(condition)])
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
 
+    def countRowsAtLength(self, contigs, lengthCut):
+        """Count the leading rows of a length sorted contigs table with length >= lengthCut"""
+        boundaries = list(contigs.attrs.lengthBoundaries)
+        if lengthCut in boundaries:
+            return int(contigs.attrs.lengthBoundaryRows[boundaries.index(lengthCut)])
+        return int(np.searchsorted(-contigs.col('length'), -lengthCut, side='right'))
+
     def getCoverageProfiles(self, dbFileName, condition='', indices=np.array([])):
         """Load coverage profiles"""
         try:
-            with tables.openFile(dbFileName, mode='r') as h5file:
+            with self.openDB(dbFileName, mode='r') as h5file:
                 if(np.size(indices) != 0):
                     return np.array([list(h5file.root.profile.coverage[x]) for x in indices])
                 else:
                     if('' == condition):
-                        condition = "cid != ''" # no condition breaks everything!
+                        condition = "length >= 0" # no condition breaks everything!
                     return np.array([list(h5file.root.profile.coverage[x.nrow]) for x in h5file.root.meta.contigs.where(condition)])
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
 
+    def getNumColumns(self, dbFileName, nodePath):
+        """return the number of columns in the table at nodePath"""
+        try:
+            with self.openDB(dbFileName, mode='r') as h5file:
+                return len(h5file.getNode(nodePath).colnames)
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+    def getProfileDtype(self, dbFileName, nodePath='/profile/coverage'):
+        """return the numpy type used to store values in the table at nodePath
+
+        DBs made in float32 mode return float32, everything else float64
+        """
+        try:
+            with self.openDB(dbFileName, mode='r') as h5file:
+                table = h5file.getNode(nodePath)
+                return np.dtype(table.coldtypes[table.colnames[0]]).type
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+    def fillProfileArray(self, dbFileName, nodePath, indices, out, blockSize=100000, columns=None):
+        """Copy the rows of the table at nodePath listed in indices into out
+
+        out can be any writeable 2D array (including a numpy.memmap) with
+        one row per index. The table is read in blocks of blockSize rows
+        so only one block of records is ever held in memory. If columns is
+        set then only those columns (by position) are copied
+        """
+        try:
+            with self.openDB(dbFileName, mode='r') as h5file:
+                table = h5file.getNode(nodePath)
+                for start in xrange(0, len(indices), blockSize):
+                    block = indices[start:start+blockSize]
+                    if block[-1] - block[0] == len(block) - 1 and np.all(np.diff(block) == 1):
+                        # contiguous rows (eg. a length sorted DB) can be read in one go
+                        records = table.read(block[0], block[-1]+1)
+                    else:
+                        records = table.readCoordinates(block)
+                    if columns is None:
+                        out[start:start+len(records)] = records2Array(records)
+                    else:
+                        out[start:start+len(records)] = records2Array(records)[:,columns]
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+        return out
+
     def getTransformedCoverageProfiles(self, dbFileName, condition='', indices=np.array([])):
         """Load transformed coverage profiles"""
         try:
-            with tables.openFile(dbFileName, mode='r') as h5file:
+            with self.openDB(dbFileName, mode='r') as h5file:
                 if(np.size(indices) != 0):
                     return np.array([list(h5file.root.profile.transCoverage[x]) for x in indices])
                 else:
                     if('' == condition):
-                        condition = "cid != ''" # no condition breaks everything!
+                        condition = "length >= 0" # no condition breaks everything!
                     return np.array([list(h5file.root.profile.transCoverage[x.nrow]) for x in h5file.root.meta.contigs.where(condition)])
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
@@ -992,12 +1648,12 @@ class GMDataManager:
     def getNormalisedCoverageProfiles(self, dbFileName, condition='', indices=np.array([])):
         """Load normalised coverage profiles"""
         try:
-            with tables.openFile(dbFileName, mode='r') as h5file:
+            with self.openDB(dbFileName, mode='r') as h5file:
                 if(np.size(indices) != 0):
                     return np.array([list(h5file.root.profile.normCoverage[x]) for x in indices])
                 else:
                     if('' == condition):
-                        condition = "cid != ''" # no condition breaks everything!
+                        condition = "length >= 0" # no condition breaks everything!
                     return np.array([list(h5file.root.profile.normCoverage[x.nrow]) for x in h5file.root.meta.contigs.where(condition)])
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
@@ -1006,9 +1662,10 @@ class GMDataManager:
     def nukeBins(self, dbFileName):
         """Reset all bin information, completely"""
         print "    Clearing all old bin information from",dbFileName
-        self.setBinStats(dbFileName, [])
-        self.setNumBins(dbFileName, 0)
-        self.setBinAssignments(dbFileName, updates={}, nuke=True)
+        with self.lockDB(dbFileName, exclusive=True):
+            self.setBinStats(dbFileName, [])
+            self.setNumBins(dbFileName, 0)
+            self.setBinAssignments(dbFileName, updates={}, nuke=True)
 
     def initBinStats(self, storage):
         '''Initialise the bins table
@@ -1046,7 +1703,7 @@ class GMDataManager:
         bd = np.array(updates, dtype=db_desc)
 
         try:
-            with tables.openFile(dbFileName, mode='a', rootUEP="/") as h5file:
+            with self.openDB(dbFileName, mode='a', rootUEP="/") as h5file:
                 mg = h5file.getNode('/', name='meta')
                 # nuke any previous failed attempts
                 try:
@@ -1077,7 +1734,7 @@ class GMDataManager:
         { bid : [numMembers, isLikelyChimeric] }
         """
         try:
-            with tables.openFile(dbFileName, mode='r') as h5file:
+            with self.openDB(dbFileName, mode='r') as h5file:
                 ret_dict = {}
                 all_rows = h5file.root.meta.bins.read()
                 for row in all_rows:
@@ -1092,13 +1749,13 @@ class GMDataManager:
     def getBins(self, dbFileName, condition='', indices=np.array([])):
         """Load per-contig bins"""
         try:
-            with tables.openFile(dbFileName, mode='r') as h5file:
+            with self.openDB(dbFileName, mode='r') as h5file:
                 if(np.size(indices) != 0):
-                    return np.array([h5file.root.meta.contigs[x][1] for x in indices]).ravel()
+                    return h5file.root.meta.contigs.readCoordinates(indices, field='bid')
                 else:
                     if('' == condition):
-                        condition = "cid != ''" # no condition breaks everything!
-                    return np.array([list(x)[1] for x in h5file.root.meta.contigs.readWhere(condition)]).ravel()
+                        condition = "length >= 0" # no condition breaks everything!
+                    return h5file.root.meta.contigs.readWhere(condition, field='bid')
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
@@ -1109,89 +1766,204 @@ class GMDataManager:
         updates is a dictionary which looks like:
         { tableRow : binValue }
         if updates is set then storage is the
-        path to the hdf file
+        path to the hdf file. Only the bid column is rewritten
 
         image is a list of tuples which look like:
         [(cid, bid, len, gc)]
         if image is set then storage is a tuple of type:
         (h5file, group)
         """
-        db_desc = [('cid', '|S512'),
-                   ('bid', int),
-                   ('length', int),
-                   ('gc', float)]
-        closeh5 = False
         if updates is not None:
-            # we need to build the image
             dbFileName = storage
-            contig_names = self.getContigNames(dbFileName)
-            contig_lengths = self.getContigLengths(dbFileName)
-            contig_gcs = self.getContigGCs(dbFileName)
-            num_cons = len(contig_lengths)
-            if nuke:
-                # clear all bin assignments
-                bins = [0]*num_cons
-            else:
-                bins = self.getBins(dbFileName)
-
-            # now apply the updates
-            for tr in updates.keys():
-                bins[tr] = updates[tr]
+            try:
+                with self.openDB(dbFileName, mode='a') as h5file:
+                    contigs = h5file.root.meta.contigs
+                    if nuke:
+                        # clear all bin assignments
+                        bins = np.zeros(contigs.nrows, dtype=contigs.coldtypes['bid'])
+                    else:
+                        bins = contigs.col('bid')
 
-            # and build the image
-            image = np.array(zip(contig_names, bins, contig_lengths, contig_gcs),
-                             dtype=db_desc)
+                    # now apply the updates
+                    for tr in updates.keys():
+                        bins[tr] = updates[tr]
 
-            try:
-                h5file = tables.openFile(dbFileName, mode='a')
+                    contigs.modifyColumn(column=bins, colname='bid')
             except:
                 print "Error opening DB:",dbFileName, exc_info()[0]
                 raise
-            meta_group = h5file.getNode('/', name='meta')
-            closeh5 = True
 
         elif image is not None:
             h5file = storage[0]
             meta_group = storage[1]
             num_cons = len(image)
-            image = np.array(image,
+            db_desc = [('bid', int),
+                       ('length', int),
+                       ('gc', float)]
+            contig_names = [i[0] for i in image]
+            image = np.array([i[1:] for i in image],
                              dtype=db_desc)
+
+            # now we write the data
+            try:
+                # get rid of any failed attempts
+                h5file.removeNode(meta_group, 'tmp_contigs')
+            except:
+                pass
+
+            try:
+                h5file.createTable(meta_group,
+                                   'tmp_contigs',
+                                   image,
+                                   title="Contig information",
+                                   expectedrows=num_cons)
+            except:
+                print "Error creating CONTIG table:", exc_info()[0]
+                raise
+
+            # rename the tmp table to overwrite
+            h5file.renameNode(meta_group, 'contigs', 'tmp_contigs', overwrite=True)
+            self.setContigNames(h5file, meta_group, contig_names)
         else:
             print "get with the program dude"
             return
 
-        # now we write the data
+    def setContigNames(self, h5file, metaGroup, contigNames):
+        """Write the contig names as one blob of characters plus offsets
+
+        Names are variable length so they are kept out of the contigs
+        table, this way the numeric columns can be rewritten cheaply
+        """
+        (blob, offsets) = encodeNames(contigNames)
+        for node_name in ['contigNameBlob', 'contigNameOffsets']:
+            try:
+                h5file.removeNode(metaGroup, node_name)
+            except:
+                pass
+        try:
+            name_blob = h5file.createEArray(metaGroup,
+                                            'contigNameBlob',
+                                            tables.UInt8Atom(),
+                                            (0,),
+                                            title="Contig names",
+                                            expectedrows=len(blob))
+            if len(blob) > 0:
+                name_blob.append(blob)
+            h5file.createArray(metaGroup,
+                               'contigNameOffsets',
+                               offsets,
+                               title="Contig name offsets")
+        except:
+            print "Error creating CONTIG NAME arrays:", exc_info()[0]
+            raise
+
+        self.setContigNameIndex(h5file, metaGroup, contigNames)
+
+    def setContigNameIndex(self, h5file, metaGroup, contigNames):
+        """Write a table of (name hash, row) sorted by hash
+
+        This lets us resolve names to rows with a binary search instead
+        of loading every contig name
+        """
+        hashes = hashNames(contigNames)
+        order = np.argsort(hashes, kind='mergesort')
+        db_desc = [('hash', np.uint64),
+                   ('row', np.int64)]
+        image = np.zeros(len(hashes), dtype=db_desc)
+        image['hash'] = hashes[order]
+        image['row'] = order
+
         try:
-            # get rid of any failed attempts
-            h5file.removeNode(meta_group, 'tmp_contigs')
+            h5file.removeNode(metaGroup, 'tmp_contigNameHash')
         except:
             pass
 
         try:
-            h5file.createTable(meta_group,
-                               'tmp_contigs',
+            h5file.createTable(metaGroup,
+                               'tmp_contigNameHash',
                                image,
-                               title="Contig information",
-                               expectedrows=num_cons)
+                               title="Contig name index",
+                               expectedrows=len(hashes))
         except:
-            print "Error creating CONTIG table:", exc_info()[0]
+            print "Error creating CONTIG NAME INDEX table:", exc_info()[0]
             raise
 
         # rename the tmp table to overwrite
-        h5file.renameNode(meta_group, 'contigs', 'tmp_contigs', overwrite=True)
-        if closeh5:
-            h5file.close()
+        h5file.renameNode(metaGroup, 'contigNameHash', 'tmp_contigNameHash', overwrite=True)
+
+    def getContigNameIndex(self, dbFileName):
+        """Load the (hash, row) name index and the name offsets
+
+        Keep hold of the result and pass it to getRowIndicesForNames when
+        resolving names in many batches
+        """
+        try:
+            with self.openDB(dbFileName, mode='r') as h5file:
+                return (h5file.root.meta.contigNameHash.read(),
+                        h5file.root.meta.contigNameOffsets.read())
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+    def getRowIndicesForNames(self, dbFileName, contigNames, nameIndex=None):
+        """Resolve many contig names to rows in meta/contigs at once
+
+        Returns an array the same length as contigNames holding the row
+        of each name, or -1 where the name is not in the DB. nameIndex is
+        the result of getContigNameIndex, it is loaded if not given
+        """
+        rows = np.zeros(len(contigNames), dtype=np.int64) - 1
+        if len(contigNames) == 0:
+            return rows
+
+        if nameIndex is None:
+            nameIndex = self.getContigNameIndex(dbFileName)
+        (index, name_offsets) = nameIndex
+
+        # every (name, row) pair whose hashes match
+        hashes = hashNames(contigNames)
+        starts = np.searchsorted(index['hash'], hashes, side='left')
+        counts = np.searchsorted(index['hash'], hashes, side='right') - starts
+        num_pairs = np.sum(counts)
+        if num_pairs == 0:
+            return rows
+        name_ids = np.repeat(np.arange(len(contigNames)), counts)
+        pair_starts = np.repeat(np.cumsum(counts) - counts, counts)
+        candidates = index['row'][np.repeat(starts, counts) + np.arange(num_pairs) - pair_starts]
+
+        # check the names themselves to guard against hash collisions
+        # names are read in runs of nearby rows, one blob slice per run
+        check_rows = np.unique(candidates)
+        gaps = name_offsets[check_rows[1:]] - name_offsets[check_rows[:-1]+1]
+        run_edges = np.concatenate(([0], np.nonzero(gaps > NAME_SLICE_GAP)[0]+1, [len(check_rows)]))
+        check_names = []
+        try:
+            with self.openDB(dbFileName, mode='r') as h5file:
+                for i in range(len(run_edges)-1):
+                    check_names.append(self.readNamesBlock(h5file,
+                                                           name_offsets,
+                                                           check_rows[run_edges[i]:run_edges[i+1]]))
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+        check_names = np.concatenate(check_names)
+
+        found = check_names[np.searchsorted(check_rows, candidates)] == np.array(contigNames)[name_ids]
+        # earlier index entries win, as if we had checked them in order
+        rows[name_ids[found][::-1]] = candidates[found][::-1]
+        return rows
 
     def getContigNames(self, dbFileName, condition='', indices=np.array([])):
         """Load contig names"""
         try:
-            with tables.openFile(dbFileName, mode='r') as h5file:
-                if(np.size(indices) != 0):
-                    return np.array([h5file.root.meta.contigs[x][0] for x in indices]).ravel()
-                else:
+            with self.openDB(dbFileName, mode='r') as h5file:
+                if(np.size(indices) == 0):
                     if('' == condition):
-                        condition = "cid != ''" # no condition breaks everything!
-                    return np.array([list(x)[0] for x in h5file.root.meta.contigs.readWhere(condition)]).ravel()
+                        condition = "length >= 0" # no condition breaks everything!
+                    indices = h5file.root.meta.contigs.getWhereList(condition)
+                return decodeNames(h5file.root.meta.contigNameBlob.read(),
+                                   h5file.root.meta.contigNameOffsets.read(),
+                                   indices)
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
@@ -1199,13 +1971,13 @@ class GMDataManager:
     def getContigLengths(self, dbFileName, condition='', indices=np.array([])):
         """Load contig lengths"""
         try:
-            with tables.openFile(dbFileName, mode='r') as h5file:
+            with self.openDB(dbFileName, mode='r') as h5file:
                 if(np.size(indices) != 0):
-                    return np.array([h5file.root.meta.contigs[x][2] for x in indices]).ravel()
+                    return h5file.root.meta.contigs.readCoordinates(indices, field='length')
                 else:
                     if('' == condition):
-                        condition = "cid != ''" # no condition breaks everything!
-                    return np.array([list(x)[2] for x in h5file.root.meta.contigs.readWhere(condition)]).ravel()
+                        condition = "length >= 0" # no condition breaks everything!
+                    return h5file.root.meta.contigs.readWhere(condition, field='length')
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
@@ -1213,13 +1985,13 @@ class GMDataManager:
     def getContigGCs(self, dbFileName, condition='', indices=np.array([])):
         """Load contig gcs"""
         try:
-            with tables.openFile(dbFileName, mode='r') as h5file:
+            with self.openDB(dbFileName, mode='r') as h5file:
                 if(np.size(indices) != 0):
-                    return np.array([h5file.root.meta.contigs[x][3] for x in indices]).ravel()
+                    return h5file.root.meta.contigs.readCoordinates(indices, field='gc')
                 else:
                     if('' == condition):
-                        condition = "cid != ''" # no condition breaks everything!
-                    return np.array([list(x)[3] for x in h5file.root.meta.contigs.readWhere(condition)]).ravel()
+                        condition = "length >= 0" # no condition breaks everything!
+                    return h5file.root.meta.contigs.readWhere(condition, field='gc')
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
@@ -1227,12 +1999,12 @@ class GMDataManager:
     def getKmerSigs(self, dbFileName, condition='', indices=np.array([])):
         """Load kmer sigs"""
         try:
-            with tables.openFile(dbFileName, mode='r') as h5file:
+            with self.openDB(dbFileName, mode='r') as h5file:
                 if(np.size(indices) != 0):
                     return np.array([list(h5file.root.profile.kms[x]) for x in indices])
                 else:
                     if('' == condition):
-                        condition = "cid != ''" # no condition breaks everything!
+                        condition = "length >= 0" # no condition breaks everything!
                     return np.array([list(h5file.root.profile.kms[x.nrow]) for x in h5file.root.meta.contigs.where(condition)])
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
@@ -1241,12 +2013,12 @@ class GMDataManager:
     def getKmerPCAs(self, dbFileName, condition='', indices=np.array([])):
         """Load kmer sig PCAs"""
         try:
-            with tables.openFile(dbFileName, mode='r') as h5file:
+            with self.openDB(dbFileName, mode='r') as h5file:
                 if(np.size(indices) != 0):
                     return np.array([list(h5file.root.profile.kpca[x]) for x in indices])
                 else:
                     if('' == condition):
-                        condition = "cid != ''" # no condition breaks everything!
+                        condition = "length >= 0" # no condition breaks everything!
                     return np.array([list(h5file.root.profile.kpca[x.nrow]) for x in h5file.root.meta.contigs.where(condition)])
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
@@ -1258,7 +2030,7 @@ class GMDataManager:
     def getKmerVarPC(self, dbFileName, condition='', indices=np.array([])):
         """Load variance of kmer sig PCAs"""
         try:
-            with tables.openFile(dbFileName, mode='r') as h5file:
+            with self.openDB(dbFileName, mode='r') as h5file:
                 return np.array(list(h5file.root.meta.kpca_variance[0]))
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
@@ -1267,7 +2039,7 @@ class GMDataManager:
     def getTransformedCoverageCorners(self, dbFileName):
         """Load transformed coverage corners"""
         try:
-            with tables.openFile(dbFileName, mode='r') as h5file:
+            with self.openDB(dbFileName, mode='r') as h5file:
                 return np.array([list(x) for x in h5file.root.meta.transCoverageCorners.read()])
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
@@ -1320,7 +2092,7 @@ class GMDataManager:
     def getMetaField(self, dbFileName, fieldName):
         """return the value of fieldName in the metadata tables"""
         try:
-            with tables.openFile(dbFileName, mode='r') as h5file:
+            with self.openDB(dbFileName, mode='r') as h5file:
                 # theres only one value
                 return h5file.root.meta.meta.read()[fieldName][0]
         except:
@@ -1341,7 +2113,7 @@ class GMDataManager:
                     self.isComplete(dbFileName),
                     version)
         try:
-            with tables.openFile(dbFileName, mode='a', rootUEP="/") as h5file:
+            with self.openDB(dbFileName, mode='a', rootUEP="/") as h5file:
                 self.setMeta(h5file, meta_data, overwrite=True)
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
@@ -1351,7 +2123,7 @@ class GMDataManager:
         """return the format version of this GM file"""
         # this guy needs to be a bit different to the other meta methods
         # becuase earlier versions of GM didn't include a format parameter
-        with tables.openFile(dbFileName, mode='r') as h5file:
+        with self.openDB(dbFileName, mode='r') as h5file:
             # theres only one value
             try:
                 this_DB_version = h5file.root.meta.meta.read()['formatVersion'][0]
@@ -1394,7 +2166,7 @@ class GMDataManager:
                     self.isComplete(dbFileName),
                     self.getGMDBFormat(dbFileName))
         try:
-            with tables.openFile(dbFileName, mode='a', rootUEP="/") as h5file:
+            with self.openDB(dbFileName, mode='a', rootUEP="/") as h5file:
                 self.setMeta(h5file, meta_data, overwrite=True)
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
@@ -1414,7 +2186,7 @@ class GMDataManager:
     def isClustered(self, dbFileName):
         """Has this data set been clustered?"""
         try:
-            with tables.openFile(dbFileName, mode='r') as h5file:
+            with self.openDB(dbFileName, mode='r') as h5file:
                 return h5file.root.meta.meta.read()['clustered']
         except:
             print "Error opening database:", dbFileName, exc_info()[0]
@@ -1434,7 +2206,7 @@ class GMDataManager:
                     self.isComplete(dbFileName),
                     self.getGMDBFormat(dbFileName))
         try:
-            with tables.openFile(dbFileName, mode='a', rootUEP="/") as h5file:
+            with self.openDB(dbFileName, mode='a', rootUEP="/") as h5file:
                 self.setMeta(h5file, meta_data, overwrite=True)
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
@@ -1443,7 +2215,7 @@ class GMDataManager:
     def isComplete(self, dbFileName):
         """Has this data set been *completely* clustered?"""
         try:
-            with tables.openFile(dbFileName, mode='r') as h5file:
+            with self.openDB(dbFileName, mode='r') as h5file:
                 return h5file.root.meta.meta.read()['complete']
         except:
             print "Error opening database:", dbFileName, exc_info()[0]
@@ -1463,72 +2235,139 @@ class GMDataManager:
                     state,
                     self.getGMDBFormat(dbFileName))
         try:
-            with tables.openFile(dbFileName, mode='a', rootUEP="/") as h5file:
+            with self.openDB(dbFileName, mode='a', rootUEP="/") as h5file:
                 self.setMeta(h5file, meta_data, overwrite=True)
         except:
             print "Error opening DB:",dbFileName, exc_info()[0]
             raise
 
 #------------------------------------------------------------------------------
-# FILE / IO
+# CORE CHECKPOINTS
+#
+# groopm core saves the bins it has made so far as it goes. Everything else
+# it needs to carry on from there is kept in root attributes
 
-    def dumpData(self, dbFileName, fields, outFile, separator, useHeaders):
-        """Dump data to file"""
-        header_strings = []
-        data_arrays = []
+    def getCoreCheckpoint(self, dbFileName):
+        """Return (restricted GLOBAL row indices, state) from the last core checkpoint or None"""
+        try:
+            with self.openDB(dbFileName, mode='r') as h5file:
+                attr_names = h5file.root._v_attrs._v_attrnames
+                if 'core_restricted' not in attr_names or 'core_state' not in attr_names:
+                    return None
+                return (np.array(h5file.root._v_attrs.core_restricted, dtype=int),
+                        h5file.root._v_attrs.core_state)
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+    def setCoreCheckpoint(self, dbFileName, restricted, state):
+        """Save what groopm core needs (besides the bins) to resume
+
+        restricted holds GLOBAL row indices, state is a dict
+        """
+        try:
+            with self.openDB(dbFileName, mode='a') as h5file:
+                h5file.root._v_attrs.core_restricted = np.array(restricted, dtype=int)
+                h5file.root._v_attrs.core_state = state
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
+
+    def clearCoreCheckpoint(self, dbFileName):
+        """Forget the last core checkpoint"""
+        try:
+            with self.openDB(dbFileName, mode='a') as h5file:
+                for attr_name in ['core_restricted', 'core_state']:
+                    if attr_name in h5file.root._v_attrs._v_attrnames:
+                        delattr(h5file.root._v_attrs, attr_name)
+        except:
+            print "Error opening DB:",dbFileName, exc_info()[0]
+            raise
 
+#------------------------------------------------------------------------------
+# FILE / IO
+
+    def dumpData(self,
+                 dbFileName,
+                 fields,
+                 outFile,
+                 separator,
+                 useHeaders,
+                 bids=None,                 # only dump contigs in these bins
+                 minLength=None,            # only dump contigs at least this long
+                 maxLength=None,            # only dump contigs at most this long
+                 minGC=None,                # only dump contigs with GC in this range
+                 maxGC=None,
+                 contigNames=None,          # only dump these contigs
+                 columns=None):             # only dump these coverage / mer columns
+        """Dump data to file
+
+        The row filters are evaluated by PyTables and the columns are read
+        field by field, so only the selected part of the DB is ever read.
+        Rows are read and written DUMP_BLOCK_SIZE at a time, the DB is only
+        locked while each block is read. Blocks may see different bin
+        assignments if a bin save lands part way through
+        """
         if fields == ['all']:
             fields = ['names', 'lengths', 'gc', 'bins', 'coverage', 'tcoverage', 'ncoverage', 'mers']
 
-        num_fields = len(fields)
-        data_converters = []
-
+        indices = self.getDumpIndices(dbFileName,
+                                      bids=bids,
+                                      minLength=minLength,
+                                      maxLength=maxLength,
+                                      minGC=minGC,
+                                      maxGC=maxGC,
+                                      contigNames=contigNames)
+
+        # work out what comes from where
+        # [(header strings, table path, column names, converter)]
+        # table path None means the contig names
+        header_strings = []
+        field_sources = []
         for field in fields:
             if field == 'names':
                 header_strings.append('cid')
-                data_arrays.append(self.getContigNames(dbFileName))
-                data_converters.append(lambda x : x)
+                field_sources.append((None, None, lambda x : x))
 
             elif field == 'lengths':
                 header_strings.append('length')
-                data_arrays.append(self.getContigLengths(dbFileName))
-                data_converters.append(lambda x : str(x))
+                field_sources.append(('/meta/contigs', ['length'], lambda x : str(x[0])))
 
             elif field == 'gc':
                 header_strings.append('GCs')
-                data_arrays.append(self.getContigGCs(dbFileName))
-                data_converters.append(lambda x : str(x))
+                field_sources.append(('/meta/contigs', ['gc'], lambda x : str(x[0])))
 
             elif field == 'bins':
                 header_strings.append('bid')
-                data_arrays.append(self.getBins(dbFileName))
-                data_converters.append(lambda x : str(x))
+                field_sources.append(('/meta/contigs', ['bid'], lambda x : str(x[0])))
 
             elif field == 'coverage':
-                stoits = self.getStoitColNames(dbFileName).split(',')
-                for stoit in stoits:
-                    header_strings.append(stoit)
-                data_arrays.append(self.getCoverageProfiles(dbFileName))
-                data_converters.append(lambda x : separator.join(["%0.4f" % i for i in x]))
+                stoits = self.selectColumns(self.getStoitColNames(dbFileName).split(','), columns)
+                if len(stoits) == 0:
+                    continue
+                header_strings += stoits
+                field_sources.append(('/profile/coverage', stoits, lambda x : separator.join(["%0.4f" % i for i in x])))
 
             elif field == 'tcoverage':
                 header_strings.append('transformedCoverageX')
                 header_strings.append('transformedCoverageY')
                 header_strings.append('transformedCoverageZ')
-                data_arrays.append(self.getTransformedCoverageProfiles(dbFileName))
-                data_converters.append(lambda x : separator.join(["%0.4f" % i for i in x]))
+                field_sources.append(('/profile/transCoverage', ['x', 'y', 'z'], lambda x : separator.join(["%0.4f" % i for i in x])))
 
             elif field == 'ncoverage':
                 header_strings.append('normalisedCoverage')
-                data_arrays.append(self.getNormalisedCoverageProfiles(dbFileName))
-                data_converters.append(lambda x : separator.join(["%0.4f" % i for i in x]))
+                field_sources.append(('/profile/normCoverage', ['normCov'], lambda x : separator.join(["%0.4f" % i for i in x])))
 
             elif field == 'mers':
-                mers = self.getMerColNames(dbFileName).split(',')
-                for mer in mers:
-                    header_strings.append(mer)
-                data_arrays.append(self.getKmerSigs(dbFileName))
-                data_converters.append(lambda x : separator.join(["%0.4f" % i for i in x]))
+                mers = self.selectColumns(self.getMerColNames(dbFileName).split(','), columns)
+                if len(mers) == 0:
+                    continue
+                header_strings += mers
+                field_sources.append(('/profile/kms', mers, lambda x : separator.join(["%0.4f" % i for i in x])))
+
+        if len(field_sources) == 0:
+            print "    Nothing to dump"
+            return
 
         try:
             with open(outFile, 'w') as fh:
@@ -1536,16 +2375,90 @@ class GMDataManager:
                     header = separator.join(header_strings) + "\n"
                     fh.write(header)
 
-                num_rows = len(data_arrays[0])
-                for i in range(num_rows):
-                    fh.write(data_converters[0](data_arrays[0][i]))
-                    for j in range(1, num_fields):
-                        fh.write(separator+data_converters[j](data_arrays[j][i]))
-                    fh.write('\n')
+                # the DB is only locked while a block is read, writers can get
+                # in while we format and write it out
+                name_offsets = None
+                converters = [source[2] for source in field_sources]
+                for start in xrange(0, len(indices), DUMP_BLOCK_SIZE):
+                    block = indices[start:start+DUMP_BLOCK_SIZE]
+                    data_arrays = []
+                    with self.openDB(dbFileName, mode='r') as h5file:
+                        for (table_path, col_names, converter) in field_sources:
+                            if table_path is None:
+                                if name_offsets is None:
+                                    name_offsets = h5file.root.meta.contigNameOffsets.read()
+                                data_arrays.append(self.readNamesBlock(h5file, name_offsets, block))
+                            else:
+                                data_arrays.append(self.readColumnsBlock(h5file.getNode(table_path), block, col_names))
+
+                    for i in range(len(block)):
+                        fh.write(separator.join([converters[j](data_arrays[j][i]) for j in range(len(data_arrays))]))
+                        fh.write('\n')
         except:
             print "Error opening output file %s for writing" % outFile
             raise
 
+    def getDumpIndices(self, dbFileName, bids=None, minLength=None, maxLength=None, minGC=None, maxGC=None, contigNames=None):
+        """Sorted rows of meta/contigs which pass the dump filters"""
+        clauses = []
+        if minLength is not None:
+            clauses.append("(length >= %d)" % minLength)
+        if maxLength is not None:
+            clauses.append("(length <= %d)" % maxLength)
+        if minGC is not None:
+            clauses.append("(gc >= %f)" % minGC)
+        if maxGC is not None:
+            clauses.append("(gc <= %f)" % maxGC)
+        if bids is not None and len(bids) > 0:
+            clauses.append("(" + " | ".join(["(bid == %d)" % bid for bid in bids]) + ")")
+
+        if contigNames is not None:
+            # go straight to the rows we want
+            rows = self.getRowIndicesForNames(dbFileName, contigNames)
+            rows = np.unique(rows[rows >= 0])
+            if len(clauses) == 0:
+                return rows
+            indices = self.getConditionalIndices(dbFileName, condition=" & ".join(clauses), silent=True)
+            return np.intersect1d(indices, rows)
+
+        return self.getConditionalIndices(dbFileName, condition=" & ".join(clauses), silent=True)
+
+    def selectColumns(self, colNames, columns):
+        """Keep those of colNames which are listed in columns (all of them if columns is None)"""
+        if columns is None:
+            return colNames
+        wanted = set(columns)
+        return [col_name for col_name in colNames if col_name in wanted]
+
+    def readColumnsBlock(self, table, indices, colNames):
+        """Read some columns of some rows of a table as a 2D array
+
+        If we want every column whole records are read, otherwise each
+        column is read on its own so the others never leave the disk
+        """
+        contiguous = len(indices) > 0 and indices[-1] - indices[0] == len(indices) - 1
+        if list(colNames) == list(table.colnames):
+            if contiguous:
+                return records2Array(table.read(indices[0], indices[-1]+1))
+            return records2Array(table.readCoordinates(indices))
+
+        block = np.zeros((len(indices), len(colNames)),
+                         dtype=np.result_type(*[table.coldtypes[col_name] for col_name in colNames]))
+        for (i, col_name) in enumerate(colNames):
+            if contiguous:
+                block[:,i] = table.read(indices[0], indices[-1]+1, field=col_name)
+            else:
+                block[:,i] = table.readCoordinates(indices, field=col_name)
+        return block
+
+    def readNamesBlock(self, h5file, nameOffsets, indices):
+        """Decode the names at (sorted) indices, reading only the part of the blob they span"""
+        if len(indices) == 0:
+            return np.array([])
+        first = nameOffsets[indices[0]]
+        blob = h5file.root.meta.contigNameBlob[first:nameOffsets[indices[-1]+1]]
+        return decodeNames(blob, nameOffsets - first, indices)
+
 ###############################################################################
 ###############################################################################
 ###############################################################################
@@ -1777,6 +2690,87 @@ def getBamDescriptor(fullPath, index_num):
     """AUX: Reduce a full path to just the file name minus extension"""
     return str(index_num) + '_' + op_splitext(op_basename(fullPath))[0]
 
+def encodeNames(names):
+    """AUX: Pack a list of strings into a (UInt8 blob, Int64 offsets) pair"""
+    offsets = np.zeros(len(names)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(name) for name in names])
+    return (np.fromstring("".join(names), dtype=np.uint8), offsets)
+
+def decodeNames(blob, offsets, indices):
+    """AUX: Pull the strings at indices back out of a packed blob"""
+    blob = blob.tostring()
+    return np.array([blob[offsets[i]:offsets[i+1]] for i in indices])
+
+def getLengthCutoff(condition):
+    """AUX: If condition is a plain 'length >= X' return X, otherwise None"""
+    match = re.match(r'^[\s\(]*length\s*>=\s*(\d+)[\s\)]*$', condition)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+def hashNames(names):
+    """AUX: 64 bit hashes of strings, stable across runs and platforms"""
+    return np.fromstring("".join([md5(name).digest()[:8] for name in names]), dtype='<u8')
+
+def array2Records(array, dbDesc):
+    """AUX: Convert a plain 2D array into records with the given columns"""
+    records = np.zeros(len(array), dtype=dbDesc)
+    for (i, (name, col_type)) in enumerate(dbDesc):
+        records[name] = array[:,i]
+    return records
+
+def blockwisePCA(blockFn, numRows, variance=0.8, blockSize=UPGRADE_BLOCK_SIZE):
+    """AUX: PCA of a large matrix which is only ever read in blocks
+
+    blockFn(start, end) returns rows [start, end). Matches ContigParser.PCAKSigs
+    (centre, scale to unit variance, keep enough PCs to capture variance) but
+    works from the covariance matrix, which is accumulated over two passes.
+    Returns a model to hand to projectBlock
+    """
+    # pass one, column means
+    total = 0.
+    for start in xrange(0, numRows, blockSize):
+        total = total + np.sum(blockFn(start, start+blockSize), axis=0)
+    mean = total / numRows
+
+    # pass two, scatter matrix of the centred data
+    scatter = 0.
+    for start in xrange(0, numRows, blockSize):
+        centred = blockFn(start, start+blockSize) - mean
+        scatter = scatter + np.dot(centred.T, centred)
+    std = np.sqrt(np.diag(scatter) / numRows)
+    std = np.where(std, std, 1.)
+
+    # eigenvectors of the correlation matrix are the right singular
+    # vectors of the centred, scaled data
+    (eigen, vectors) = np.linalg.eigh(scatter / np.outer(std, std))
+    order = np.argsort(eigen)[::-1]
+    eigen = np.maximum(eigen[order], 0.)
+    Vt = vectors[:,order].T
+    if Vt[0,0] < 0:
+        Vt *= -1.
+
+    sumvariance = np.cumsum(eigen)
+    sumvariance /= sumvariance[-1]
+    npc = np.searchsorted(sumvariance, variance) + 1
+    while(npc == 1):   # prevents less than 2 pcs being found
+        variance *= 1.1
+        npc = np.searchsorted(sumvariance, variance) + 1
+    npc = min(npc, len(eigen))
+
+    return {'mean' : mean,
+            'std' : std,
+            'components' : Vt[:npc],
+            'sumvariance' : sumvariance[:npc]}
+
+def projectBlock(model, block):
+    """AUX: Project a block of rows onto the PCs of a blockwisePCA model"""
+    return np.dot((block - model['mean']) / model['std'], model['components'].T)
+
+def records2Array(records):
+    """AUX: Convert a block of table records into a plain 2D array"""
+    return np.column_stack([records[name] for name in records.dtype.names])
+
 ###############################################################################
 ###############################################################################
 ###############################################################################
@@ -1806,45 +2800,19 @@ class CoverageTransformer:
         self.TCentre = None
         self.transformedCP = np.zeros((self.numContigs,3))
         self.corners = np.zeros((self.numStoits,3))
+        self.stoitOrder = np.arange(self.numStoits)   # original column of each stoit after shuffling
 
     def transformCP(self, silent=False, nolog=False):
         """Do the main transformation on the coverage profile data"""
-        shrinkFn = np.log10
-        if(nolog):
-            shrinkFn = lambda x:x
-
         if(not silent):
             print "    Reticulating splines"
             print "    Dimensionality reduction"
 
-        unit_vectors = [(np.cos(i*2*np.pi/self.numStoits),np.sin(i*2*np.pi/self.numStoits)) for i in range(self.numStoits)]
-
         # make sure the bams are ordered consistently
         if self.numStoits > 3:
             self.shuffleBAMs()
 
-        for i in range(len(self.indices)):
-            shifted_vector = np.array([0.0,0.0])
-            try:
-                flat_vector = (self.covProfiles[i] / sum(self.covProfiles[i]))
-            except FloatingPointError:
-                flat_vector = self.covProfiles[i]
-
-            for j in range(self.numStoits):
-                shifted_vector[0] += unit_vectors[j][0] * flat_vector[j]
-                shifted_vector[1] += unit_vectors[j][1] * flat_vector[j]
-
-            # log scale it towards the centre
-            scaling_vector = shifted_vector * self.scaleFactor
-            sv_size = np.linalg.norm(scaling_vector)
-            if sv_size > 1:
-                shifted_vector /= shrinkFn(sv_size)
-
-            self.transformedCP[i,0] = shifted_vector[0]
-            self.transformedCP[i,1] = shifted_vector[1]
-            # should always work cause we nuked
-            # all 0 coverage vecs in parse
-            self.transformedCP[i,2] = shrinkFn(self.normCoverages[i])
+        self.transformedCP = self.transformBlock(self.covProfiles, self.normCoverages, nolog=nolog)
 
         # finally scale the matrix to make it equal in all dimensions
         min = np.amin(self.transformedCP, axis=0)
@@ -1853,13 +2821,50 @@ class CoverageTransformer:
         max = max / (self.scaleFactor-1)
         self.transformedCP /= max
 
-        # get the corner points
-        XYcorners = np.reshape([i for i in np.array(unit_vectors)],
-                               (self.numStoits, 2))
+        self.makeCorners(min, max)
 
-        for i in range(self.numStoits):
-            self.corners[i,0] = XYcorners[i,0]
-            self.corners[i,1] = XYcorners[i,1]
+    def getUnitVectors(self):
+        """One unit vector per stoit, evenly spaced around the circle"""
+        return np.array([(np.cos(i*2*np.pi/self.numStoits),np.sin(i*2*np.pi/self.numStoits)) for i in range(self.numStoits)])
+
+    def transformBlock(self, covProfiles, normCoverages, nolog=False):
+        """Transform a block of coverage profiles
+
+        The columns must already be in the shuffled BAM order. The result
+        still needs to be shifted and scaled (see transformCP) but this can
+        be done afterwards, so large DBs can be transformed in blocks
+        """
+        shrinkFn = np.log10
+        if(nolog):
+            shrinkFn = lambda x:x
+
+        cov_profiles = np.asarray(covProfiles, dtype=float)
+        totals = np.sum(cov_profiles, axis=1)
+        totals[totals == 0] = 1. # leave all zero vectors alone
+        flat_vectors = cov_profiles / totals[:,np.newaxis]
+        shifted_vectors = np.dot(flat_vectors, self.getUnitVectors())
+
+        # log scale it towards the centre
+        sv_sizes = np.sqrt(np.sum((shifted_vectors * self.scaleFactor)**2, axis=1))
+        far = sv_sizes > 1
+        shifted_vectors[far] /= shrinkFn(sv_sizes[far])[:,np.newaxis]
+
+        transformed = np.zeros((len(cov_profiles),3))
+        transformed[:,:2] = shifted_vectors
+        # should always work cause we nuked
+        # all 0 coverage vecs in parse
+        transformed[:,2] = shrinkFn(normCoverages)
+        return transformed
+
+    def makeCorners(self, min, max):
+        """Work out the corners of the transformed space
+
+        min and max are the shift and scale which were applied to the
+        transformed coverage profiles
+        """
+        # get the corner points
+        self.corners = np.zeros((self.numStoits,3))
+        self.corners[:,:2] = self.getUnitVectors()
 
         # shift the corners to match the space
         self.corners -= min
@@ -1887,112 +2892,31 @@ class CoverageTransformer:
             step += 1
         return (step, step + index + 1)
 
+    def getShuffleSubset(self):
+        """Pick the (repeatable) subset of contigs used to order the bams"""
+        # we'd like to take it down to about 1500 or so RI's
+        # but we'd like to do this in a repeatable way
+        ideal_contig_num = 1500
+        sub_cons = np.arange(self.numContigs)
+        while len(sub_cons) > ideal_contig_num:
+            # select every second contig when sorted by norm cov
+            cov_sorted = np.argsort(self.normCoverages[sub_cons])
+            sub_cons = np.array([sub_cons[cov_sorted[i*2]] for i in np.arange(int(len(sub_cons)/2))])
+
+            if len(sub_cons) > ideal_contig_num:
+                # select every second contig when sorted by mer PC1
+                mer_sorted = np.argsort(self.kmerNormPC1[sub_cons])
+                sub_cons = np.array([sub_cons[mer_sorted[i*2]] for i in np.arange(int(len(sub_cons)/2))])
+        return sub_cons
+
     def shuffleBAMs(self, ordering=None):
         """Make the data transformation deterministic by reordering the bams"""
         # As Ben pointed out. This is basically the travelling salesman.
         if ordering is None:
             # we will need to deduce the ordering of the contigs
             # first we should make a subset of the total data
-            # we'd like to take it down to about 1500 or so RI's
-            # but we'd like to do this in a repeatable way
-            ideal_contig_num = 1500
-            sub_cons = np.arange(self.numContigs)
-            while len(sub_cons) > ideal_contig_num:
-                # select every second contig when sorted by norm cov
-                cov_sorted = np.argsort(self.normCoverages[sub_cons])
-                sub_cons = np.array([sub_cons[cov_sorted[i*2]] for i in np.arange(int(len(sub_cons)/2))])
-
-                if len(sub_cons) > ideal_contig_num:
-                    # select every second contig when sorted by mer PC1
-                    mer_sorted = np.argsort(self.kmerNormPC1[sub_cons])
-                    sub_cons = np.array([sub_cons[mer_sorted[i*2]] for i in np.arange(int(len(sub_cons)/2))])
-
-            # now that we have a subset, calculate the distance between each of the untransformed vectors
-            num_sc = len(sub_cons)
-
-            # log shift the coverages towards the origin
-            sub_covs = np.transpose([self.covProfiles[i]*(np.log10(self.normCoverages[i])/self.normCoverages[i]) for i in sub_cons])
-            sq_dists = cdist(sub_covs,sub_covs,'cityblock')
-            dists = squareform(sq_dists)
-
-            # we have an all vs all distance matrix. Time to do some dodgy optimization.
-            # For this case, we only require locally optimal paths. So we can get away with
-            # simply choosing the shortest edges in the list
-            # initialise a list of left, right neighbours
-            lr_dict = {}
-            for i in range(self.numStoits):
-                lr_dict[i] = []
-
-            too_big = 10000
-            while True:
-                closest = np.argmin(dists)
-                if dists[closest] == too_big:
-                    break
-                (i,j) = self.small2indices(closest, self.numStoits-1)
-                lr_dict[j].append(i)
-                lr_dict[i].append(j)
-
-                # mark these guys as neighbours
-                if len(lr_dict[i]) == 2:
-                    # no more than 2 neighbours
-                    sq_dists[i,:] = too_big
-                    sq_dists[:,i] = too_big
-                    sq_dists[i,i] = 0.0
-                if len(lr_dict[j]) == 2:
-                    # no more than 2 neighbours
-                    sq_dists[j,:] = too_big
-                    sq_dists[:,j] = too_big
-                    sq_dists[j,j] = 0.0
-
-                # fix the dist matrix
-                sq_dists[j,i] = too_big
-                sq_dists[i,j] = too_big
-                dists = squareform(sq_dists)
-
-            # now everyone should have two neighbours ( but not always )
-            # The global path may be separated into several disjoint rings.
-            # so we need to make sure that we get all the nodes in the ordering list
-            trier = 0   # start of a new disjoint ring
-            ordering = [trier]
-            while len(ordering) < len(lr_dict.keys()):
-                try:
-                    adding_index = lr_dict[trier][0]    # ok IF this guy has a registered neighbour
-                    if adding_index in ordering:        # NOT ok if the neighbour is already in the list
-                        raise IndexError()
-                    ordering.append(adding_index)
-                    while len(ordering) < len(lr_dict.keys()):  # try consume the entire ring
-                        # len(ordering) >= 2
-                        last = ordering[-1]
-                        if lr_dict[last][0] == ordering[-2]:    # bi-directionality means this will always work
-                            try:
-                                adding_index = lr_dict[last][1] # ok IF this guy has two neighbours
-                                if adding_index in ordering:    # NOT ok if the neighbour is already in the list
-                                    raise IndexError()
-                                ordering.append(adding_index)
-                            except IndexError:                  # only one neighbour
-                                # stick (2 city system)
-                                while(trier in ordering):       # find the next index NOT in the ordering
-                                    trier += 1
-                                if trier < len(lr_dict.keys()): # make sure it makes sense
-                                    ordering.append(trier)
-                                break
-                        else:
-                            adding_index = lr_dict[last][0]
-                            if adding_index in ordering:
-                                raise IndexError()
-                            ordering.append(adding_index)
-                except IndexError:                  # start a new disjoint ring
-                    # single point
-                    while(trier in ordering):
-                        trier += 1
-                    if trier < len(lr_dict.keys()): # make sure it makes sense
-                        ordering.append(trier)
-
-        # sanity check
-        if len(ordering) != self.numStoits:
-            print "WATTUP, ordering is looking wrong!"
-            print ordering
-            print lr_dict
+            sub_cons = self.getShuffleSubset()
+            ordering = self.findBAMOrdering(self.covProfiles[sub_cons], self.normCoverages[sub_cons])
 
         # reshuffle the contig order!
         # yay for bubble sort!
@@ -2002,6 +2926,99 @@ class CoverageTransformer:
             loc = list(working).index(ordering[i])
             if loc != i:
                 # swap the columns
-                self.covProfiles[:,[i,loc]] = self.covProfiles[:,[loc,i]]
+                if self.covProfiles is not None:
+                    self.covProfiles[:,[i,loc]] = self.covProfiles[:,[loc,i]]
                 self.stoitColNames[[i,loc]] = self.stoitColNames[[loc,i]]
                 working[[i,loc]] = working[[loc,i]]
+        self.stoitOrder = working
+
+    def findBAMOrdering(self, subCovProfiles, subNormCoverages):
+        """Find a good ordering of the bams using a subset of the coverage profiles"""
+        # now that we have a subset, calculate the distance between each of the untransformed vectors
+        num_sc = len(subCovProfiles)
+
+        # log shift the coverages towards the origin
+        sub_covs = np.transpose([subCovProfiles[i]*(np.log10(subNormCoverages[i])/subNormCoverages[i]) for i in range(num_sc)])
+        sq_dists = cdist(sub_covs,sub_covs,'cityblock')
+        dists = squareform(sq_dists)
+
+        # we have an all vs all distance matrix. Time to do some dodgy optimization.
+        # For this case, we only require locally optimal paths. So we can get away with
+        # simply choosing the shortest edges in the list
+        # initialise a list of left, right neighbours
+        lr_dict = {}
+        for i in range(self.numStoits):
+            lr_dict[i] = []
+
+        too_big = 10000
+        while True:
+            closest = np.argmin(dists)
+            if dists[closest] == too_big:
+                break
+            (i,j) = self.small2indices(closest, self.numStoits-1)
+            lr_dict[j].append(i)
+            lr_dict[i].append(j)
+
+            # mark these guys as neighbours
+            if len(lr_dict[i]) == 2:
+                # no more than 2 neighbours
+                sq_dists[i,:] = too_big
+                sq_dists[:,i] = too_big
+                sq_dists[i,i] = 0.0
+            if len(lr_dict[j]) == 2:
+                # no more than 2 neighbours
+                sq_dists[j,:] = too_big
+                sq_dists[:,j] = too_big
+                sq_dists[j,j] = 0.0
+
+            # fix the dist matrix
+            sq_dists[j,i] = too_big
+            sq_dists[i,j] = too_big
+            dists = squareform(sq_dists)
+
+        # now everyone should have two neighbours ( but not always )
+        # The global path may be separated into several disjoint rings.
+        # so we need to make sure that we get all the nodes in the ordering list
+        trier = 0   # start of a new disjoint ring
+        ordering = [trier]
+        while len(ordering) < len(lr_dict.keys()):
+            try:
+                adding_index = lr_dict[trier][0]    # ok IF this guy has a registered neighbour
+                if adding_index in ordering:        # NOT ok if the neighbour is already in the list
+                    raise IndexError()
+                ordering.append(adding_index)
+                while len(ordering) < len(lr_dict.keys()):  # try consume the entire ring
+                    # len(ordering) >= 2
+                    last = ordering[-1]
+                    if lr_dict[last][0] == ordering[-2]:    # bi-directionality means this will always work
+                        try:
+                            adding_index = lr_dict[last][1] # ok IF this guy has two neighbours
+                            if adding_index in ordering:    # NOT ok if the neighbour is already in the list
+                                raise IndexError()
+                            ordering.append(adding_index)
+                        except IndexError:                  # only one neighbour
+                            # stick (2 city system)
+                            while(trier in ordering):       # find the next index NOT in the ordering
+                                trier += 1
+                            if trier < len(lr_dict.keys()): # make sure it makes sense
+                                ordering.append(trier)
+                            break
+                    else:
+                        adding_index = lr_dict[last][0]
+                        if adding_index in ordering:
+                            raise IndexError()
+                        ordering.append(adding_index)
+            except IndexError:                  # start a new disjoint ring
+                # single point
+                while(trier in ordering):
+                    trier += 1
+                if trier < len(lr_dict.keys()): # make sure it makes sense
+                    ordering.append(trier)
+
+        # sanity check
+        if len(ordering) != self.numStoits:
+            print "WATTUP, ordering is looking wrong!"
+            print ordering
+            print lr_dict
+
+        return ordering
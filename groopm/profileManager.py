@@ -49,6 +49,11 @@ __email__ = "mike@mikeimelfort.com"
 ###############################################################################
 
 from sys import exc_info, exit, stdout as sys_stdout
+from threading import Thread
+from os import close as os_close, remove as os_remove
+from tempfile import mkdtemp, mkstemp
+from shutil import rmtree
+from atexit import register as atexit_register
 from operator import itemgetter
 from colorsys import hsv_to_rgb as htr
 import matplotlib.pyplot as plt
@@ -75,9 +80,14 @@ from numpy import (abs as np_abs,
                    max as np_max,
                    mean as np_mean,
                    median as np_median,
+                   memmap as np_memmap,
                    min as np_min,
+                   nonzero as np_nonzero,
+                   ones as np_ones,
                    pi as np_pi,
+                   prod as np_prod,
                    reshape as np_reshape,
+                   searchsorted as np_searchsorted,
                    seterr as np_seterr,
                    shape as np_shape,
                    sin as np_sin,
@@ -97,7 +107,8 @@ from scipy.stats import f_oneway, distributions
 
 # GroopM imports
 from PCA import PCA, Center
-from mstore import GMDataManager
+from mstore import GMDataManager, CoverageTransformer
+from groopmExceptions import UnknownSampleException
 from bin import Bin, mungeCbar
 import groopmExceptions as ge
 
@@ -113,7 +124,7 @@ class ProfileManager:
 
     Mostly a wrapper around a group of numpy arrays and a pytables quagmire
     """
-    def __init__(self, dbFileName, force=False, scaleFactor=1000):
+    def __init__(self, dbFileName, force=False, scaleFactor=1000, memmapDir=None, dtype=None, samples=None):
         # data
         self.dataManager = GMDataManager()  # most data is saved to hdf
         self.dbFileName = dbFileName        # db containing all the data we'd like to use
@@ -157,6 +168,22 @@ class ProfileManager:
         self.forceWriting = force           # overwrite existng values silently?
         self.scaleFactor = scaleFactor      # scale every thing in the transformed data to this dimension
 
+        # out of core storage
+        self.memmapDir = memmapDir          # if set, large arrays are memory-mapped from scratch files in here
+        self.scratchDir = None              # our own private scratch space inside memmapDir
+        self.blockSize = 100000             # number of rows to work on at once when streaming large arrays
+
+        # precision
+        self.dtype = dtype                  # float type of the profile arrays, None -> use whatever the DB stores
+
+        # sample selection
+        self.samples = samples              # names of the bams to work with, None -> all of them
+        self.sampleColumns = None           # columns of the coverage table holding those bams
+
+        # background loading
+        self.prefetchThreads = {}           # field name -> thread loading it
+        self.prefetchResults = {}           # field name -> [value, exc_info]
+
     def loadData(self,
                  timer,
                  condition,                 # condition as set by another function
@@ -172,8 +199,14 @@ class ProfileManager:
                  loadContigLengths=True,
                  loadContigGCs=True,
                  loadBins=False,
-                 loadLinks=False):
-        """Load pre-parsed data"""
+                 loadLinks=False,
+                 prefetch=False):           # load names and links in the background
+        """Load pre-parsed data
+
+        If prefetch is set then contig names and links are loaded in a
+        background thread while the caller gets on with other work. Use
+        waitForPrefetch before touching them
+        """
 
         timer.getTimeStamp()
         if(silent):
@@ -182,111 +215,158 @@ class ProfileManager:
             print("Loading data from:", self.dbFileName)
 
         try:
-            self.numStoits = self.getNumStoits()
-            self.condition = condition
-            self.indices = self.dataManager.getConditionalIndices(self.dbFileName,
-                                                                  condition=condition,
-                                                                  silent=silent)
-            if(verbose):
-                print("    Loaded indices with condition:", condition)
-            self.numContigs = len(self.indices)
-
-            if self.numContigs == 0:
-                print("    ERROR: No contigs loaded using condition:", condition)
-                return
-
-            if(not silent):
-                print("    Working with: %d contigs" % self.numContigs)
-
-            if(loadCovProfiles):
+            # upgrading needs the DB to itself so do it before we start reading
+            self.dataManager.checkAndUpgradeDB(self.dbFileName, silent=silent)
+
+            # read everything under one lock so a writer can't change the
+            # DB part way through
+            with self.dataManager.lockDB(self.dbFileName):
+                self.numStoits = self.getNumStoits()
+                if self.samples is not None:
+                    self.sampleColumns = self.getSampleColumns()
+                    self.numStoits = len(self.sampleColumns)
+                    if verbose:
+                        print("    Using %d of %d samples" % (self.numStoits, self.getNumStoits()))
+                if self.dtype is None:
+                    self.dtype = self.dataManager.getProfileDtype(self.dbFileName)
+                self.condition = condition
+                self.indices = self.dataManager.getConditionalIndices(self.dbFileName,
+                                                                      condition=condition,
+                                                                      silent=silent,
+                                                                      checkUpgrade=False)
                 if(verbose):
-                    print("    Loading coverage profiles")
-                self.covProfiles = self.dataManager.getCoverageProfiles(self.dbFileName, indices=self.indices)
-                self.normCoverages = self.dataManager.getNormalisedCoverageProfiles(self.dbFileName, indices=self.indices)
-
-                # work out average coverages
-                self.averageCoverages = np_array([sum(i)/self.numStoits for i in self.covProfiles])
-
-            if loadRawKmers:
-                if(verbose):
-                    print("    Loading RAW kmer sigs")
-                self.kmerSigs = self.dataManager.getKmerSigs(self.dbFileName, indices=self.indices)
-
-            if(loadKmerPCs):
-                self.kmerPCs = self.dataManager.getKmerPCAs(self.dbFileName, indices=self.indices)
-
-                if(verbose):
-                    print("    Loading PCA kmer sigs (" + str(len(self.kmerPCs[0])) + " dimensional space)")
-
-                self.kmerNormPC1 = np_copy(self.kmerPCs[:,0])
-                self.kmerNormPC1 -= np_min(self.kmerNormPC1)
-                self.kmerNormPC1 /= np_max(self.kmerNormPC1)
-
-            if(loadKmerVarPC):
-                self.kmerVarPC = self.dataManager.getKmerVarPC(self.dbFileName, indices=self.indices)
-
-                if(verbose):
-                    print("    Loading PCA kmer variance (total variance: %.2f" % np_sum(self.kmerVarPC) + ")")
-
-            if(loadContigNames):
-                if(verbose):
-                    print("    Loading contig names")
-                self.contigNames = self.dataManager.getContigNames(self.dbFileName, indices=self.indices)
-
-            if(loadContigLengths):
-                self.contigLengths = self.dataManager.getContigLengths(self.dbFileName, indices=self.indices)
-                if(verbose):
-                    print("    Loading contig lengths (Total: %d BP)" % ( sum(self.contigLengths) ))
-
-            if(loadContigGCs):
-                self.contigGCs = self.dataManager.getContigGCs(self.dbFileName, indices=self.indices)
-                if(verbose):
-                    print("    Loading contig GC ratios (Average GC: %0.3f)" % ( np_mean(self.contigGCs) ))
-
-            if(makeColors):
-                if(verbose):
-                    print("    Creating color map")
-
-                # use HSV to RGB to generate colors
-                S = 1       # SAT and VAL remain fixed at 1. Reduce to make
-                V = 1       # Pastels if that's your preference...
-                self.colorMapGC = self.createColorMapHSV()
-
-            if(loadBins):
-                if(verbose):
-                    print("    Loading bin assignments")
-
-                self.binIds = self.dataManager.getBins(self.dbFileName, indices=self.indices)
+                    print("    Loaded indices with condition:", condition)
+                self.numContigs = len(self.indices)
+
+                if self.numContigs == 0:
+                    print("    ERROR: No contigs loaded using condition:", condition)
+                    return
+
+                if(not silent):
+                    print("    Working with: %d contigs" % self.numContigs)
+
+                if(loadCovProfiles):
+                    if(verbose):
+                        print("    Loading coverage profiles")
+                    self.covProfiles = self.loadProfile('/profile/coverage', columns=self.sampleColumns)
+                    if self.samples is None:
+                        self.normCoverages = self.dataManager.getNormalisedCoverageProfiles(self.dbFileName, indices=self.indices).astype(self.dtype)
+                    else:
+                        # the stored norms are taken over every bam
+                        self.normCoverages = np_zeros(self.numContigs, dtype=self.dtype)
+                        for (start, end) in self.iterBlocks(self.numContigs):
+                            self.normCoverages[start:end] = np_sqrt(np_sum(self.covProfiles[start:end]**2, axis=1))
+
+                        # contigs with no coverage in these samples can't be placed
+                        dead_rows = np_nonzero(self.normCoverages == 0)[0]
+                        if len(dead_rows) > 0:
+                            if(verbose):
+                                print("    Ignoring %d contigs with no coverage in the selected samples" % len(dead_rows))
+                            self.indices = np_delete(self.indices, dead_rows)
+                            self.covProfiles = self.reduceArray(self.covProfiles, dead_rows)
+                            self.normCoverages = np_delete(self.normCoverages, dead_rows)
+                            self.numContigs = len(self.indices)
+
+                    # work out average coverages
+                    self.averageCoverages = np_zeros(self.numContigs, dtype=self.dtype)
+                    for (start, end) in self.iterBlocks(self.numContigs):
+                        self.averageCoverages[start:end] = np_sum(self.covProfiles[start:end], axis=1)/self.numStoits
+
+                if loadRawKmers:
+                    if(verbose):
+                        print("    Loading RAW kmer sigs")
+                    self.kmerSigs = self.loadProfile('/profile/kms')
+
+                if(loadKmerPCs):
+                    self.kmerPCs = self.loadProfile('/profile/kpca')
+
+                    if(verbose):
+                        print("    Loading PCA kmer sigs (" + str(len(self.kmerPCs[0])) + " dimensional space)")
+
+                    self.kmerNormPC1 = np_copy(self.kmerPCs[:,0])
+                    self.kmerNormPC1 -= np_min(self.kmerNormPC1)
+                    self.kmerNormPC1 /= np_max(self.kmerNormPC1)
+
+                if(loadKmerVarPC):
+                    self.kmerVarPC = self.dataManager.getKmerVarPC(self.dbFileName, indices=self.indices)
+
+                    if(verbose):
+                        print("    Loading PCA kmer variance (total variance: %.2f" % np_sum(self.kmerVarPC) + ")")
+
+                if(loadContigNames):
+                    if(prefetch):
+                        if(verbose):
+                            print("    Loading contig names (in the background)")
+                        self.startPrefetch('contigNames',
+                                           self.dataManager.getContigNames,
+                                           self.dbFileName,
+                                           indices=np_copy(self.indices))
+                    else:
+                        if(verbose):
+                            print("    Loading contig names")
+                        self.contigNames = self.dataManager.getContigNames(self.dbFileName, indices=self.indices)
+
+                if(loadContigLengths):
+                    self.contigLengths = self.dataManager.getContigLengths(self.dbFileName, indices=self.indices)
+                    if(verbose):
+                        print("    Loading contig lengths (Total: %d BP)" % ( sum(self.contigLengths) ))
+
+                if(loadContigGCs):
+                    self.contigGCs = self.dataManager.getContigGCs(self.dbFileName, indices=self.indices)
+                    if(verbose):
+                        print("    Loading contig GC ratios (Average GC: %0.3f)" % ( np_mean(self.contigGCs) ))
+
+                if(makeColors):
+                    if(verbose):
+                        print("    Creating color map")
+
+                    # use HSV to RGB to generate colors
+                    S = 1       # SAT and VAL remain fixed at 1. Reduce to make
+                    V = 1       # Pastels if that's your preference...
+                    self.colorMapGC = self.createColorMapHSV()
+
+                if(loadBins):
+                    if(verbose):
+                        print("    Loading bin assignments")
+
+                    self.binIds = self.dataManager.getBins(self.dbFileName, indices=self.indices)
+
+                    if len(bids) != 0: # need to make sure we're not restricted in terms of bins
+                        bin_stats = self.getBinStats()
+                        for bid in bids:
+                            try:
+                                self.validBinIds[bid] = bin_stats[bid][0]
+                                self.isLikelyChimeric[bid]= bin_stats[bid][1]
+                            except KeyError:
+                                self.validBinIds[bid] = 0
+                                self.isLikelyChimeric[bid]= False
 
-                if len(bids) != 0: # need to make sure we're not restricted in terms of bins
-                    bin_stats = self.getBinStats()
-                    for bid in bids:
-                        try:
+                    else:
+                        bin_stats = self.getBinStats()
+                        for bid in bin_stats:
                             self.validBinIds[bid] = bin_stats[bid][0]
-                            self.isLikelyChimeric[bid]= bin_stats[bid][1]
-                        except KeyError:
-                            self.validBinIds[bid] = 0
-                            self.isLikelyChimeric[bid]= False
+                            self.isLikelyChimeric[bid] = bin_stats[bid][1]
 
+                    # fix the binned indices
+                    self.binnedRowIndices = {}
+                    for i in range(len(self.indices)):
+                        if(self.binIds[i] != 0):
+                            self.binnedRowIndices[i] = True
                 else:
-                    bin_stats = self.getBinStats()
-                    for bid in bin_stats:
-                        self.validBinIds[bid] = bin_stats[bid][0]
-                        self.isLikelyChimeric[bid] = bin_stats[bid][1]
-
-                # fix the binned indices
-                self.binnedRowIndices = {}
-                for i in range(len(self.indices)):
-                    if(self.binIds[i] != 0):
-                        self.binnedRowIndices[i] = True
-            else:
-                # we need zeros as bin indicies then...
-                self.binIds = np_zeros(len(self.indices))
-
-            if(loadLinks):
-                self.loadLinks()
+                    # we need zeros as bin indicies then...
+                    self.binIds = np_zeros(len(self.indices))
+
+                if(loadLinks):
+                    if(prefetch):
+                        if(verbose):
+                            print("    Loading contig links (in the background)")
+                        self.startPrefetch('links', self.getLinks, np_copy(self.indices))
+                    else:
+                        self.loadLinks()
 
-            self.stoitColNames = self.getStoitColNames()
+                self.stoitColNames = self.getStoitColNames()
+                if self.samples is not None:
+                    self.stoitColNames = self.stoitColNames[self.sampleColumns]
 
         except:
             print("Error loading DB:", self.dbFileName, exc_info()[0])
@@ -297,17 +377,137 @@ class ProfileManager:
 
         Be sure that deadRowIndices are sorted ascending
         """
+        # anything still loading was loaded for the old indices
+        self.waitForPrefetch()
+
         # strip out the other values
         self.indices = np_delete(self.indices, deadRowIndices, axis=0)
-        self.covProfiles = np_delete(self.covProfiles, deadRowIndices, axis=0)
-        self.transformedCP = np_delete(self.transformedCP, deadRowIndices, axis=0)
+        self.covProfiles = self.reduceArray(self.covProfiles, deadRowIndices)
+        self.transformedCP = self.reduceArray(self.transformedCP, deadRowIndices)
         self.contigNames = np_delete(self.contigNames, deadRowIndices, axis=0)
         self.contigLengths = np_delete(self.contigLengths, deadRowIndices, axis=0)
         self.contigGCs = np_delete(self.contigGCs, deadRowIndices, axis=0)
         #self.kmerSigs = np_delete(self.kmerSigs, deadRowIndices, axis=0)
-        self.kmerPCs = np_delete(self.kmerPCs, deadRowIndices, axis=0)
+        self.kmerPCs = self.reduceArray(self.kmerPCs, deadRowIndices)
         self.binIds = np_delete(self.binIds, deadRowIndices, axis=0)
 
+#------------------------------------------------------------------------------
+# BACKGROUND LOADING
+
+    def startPrefetch(self, fieldName, loadFn, *args, **kwargs):
+        """Set loadFn(*args, **kwargs) running in the background
+
+        The result is stored as self.<fieldName> by waitForPrefetch. The
+        loader holds a shared lock like any other reader, but it still takes
+        turns with the other threads here for the HDF5 file itself (see
+        GMDataManager.openDB). So the load overlaps with the caller's
+        computation, never with its DB reads
+        """
+        def load():
+            try:
+                self.prefetchResults[fieldName] = [loadFn(*args, **kwargs), None]
+            except:
+                self.prefetchResults[fieldName] = [None, exc_info()]
+
+        self.waitForPrefetch(fieldName) # don't let two loaders race
+        thread = Thread(target=load, name="prefetch-"+fieldName)
+        thread.daemon = True
+        self.prefetchThreads[fieldName] = thread
+        thread.start()
+
+    def waitForPrefetch(self, fieldName=None):
+        """Block until a background load has finished and return its value
+
+        Returns immediately if the field is not being loaded. With no
+        fieldName, wait for everything
+        """
+        if fieldName is None:
+            for field_name in list(self.prefetchThreads.keys()):
+                self.waitForPrefetch(field_name)
+            return None
+
+        thread = self.prefetchThreads.pop(fieldName, None)
+        if thread is not None:
+            thread.join()
+            (value, error) = self.prefetchResults.pop(fieldName)
+            if error is not None:
+                print("Error loading DB:", self.dbFileName, error[0])
+                raise error[0], error[1], error[2]
+            setattr(self, fieldName, value)
+        return getattr(self, fieldName, None)
+
+    def isPrefetching(self, fieldName):
+        """Is this field still loading in the background?"""
+        thread = self.prefetchThreads.get(fieldName)
+        return thread is not None and thread.is_alive()
+
+#------------------------------------------------------------------------------
+# OUT OF CORE STORAGE
+
+    def isOutOfCore(self):
+        """Are the large profile arrays memory-mapped from scratch files?"""
+        return self.memmapDir is not None
+
+    def makeProfileArray(self, shape, dtype=float):
+        """Make storage for a large per-contig array
+
+        Returns an ordinary numpy array, or a numpy.memmap backed by a file
+        in the scratch directory when we are working out of core
+        """
+        if not self.isOutOfCore() or np_prod(shape) == 0:
+            return np_zeros(shape, dtype=dtype)
+
+        if self.scratchDir is None:
+            self.scratchDir = mkdtemp(prefix="groopm_", dir=self.memmapDir)
+            atexit_register(rmtree, self.scratchDir, True)
+
+        (fd, file_name) = mkstemp(suffix=".dat", dir=self.scratchDir)
+        os_close(fd)
+        profile = np_memmap(file_name, dtype=dtype, mode='w+', shape=shape)
+        # the mapping keeps the data alive, the disk space is
+        # handed back as soon as the array is garbage collected
+        os_remove(file_name)
+        return profile
+
+    def iterBlocks(self, numRows):
+        """Yield (start, end) pairs which cover numRows rows in blocks"""
+        for start in range(0, numRows, self.blockSize):
+            yield (start, min(start + self.blockSize, numRows))
+
+    def loadProfile(self, nodePath, columns=None):
+        """Load the rows of a profile table which match the current indices
+
+        columns optionally selects columns (by position) of the table
+        """
+        if columns is None:
+            num_cols = self.dataManager.getNumColumns(self.dbFileName, nodePath)
+        else:
+            num_cols = len(columns)
+        profile = self.makeProfileArray((self.numContigs, num_cols), dtype=self.dtype)
+        return self.dataManager.fillProfileArray(self.dbFileName,
+                                                 nodePath,
+                                                 self.indices,
+                                                 profile,
+                                                 blockSize=self.blockSize,
+                                                 columns=columns)
+
+    def reduceArray(self, profile, deadRowIndices):
+        """Remove rows from a (possibly memory-mapped) array
+
+        memory-mapped arrays are copied block by block into new scratch
+        storage so the full array is never pulled into RAM
+        """
+        if not isinstance(profile, np_memmap):
+            return np_delete(profile, deadRowIndices, axis=0)
+
+        keep = np_ones(len(profile), dtype=bool)
+        keep[deadRowIndices] = False
+        kept_rows = np_where(keep)[0]
+        reduced = self.makeProfileArray((len(kept_rows),) + profile.shape[1:], dtype=profile.dtype)
+        for (start, end) in self.iterBlocks(len(kept_rows)):
+            reduced[start:end] = profile[kept_rows[start:end]]
+        return reduced
+
 #------------------------------------------------------------------------------
 # GET / SET
 
@@ -344,6 +544,18 @@ class ProfileManager:
         """return the value of stoitColNames in the metadata tables"""
         return np_array(self.dataManager.getStoitColNames(self.dbFileName).split(","))
 
+    def getSampleColumns(self):
+        """Work out which columns of the coverage table hold the selected samples"""
+        stoit_col_names = list(self.getStoitColNames())
+        columns = []
+        for sample in self.samples:
+            try:
+                columns.append(stoit_col_names.index(sample))
+            except ValueError:
+                raise UnknownSampleException("Unknown sample: '%s'. Choose from: %s" % (sample, ", ".join(stoit_col_names)))
+        # keep the DB's ordering
+        return np_array(sorted(set(columns)))
+
     def isClustered(self):
         """Has the data been clustered already"""
         return self.dataManager.isClustered(self.dbFileName)
@@ -384,18 +596,23 @@ class ProfileManager:
         """Extra wrapper 'cause I am dumb"""
         self.links = self.getLinks()
 
-    def getLinks(self):
-        """Get contig links"""
+    def getLinks(self, indices=None):
+        """Get contig links
+
+        indices defaults to the currently loaded rows
+        """
+        if indices is None:
+            indices = self.indices
         # first we get the absolute links
-        absolute_links = self.dataManager.restoreLinks(self.dbFileName, self.indices)
+        absolute_links = self.dataManager.restoreLinks(self.dbFileName, indices)
         # now convert this into plain old row_indices
         reverse_index_lookup = {}
-        for i in range(len(self.indices)):
-            reverse_index_lookup[self.indices[i]] = i
+        for i in range(len(indices)):
+            reverse_index_lookup[indices[i]] = i
 
         # now convert the absolute links to local ones
         relative_links = {}
-        for cid in self.indices:
+        for cid in indices:
             local_cid = reverse_index_lookup[cid]
             relative_links[local_cid] = []
             try:
@@ -406,6 +623,22 @@ class ProfileManager:
 
         return relative_links
 
+    def getRowIndicesForNames(self, contigNames, nameIndex=None):
+        """Map contig names to row indices into the loaded arrays
+
+        Uses the name index in the DB so we never need to build a dict of
+        every contig name. Names which are unknown, or were not loaded
+        with the current condition, map to -1. See
+        GMDataManager.getRowIndicesForNames for nameIndex
+        """
+        db_rows = self.dataManager.getRowIndicesForNames(self.dbFileName, contigNames, nameIndex=nameIndex)
+        if len(self.indices) == 0:
+            return np_zeros(len(db_rows), dtype=int) - 1
+        row_indices = np_searchsorted(self.indices, db_rows)
+        row_indices[row_indices >= len(self.indices)] = 0
+        found = (db_rows >= 0) & (self.indices[row_indices] == db_rows)
+        return np_where(found, row_indices, -1)
+
 #------------------------------------------------------------------------------
 # DATA TRANSFORMATIONS
 
@@ -498,11 +731,58 @@ class ProfileManager:
         """Do the main transformation on the coverage profile data"""
         if(not silent):
             print("    Reticulating splines")
-        self.transformedCP = self.dataManager.getTransformedCoverageProfiles(self.dbFileName, indices=self.indices)
-        self.corners = self.dataManager.getTransformedCoverageCorners(self.dbFileName)
-        self.TCentre = np_mean(self.corners, axis=0)
+        if self.samples is not None:
+            # the stored transformation uses every bam
+            self.transformSamples(silent=silent, nolog=nolog)
+        else:
+            self.transformedCP = self.loadProfile('/profile/transCoverage')
+            self.corners = self.dataManager.getTransformedCoverageCorners(self.dbFileName)
+            self.TCentre = np_mean(self.corners, axis=0)
         self.transRadius = np_norm(self.corners[0] - self.TCentre)
 
+    def transformSamples(self, silent=False, nolog=False):
+        """Transform the coverage profiles of the selected samples
+
+        Does what parse does for all the bams, but in memory and
+        block by block. The coverage columns (and stoitColNames) are
+        reordered in the same way parse would order them
+        """
+        if(not silent):
+            print("    Transforming coverage for %d samples" % self.numStoits)
+        kmer_norm_PC1 = self.kmerNormPC1
+        if len(kmer_norm_PC1) != self.numContigs:
+            # only used to pick a repeatable subset when ordering the bams
+            kmer_norm_PC1 = np_zeros(self.numContigs)
+        CT = CoverageTransformer(self.numContigs,
+                                 self.numStoits,
+                                 self.normCoverages,
+                                 kmer_norm_PC1,
+                                 self.covProfiles,
+                                 self.stoitColNames,
+                                 scaleFactor=self.scaleFactor)
+        if self.numStoits > 3:
+            CT.shuffleBAMs()
+            self.sampleColumns = self.sampleColumns[CT.stoitOrder]
+        self.stoitColNames = CT.stoitColNames
+
+        # first pass works out the raw positions
+        self.transformedCP = self.makeProfileArray((self.numContigs, 3), dtype=self.dtype)
+        for (start, end) in self.iterBlocks(self.numContigs):
+            self.transformedCP[start:end] = CT.transformBlock(self.covProfiles[start:end],
+                                                              self.normCoverages[start:end],
+                                                              nolog=nolog)
+
+        # second pass scales it to fit
+        t_min = np_amin(self.transformedCP, axis=0)
+        t_scale = (np_amax(self.transformedCP, axis=0) - t_min) / (self.scaleFactor-1)
+        for (start, end) in self.iterBlocks(self.numContigs):
+            self.transformedCP[start:end] -= t_min
+            self.transformedCP[start:end] /= t_scale
+
+        CT.makeCorners(t_min, t_scale)
+        self.corners = CT.corners
+        self.TCentre = CT.TCentre
+
 #------------------------------------------------------------------------------
 # DEBUG CRUFT
 
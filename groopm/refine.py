@@ -112,12 +112,14 @@ class RefineEngine:
                  getUnbinned=False,
                  loadContigNames=False,
                  cutOff=0,
-                 bids=[]):
+                 bids=[],
+                 memmapDir=None,
+                 samples=None):
 
         # worker classes
         if BM is None:
             # make our own ones from scratch
-            self.BM = BinManager(dbFileName=dbFileName)
+            self.BM = BinManager(dbFileName=dbFileName, memmapDir=memmapDir, samples=samples)
             self.BM.loadBins(timer,
                              bids=bids,
                              makeBins=True,
@@ -125,7 +127,8 @@ class RefineEngine:
                              cutOff=cutOff,
                              loadContigNames=loadContigNames,
                              getUnbinned=getUnbinned,
-                             transform=transform)
+                             transform=transform,
+                             prefetch=True)
         else:
             self.BM = BM
 
@@ -190,12 +193,17 @@ class RefineEngine:
         show_chimeric_bins = False
         ET = self.ET
         self.printRefinePlotterInstructions()
+        # don't make the user wait on the disk between commands
+        self.BM.backgroundSaves = True
         #self.BM.plotBinIds(ignoreRanges=ignoreRanges)
         continue_merge = True
         while(continue_merge):
             user_option = self.promptOnPlotterRefine()
 
             if(user_option == 'Q'):
+                # make sure everything is on disk before we go
+                self.BM.backgroundSaves = False
+                self.BM.flushBins()
                 print '\nBye!'
                 return
 
@@ -1033,7 +1041,7 @@ class RefineEngine:
         # this is the bin centroid values
         bids = self.BM.getBids()
         #bids = self.BM.getNonChimericBinIds()
-        training_data = np_zeros((len(bids), SOMDIM))
+        training_data = np_zeros((len(bids), SOMDIM), dtype=self.PM.dtype)
         i = 0
         for bid in bids:
             training_data[i,:-1] = np_mean(self.PM.transformedCP[self.BM.bins[bid].rowIndices], axis=0)
@@ -1045,11 +1053,11 @@ class RefineEngine:
         # normalise the data so it fits between 0 and 1
         # but make sure that the max global CP and mer values are
         # used to scale
-        minz = np_zeros((SOMDIM))
+        minz = np_zeros((SOMDIM), dtype=self.PM.dtype)
         minz[:-1] = np_min(self.PM.transformedCP, axis=0)
         minz[-1] = np_min(self.PM.kmerNormPC1, axis=0)
 
-        maxz = np_zeros((SOMDIM))
+        maxz = np_zeros((SOMDIM), dtype=self.PM.dtype)
         maxz[:-1] = np_max(self.PM.transformedCP, axis=0)
         maxz[-1] = np_max(self.PM.kmerNormPC1, axis=0)
 
@@ -1063,7 +1071,7 @@ class RefineEngine:
         tmaxz = np_max(training_data, axis=0)
 
         # set training in motion
-        SS = SOM(som_side, SOMDIM, lc=tminz, uc=tmaxz)
+        SS = SOM(som_side, SOMDIM, lc=tminz, uc=tmaxz, dtype=self.PM.dtype)
         SS.train(training_data,
                  influenceRate=0.15,
                  iterations=800,
@@ -1138,7 +1146,7 @@ class RefineEngine:
         bin = self.BM.bins[bid]
 
         # make a training set of just this node's contigs
-        block = np_zeros((bin.binSize,SOMDIM))
+        block = np_zeros((bin.binSize,SOMDIM), dtype=self.PM.dtype)
         block[:,:-1] = self.PM.transformedCP[bin.rowIndices]
         block[:,-1] = self.PM.kmerNormPC1[bin.rowIndices]
 
@@ -1208,13 +1216,15 @@ class RefineEngine:
         nones = {}
 
         # we load all contigs into the block
-        block = np_zeros((len(self.PM.transformedCP),SOMDIM))
-        block[:,:-1] = self.PM.transformedCP
-        block[:,-1] = self.PM.kmerNormPC1
+        num_rows = len(self.PM.transformedCP)
+        block = self.PM.makeProfileArray((num_rows,SOMDIM), dtype=self.PM.dtype)
+        for (start, end) in self.PM.iterBlocks(num_rows):
+            block[start:end,:-1] = self.PM.transformedCP[start:end]
+            block[start:end,-1] = self.PM.kmerNormPC1[start:end]
 
-        # apply sane normalisation
-        block -= minz
-        block /= maxz
+            # apply sane normalisation
+            block[start:end] -= minz
+            block[start:end] /= maxz
 
         for i in range(len(self.PM.indices)):
             assigned = False
@@ -2125,7 +2135,7 @@ class RefineEngine:
                 if unbinned[row_index] >= cutoff:
                     unbinned_rows.append(row_index)
                     unbinned_lens.append(unbinned[row_index])
-            block = np_zeros((len(unbinned_rows),SOMDIM))
+            block = np_zeros((len(unbinned_rows),SOMDIM), dtype=self.PM.dtype)
             block[:,:-1] = self.PM.transformedCP[unbinned_rows]
             block[:,-1] = self.PM.kmerNormPC1[unbinned_rows]
             # apply sane normalisation
@@ -91,7 +91,7 @@ import groopmExceptions as ge
 
 class SOM:
     """A single instance of a self organising map"""
-    def __init__(self, side, dimension, lc=None, uc=None):
+    def __init__(self, side, dimension, lc=None, uc=None, dtype=float):
         self.side = side # side length of the grid
         self.dimension = dimension # size of our grid vectors
         self.bestMatchCoords = [] # x/y coords of classified vectors
@@ -99,7 +99,7 @@ class SOM:
         self.radius = float(side)/2 # the radius of neighbour nodes which will be influenced by each new training vector
 
         # initialise the nodes to random values between 0 -> 1
-        self.weights = TM(self.side, dimension=self.dimension, randomize=True)
+        self.weights = TM(self.side, dimension=self.dimension, randomize=True, dtype=dtype)
 
         # cutoff for turning the VS_flat into a boundary mask
         # this is a magic number, but it seems to work OK
@@ -326,7 +326,7 @@ class SOM:
                 index_array = rand_index_array[:cut_off]
 #--------
 # Make worksheet
-            worksheet = np.zeros(self.dimension*rows*cols*9).reshape((rows*3,
+            worksheet = np.zeros(self.dimension*rows*cols*9, dtype=weights.dtype).reshape((rows*3,
                                                                       cols*3,
                                                                       self.dimension))
             worksheet[0:rows,0:cols] = weights
@@ -72,11 +72,12 @@ class UnknownDistanceType(BaseException):
 class TorusMesh:
     """A closed mesh, in the shape of a torus"""
     
-    def __init__(self, rows, columns=0, dimension=1, randomize=False):
+    def __init__(self, rows, columns=0, dimension=1, randomize=False, dtype=float):
         """ init
         Set columns if you'd like something other than a square
         By default the torus is a scalar field.
         Increase dimension if you'd like a vector field
+        Set dtype to np.float32 to halve the memory used by the nodes
         """
         self.rows = rows
         if(columns == 0): # make it square
@@ -95,9 +96,9 @@ class TorusMesh:
         # the first two dimensions repesent points on the surface
         # the remainder represent values
         if(randomize):
-            self.nodes = np.random.random(self.size).reshape(self.shape)
+            self.nodes = np.random.random(self.size).astype(dtype).reshape(self.shape)
         else:
-            self.nodes = np.zeros(self.size).reshape(self.shape)
+            self.nodes = np.zeros(self.size, dtype=dtype).reshape(self.shape)
 
         # make an array of flattened nodes
         self.flatNodes = self.nodes.reshape(self.flatShape)